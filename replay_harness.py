@@ -0,0 +1,1215 @@
+"""Offline replay harness and latency benchmark for stealth_copilot.py.
+
+Plays a recorded session (audio.pcm + turns.jsonl written when SESSION_RECORD_DIR
+is set, or just a turns.jsonl of AssemblyAI "Turn" messages) through the real
+websocket_stream / on_message / StreamManager path. AssemblyAI and OpenAI are
+replaced by local stand-ins with configurable delays, so no network is needed.
+
+Examples:
+    python replay_harness.py replay/sample_session
+    python replay_harness.py replay/sample_session --through-stt --runs 5
+    python replay_harness.py replay/sample_session --runs 20 --max-p95-first-token-ms 800
+    python replay_harness.py replay/corpus --check-transcripts
+    python replay_harness.py replay/sample_session --load-test --speed 2
+    python replay_harness.py --bench-capture
+"""
+import argparse
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import os
+import queue
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # The stand-ins never check keys; this only lets stealth_copilot import in CI.
+    config = types.ModuleType("config")
+    config.OPENAI_API_KEY = "replay"
+    config.ASSEMBLYAI_API_KEY = "replay"
+    sys.modules["config"] = config
+
+import stealth_copilot as sc
+
+BYTES_PER_MS = sc.RATE * sc.CHANNELS * 2 // 1000
+DEFAULT_ANSWER = (
+    "Yes, roll back first with the previous image, then dig into the cause.\n"
+    "```bash\nkubectl rollout undo deployment/api -n prod\n```\n"
+    "That restores service in under a minute; after that I check the diff, "
+    "fix forward, and add a canary gate so it cannot ship unnoticed again."
+)
+
+# ========================
+# Scenario Loading
+# ========================
+
+def load_scenario(path):
+    # Accepts a recorded session folder or a bare turns.jsonl file.
+    if os.path.isdir(path):
+        turns_path = os.path.join(path, "turns.jsonl")
+        pcm_path = os.path.join(path, "audio.pcm")
+    else:
+        turns_path = path
+        pcm_path = None
+    turns = []
+    with open(turns_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                turns.append(json.loads(line))
+    turns.sort(key=lambda m: m.get("t_ms", 0))
+    pcm = None
+    if pcm_path and os.path.exists(pcm_path):
+        with open(pcm_path, "rb") as f:
+            pcm = f.read()
+    return turns, pcm
+
+def synthesize_pcm(turns, tail_ms=500):
+    # Low-level noise long enough to drive every scripted message, with a louder
+    # tone over each spoken word so local silence detection sees the pauses.
+    duration_ms = (turns[-1].get("t_ms", 0) if turns else 0) + tail_ms
+    frame = struct.pack("<8h", 12, -9, 30, -22, 5, -17, 8, -3)
+    total = duration_ms * BYTES_PER_MS
+    pcm = bytearray((frame * (total // len(frame) + 1))[:total])
+    samples_per_ms = BYTES_PER_MS // 2
+    tone = (3000 * np.sin(np.arange(samples_per_ms * 1000) * 2 * np.pi * 220 / sc.RATE)).astype(np.int16)
+    for msg in turns:
+        if not msg.get("end_of_turn"):
+            continue
+        for word in msg.get("words") or []:
+            start, end = word["start"] * samples_per_ms, min(word["end"], duration_ms) * samples_per_ms
+            if end > start:
+                pcm[start * 2:end * 2] = np.resize(tone, end - start).tobytes()
+    return bytes(pcm)
+
+# ========================
+# Transcript Check
+# ========================
+
+def legacy_questions(turns):
+    # What on_message sent before TurnTracker: every partial appended to the
+    # previous ones, then the final transcript on top.
+    interim, questions = "", []
+    for msg in turns:
+        if msg.get("type") != "Turn":
+            continue
+        transcript = msg.get("transcript", "")
+        if msg.get("end_of_turn"):
+            questions.append((interim + " " + transcript).strip())
+            interim = ""
+        else:
+            interim = (interim + " " + transcript).strip()
+    return questions
+
+def tracked_questions(turns):
+    tracker = sc.TurnTracker()
+    questions = []
+    for msg in turns:
+        if msg.get("type") == "Turn":
+            text = tracker.update(msg)
+            if msg.get("end_of_turn"):
+                questions.append(text)
+    return questions
+
+def check_transcripts(path):
+    # Replays each scenario's messages through TurnTracker only (no stand-ins)
+    # and compares the question text at every end_of_turn with the old
+    # accumulation and, if the folder has an expected.json, the expected text
+    # and (its "kinds") how TurnClassifier labels each one without history.
+    folders = [path] if os.path.exists(os.path.join(path, "turns.jsonl")) else sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if os.path.exists(os.path.join(path, name, "turns.jsonl")))
+    failed = False
+    totals = [0, 0]
+    print(f"{'scenario':<24}{'finals':>7}{'old chars':>11}{'new chars':>11}{'old tokens':>12}{'new tokens':>12}{'saved':>8}")
+    for folder in folders:
+        turns, _ = load_scenario(folder)
+        old, new = legacy_questions(turns), tracked_questions(turns)
+        old_chars, new_chars = sum(map(len, old)), sum(map(len, new))
+        old_tokens = sum(sc.estimate_tokens(q) for q in old)
+        new_tokens = sum(sc.estimate_tokens(q) for q in new)
+        totals[0] += old_tokens
+        totals[1] += new_tokens
+        saved = 100.0 * (1 - new_tokens / old_tokens) if old_tokens else 0.0
+        print(f"{os.path.basename(folder):<24}{len(new):>7}{old_chars:>11}{new_chars:>11}{old_tokens:>12}{new_tokens:>12}{saved:>7.0f}%")
+        expected_path = os.path.join(folder, "expected.json")
+        if os.path.exists(expected_path):
+            with open(expected_path, "r", encoding="utf-8") as f:
+                expected = json.load(f)
+            if new != expected["questions"]:
+                failed = True
+                print(f"[FAIL] {os.path.basename(folder)}: expected {expected['questions']}, got {new}")
+            if "kinds" in expected:
+                classifier = sc.TurnClassifier(path=None)
+                kinds = [classifier.classify(question, log=False)[0] for question in new]
+                for question, kind, want in zip(new, kinds, expected["kinds"]):
+                    if kind != want:
+                        failed = True
+                        print(f"[FAIL] {os.path.basename(folder)}: {question!r} classified as {kind}, expected {want}")
+    if totals[0]:
+        print(f"Question tokens: {totals[0]} -> {totals[1]} ({100.0 * (1 - totals[1] / totals[0]):.0f}% fewer)")
+    return 1 if failed else 0
+
+class PcmReplaySource:
+    # Stands in for the PyAudio stream: read(CHUNK) paced at real time / speed.
+    def __init__(self, pcm, speed=1.0):
+        self.pcm = pcm
+        self.speed = speed
+        self.offset = 0
+        self.started = None
+
+    def read(self, frames):
+        if self.started is None:
+            self.started = time.perf_counter()
+        size = frames * sc.CHANNELS * 2
+        data = self.pcm[self.offset:self.offset + size]
+        self.offset += len(data)
+        due = self.started + (self.offset / BYTES_PER_MS) / 1000.0 / self.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+# ========================
+# Local Streaming STT Stand-in
+# ========================
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def _recv_exact(sock, n):
+    buf = b""
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        buf += chunk
+    return buf
+
+def _read_frame(sock):
+    b1, b2 = _recv_exact(sock, 2)
+    opcode = b1 & 0x0F
+    length = b2 & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", _recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", _recv_exact(sock, 8))[0]
+    mask = _recv_exact(sock, 4) if b2 & 0x80 else None
+    payload = _recv_exact(sock, length) if length else b""
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+def _send_frame(sock, opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    sock.sendall(header + payload)
+
+class FakeSTTServer:
+    # Minimal RFC 6455 server that emits the scripted Turn messages once the audio
+    # it has received reaches each message's t_ms, plus stt_delay_ms of latency.
+    # With drop_at_ms it cuts the connection once at that point of the script and
+    # refuses new ones for outage_ms; the next session resumes the script from the
+    # last finished turn, as a real STT re-transcribing the replayed audio would.
+    # A ForceEndpoint message ends the current turn right away: its remaining
+    # scripted messages are sent at once instead of at their t_ms.
+    def __init__(self, turns, stt_delay_ms=0, speed=1.0, drop_at_ms=None, outage_ms=2000):
+        self.turns = [m for m in turns if m.get("type") != "Begin"]
+        self.stt_delay = stt_delay_ms / 1000.0
+        self.speed = speed
+        self.drop_at_ms = drop_at_ms
+        self.outage = outage_ms / 1000.0
+        self.connections = 0
+        self.reset()
+        harness = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                harness._serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"ws://127.0.0.1:{self.server.server_address[1]}/v3/ws"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        self.dropped = False
+        self.resume = None
+        self.refuse_until = 0.0
+        self.endpoint_delays = []  # audio ms from a turn's last word to its end_of_turn
+        self.forced_endpoints = 0
+        self.max_turn_silence = None
+
+    def _handshake(self, sock):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("handshake aborted")
+            request += chunk
+        key = ""
+        for line in request.decode("latin-1").split("\r\n"):
+            if line.lower().startswith("sec-websocket-key:"):
+                key = line.split(":", 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        sock.sendall(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+
+    def _serve(self, sock):
+        if time.perf_counter() < self.refuse_until:
+            sock.close()
+            return
+        self._handshake(sock)
+        self.connections += 1
+        send_lock = threading.Lock()
+        pending = queue.Queue()
+        done = threading.Event()
+
+        def send_text(data):
+            with send_lock:
+                _send_frame(sock, 0x1, json.dumps(data).encode())
+
+        def sender():
+            try:
+                while not done.is_set():
+                    try:
+                        due, msg = pending.get(timeout=0.05)
+                    except queue.Empty:
+                        continue
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    send_text(msg)
+            except OSError:
+                pass
+
+        send_text({"type": "Begin", "id": f"replay-{self.connections}", "expires_at": int(time.time()) + 3600})
+        threading.Thread(target=sender, daemon=True).start()
+        audio_bytes = 0
+        next_index, base_ms = self.resume or (0, 0)
+        self.resume = None
+        last_end = (next_index, base_ms)
+        audio_ms = base_ms
+
+        def emit(index):
+            # Queues scripted message `index`; returns its turn's resume point if it ends the turn.
+            msg = {k: v for k, v in self.turns[index].items() if k != "t_ms"}
+            if base_ms and msg.get("words"):
+                msg["words"] = [dict(w, start=w["start"] - base_ms, end=w["end"] - base_ms) for w in msg["words"]]
+            pending.put((time.perf_counter() + self.stt_delay / self.speed, msg))
+            if not msg.get("end_of_turn"):
+                return None
+            words = self.turns[index].get("words") or []
+            end = words[-1]["end"] if words else self.turns[index].get("t_ms", 0)
+            if index == 0 or not self.turns[index - 1].get("end_of_turn"):
+                self.endpoint_delays.append(audio_ms - end)
+            return (index + 1, end)
+
+        try:
+            while True:
+                opcode, payload = _read_frame(sock)
+                if opcode == 0x8:
+                    with send_lock:
+                        _send_frame(sock, 0x8, payload[:2])
+                    break
+                if opcode == 0x9:
+                    with send_lock:
+                        _send_frame(sock, 0xA, payload)
+                    continue
+                if opcode == 0x1:
+                    control = json.loads(payload or b"{}")
+                    if control.get("type") == "UpdateConfiguration":
+                        self.max_turn_silence = control.get("max_turn_silence", self.max_turn_silence)
+                    elif control.get("type") == "ForceEndpoint" and 0 < next_index < len(self.turns):
+                        order = self.turns[next_index - 1].get("turn_order")
+                        if not self.turns[next_index - 1].get("end_of_turn"):
+                            self.forced_endpoints += 1
+                            while next_index < len(self.turns) and self.turns[next_index].get("turn_order") == order:
+                                last_end = emit(next_index) or last_end
+                                next_index += 1
+                    continue
+                if opcode != 0x2:
+                    continue
+                audio_bytes += len(payload)
+                audio_ms = base_ms + audio_bytes / BYTES_PER_MS
+                if self.drop_at_ms is not None and not self.dropped and audio_ms >= self.drop_at_ms:
+                    self.dropped = True
+                    self.resume = last_end
+                    self.refuse_until = time.perf_counter() + self.outage / self.speed
+                    sock.shutdown(socket.SHUT_RDWR)
+                    break
+                while next_index < len(self.turns) and self.turns[next_index].get("t_ms", 0) <= audio_ms:
+                    last_end = emit(next_index) or last_end
+                    next_index += 1
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            done.set()
+
+# ========================
+# Local Responses API Stand-in
+# ========================
+
+def _tokenize_answer(text, max_tokens):
+    tokens = []
+    word = ""
+    for ch in text:
+        word += ch
+        if ch in " \n" or len(word) >= 4:
+            tokens.append(word)
+            word = ""
+    if word:
+        tokens.append(word)
+    return tokens[:max_tokens]
+
+class FakeResponsesServer:
+    # Serves POST /v1/responses as a Responses-API SSE stream. ttft_ms is the delay
+    # before the first delta, token_ms the gap between deltas, connect_ms the extra
+    # setup cost (DNS/TLS) paid once per new connection. A stall_rate share of
+    # streaming requests waits stall_ms longer for its first token, and an
+    # error_rate share fails with a 503 (seeded, so runs are repeatable).
+    def __init__(self, ttft_ms=300, token_ms=15, answer=DEFAULT_ANSWER, max_tokens=120, connect_ms=0,
+                 stall_rate=0.0, stall_ms=3000, error_rate=0.0):
+        self.ttft = ttft_ms / 1000.0
+        self.stall_rate = stall_rate
+        self.stall = stall_ms / 1000.0
+        self.error_rate = error_rate
+        self.rng = random.Random(7)
+        self.connect = connect_ms / 1000.0
+        self.connections = 0
+        self.token_gap = token_ms / 1000.0
+        self.answer = answer
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.seen_inputs = []
+        self.seen_lock = threading.Lock()
+        harness = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                harness.connections += 1
+                time.sleep(harness.connect)
+
+            def handle(self):
+                # A client that gives up mid-response (a cancelled or superseded
+                # answer) is not an error, whichever write it interrupts.
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def do_GET(self):
+                # models.retrieve, used by the keep-alive pings.
+                model = self.path.rstrip("/").rsplit("/", 1)[-1]
+                payload = json.dumps({"id": model, "object": "model", "created": 0, "owned_by": "replay"}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+                harness.requests += 1
+                request = json.loads(body or b"{}")
+                if request.get("stream") and harness.rng.random() < harness.error_rate:
+                    payload = json.dumps({"error": {"message": "replay: injected overload", "type": "server_error"}}).encode()
+                    self.send_response(503)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                if not request.get("stream"):
+                    # Non-streaming calls (e.g. the memory summarizer) get the final response.
+                    *_, completed = harness._events(request)
+                    payload = json.dumps(completed["response"]).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for event in harness._events(request):
+                    payload = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+                    self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _cached_tokens(self, serialized):
+        # Mimics server-side prompt caching: the longest prefix shared with a recent
+        # request counts once it reaches 1024 tokens, in 128-token steps.
+        with self.seen_lock:
+            best = 0
+            for previous in self.seen_inputs:
+                limit = min(len(previous), len(serialized))
+                n = 0
+                while n < limit and previous[n] == serialized[n]:
+                    n += 1
+                best = max(best, n)
+            self.seen_inputs = (self.seen_inputs + [serialized])[-8:]
+        tokens = best // 4
+        return tokens // 128 * 128 if tokens >= 1024 else 0
+
+    def _events(self, request):
+        model = request.get("model", sc.AI_MODEL)
+        resp_id = f"resp_replay_{self.requests}"
+        msg_id = f"msg_replay_{self.requests}"
+        tokens = _tokenize_answer(self.answer, min(self.max_tokens, request.get("max_output_tokens") or self.max_tokens))
+        text = "".join(tokens)
+        serialized = json.dumps(request.get("input", ""))
+        input_tokens = len(serialized) // 4
+        cached_tokens = self._cached_tokens(serialized)
+        seq = iter(range(10 ** 6))
+
+        def response(status, output, usage=None):
+            return {
+                "id": resp_id, "object": "response", "created_at": int(time.time()), "model": model,
+                "status": status, "output": output, "parallel_tool_calls": True, "tool_choice": "auto",
+                "tools": [], "usage": usage,
+            }
+
+        item = {"id": msg_id, "type": "message", "role": "assistant", "status": "in_progress", "content": []}
+        part = {"type": "output_text", "text": "", "annotations": []}
+        yield {"type": "response.created", "sequence_number": next(seq), "response": response("in_progress", [])}
+        yield {"type": "response.output_item.added", "sequence_number": next(seq), "output_index": 0, "item": item}
+        yield {"type": "response.content_part.added", "sequence_number": next(seq), "item_id": msg_id,
+               "output_index": 0, "content_index": 0, "part": part}
+        stalled = request.get("stream") and self.rng.random() < self.stall_rate
+        time.sleep(self.ttft + (self.stall if stalled else 0))
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.token_gap)
+            yield {"type": "response.output_text.delta", "sequence_number": next(seq), "item_id": msg_id,
+                   "output_index": 0, "content_index": 0, "delta": token, "logprobs": []}
+        done_part = dict(part, text=text)
+        done_item = dict(item, status="completed", content=[done_part])
+        usage = {
+            "input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": cached_tokens},
+            "output_tokens": len(tokens), "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + len(tokens),
+        }
+        yield {"type": "response.output_text.done", "sequence_number": next(seq), "item_id": msg_id,
+               "output_index": 0, "content_index": 0, "text": text, "logprobs": []}
+        yield {"type": "response.content_part.done", "sequence_number": next(seq), "item_id": msg_id,
+               "output_index": 0, "content_index": 0, "part": done_part}
+        yield {"type": "response.output_item.done", "sequence_number": next(seq), "output_index": 0, "item": done_item}
+        yield {"type": "response.completed", "sequence_number": next(seq),
+               "response": response("completed", [done_item], usage)}
+
+# ========================
+# Latency Probe
+# ========================
+
+class LatencyProbe:
+    # Stamps end-of-turn, first token queued, and first/last render per generation.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.end_of_turn = {}
+        self.turn_ended = {}
+        self.first_token = {}
+        self.first_render = {}
+        self.last_render = {}
+        self.completed = set()
+        self.started = 0
+        self.cache_hits = 0
+
+probe = None
+
+class ProbedQueue(sc.AnswerQueue):
+    def put(self, msg):
+        delivered = super().put(msg)
+        if delivered and msg.get("type") == "text" and probe is not None:
+            with probe.lock:
+                probe.first_token.setdefault(msg.get("gen"), time.perf_counter())
+        return delivered
+
+class ProbeMixin:
+    # Counts requests sent and answers that streamed to the end; an answer
+    # finished before its speculative promotion still counts once promoted.
+    def _begin_response(self, transcript, gen, spec):
+        prompt_input = super()._begin_response(transcript, gen, spec)
+        if prompt_input is not None:
+            with probe.lock:
+                probe.started += 1
+        return prompt_input
+
+    def _finish_response(self, transcript, gen, spec, response_text):
+        super()._finish_response(transcript, gen, spec, response_text)
+        with probe.lock:
+            probe.completed.add(gen)
+
+    def _serve_cached(self, transcript, gen, answer):
+        super()._serve_cached(transcript, gen, answer)
+        with probe.lock:
+            probe.cache_hits += 1
+            probe.completed.add(gen)
+
+class ProbedStreamManager(ProbeMixin, sc.StreamManager):
+    pass
+
+class ProbedAsyncStreamManager(ProbeMixin, sc.AsyncStreamManager):
+    pass
+
+class ProbedAsyncPipeline(sc.AsyncPipeline):
+    llm_url = None
+
+    def make_stream_manager(self):
+        async_client = sc.build_async_openai_client(api_key="replay", base_url=self.llm_url, max_retries=0)
+        return ProbedAsyncStreamManager(self.loop, async_client)
+
+original_on_message = sc.on_message
+
+def probed_on_message(ws, message):
+    # Latency is measured from the FIRST end_of_turn of a turn_order, so restarts
+    # caused by later end_of_turn messages for the same turn count against it.
+    now = time.perf_counter()
+    try:
+        data = json.loads(message)
+    except ValueError:
+        data = {}
+    original_on_message(ws, message)
+    if data.get("end_of_turn"):
+        with probe.lock:
+            ended = probe.turn_ended.setdefault(data.get("turn_order", now), now)
+            probe.end_of_turn.setdefault(sc.stream_manager.current_generation, ended)
+
+class HeadlessRenderer:
+    # Mirrors StealthCopilotApp's render loop without Tk: woken by the queue
+    # listener, waits one RENDER_FRAME_MS frame, then drains everything with the
+    # same stale-generation filter and fence parsing, stamping render times
+    # instead of drawing.
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.wake = threading.Event()
+        self.parser = sc.CodeFenceParser()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        sc.answer_queue.set_listener(self.wake.set)
+        self.thread.start()
+        return self
+
+    def drain(self):
+        messages = sc.answer_queue.drain()
+        now = time.perf_counter()
+        for msg in messages:
+            if "gen" in msg and msg["gen"] != sc.stream_manager.current_generation:
+                continue
+            if msg["type"] == "new_turn":
+                self.parser.reset()
+            elif msg["type"] == "text":
+                self.parser.feed(msg["content"])
+                with probe.lock:
+                    probe.first_render.setdefault(msg["gen"], now)
+                    probe.last_render[msg["gen"]] = now
+                sc.turn_tracer.rendered([msg["gen"]], now)
+        return bool(messages)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.wake.wait(sc.RENDER_IDLE_POLL_MS / 1000.0):
+                continue
+            time.sleep(sc.RENDER_FRAME_MS / 1000.0)
+            self.wake.clear()
+            self.drain()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        while self.drain():
+            pass
+        sc.answer_queue.set_listener(None)
+
+# ========================
+# Replay
+# ========================
+
+def replay_turns(turns, speed, deliver=None):
+    start = time.perf_counter()
+    for msg in turns:
+        due = start + msg.get("t_ms", 0) / 1000.0 / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        data = json.dumps({k: v for k, v in msg.items() if k != "t_ms"})
+        if deliver:
+            deliver(data)
+        else:
+            sc.on_message(None, data)
+
+def wait_for_streams(timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        manager = sc.stream_manager
+        if not manager._is_running(manager.current_thread) and sc.answer_queue.empty():
+            return
+        time.sleep(0.01)
+
+def run_async_engine(turns, pcm, args, llm_url, stt_url):
+    source = PcmReplaySource(pcm, args.speed) if stt_url else None
+    pipeline = ProbedAsyncPipeline(audio_source=source, stt_url=stt_url or sc.STT_URL, use_stt=bool(stt_url))
+    pipeline.llm_url = llm_url
+    pipeline.start()
+    try:
+        if stt_url:
+            while source.offset < len(pcm):
+                time.sleep(0.05)
+            time.sleep((args.stt_delay_ms / 1000.0 + 0.2) / args.speed)
+        else:
+            replay_turns(turns, args.speed, deliver=lambda data: pipeline.call_soon(sc.on_message, None, data))
+        wait_for_streams()
+    finally:
+        pipeline.stop()
+
+def run_once(turns, pcm, args, llm_url, stt_url):
+    global probe
+    probe = LatencyProbe()
+    sc.client = sc.build_openai_client(api_key="replay", base_url=llm_url, max_retries=0)
+    for values in sc.connection_warmer.ttft.values():
+        values.clear()
+    sc.prompt_builder = sc.PromptBuilder()
+    sc.conversation_memory = sc.ConversationMemory()
+    sc.answer_cache = sc.AnswerCache()
+    sc.endpointer = sc.EndpointController()
+    sc.turn_assembler = sc.TurnAssembler()
+    sc.turn_tracker = sc.TurnTracker()
+    sc.answer_queue = ProbedQueue()
+    sc.stream_manager = ProbedStreamManager()
+    sc.on_message = probed_on_message
+    sc.connection_warmer.warm()
+    renderer = HeadlessRenderer().start()
+    try:
+        if args.engine == "asyncio":
+            run_async_engine(turns, pcm, args, llm_url, stt_url)
+        elif stt_url:
+            source = PcmReplaySource(pcm, args.speed)
+            sc.websocket_stream(audio_source=source, stt_url=stt_url)
+            time.sleep((args.stt_delay_ms / 1000.0 + 0.2) / args.speed)
+            if sc.ws:
+                sc.ws.close()
+        else:
+            replay_turns(turns, args.speed)
+        wait_for_streams()
+    finally:
+        renderer.stop()
+        sc.on_message = original_on_message
+
+    samples = {"first_token": [], "first_render": [], "last_render": []}
+    for gen in sorted(probe.completed):
+        eot = probe.end_of_turn.get(gen)
+        if eot is None or gen not in probe.last_render:
+            continue
+        samples["first_token"].append((probe.first_token[gen] - eot) * 1000.0)
+        samples["first_render"].append((probe.first_render[gen] - eot) * 1000.0)
+        samples["last_render"].append((probe.last_render[gen] - eot) * 1000.0)
+    samples["started"] = probe.started
+    samples["completed"] = len(samples["last_render"])
+    samples["input_tokens"] = sc.prompt_builder.cache_stats["input_tokens"]
+    samples["cached_tokens"] = sc.prompt_builder.cache_stats["cached_tokens"]
+    samples["cache_hits"] = probe.cache_hits
+    samples["stt_reconnects"] = sc.stt_supervisor.stats["reconnects"]
+    samples["stt_downtime_ms"] = sc.stt_supervisor.stats["downtime_ms"]
+    samples["false_starts"] = sc.endpointer.stats["false_starts"]
+    samples["wasted"] = collections.Counter(sc.stream_manager.wasted)
+    samples["merged"] = sc.turn_assembler.stats["merged"]
+    for kind, values in sc.connection_warmer.ttft.items():
+        samples[f"ttft_{kind}"] = list(values)
+    return samples
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(values):
+    return {
+        "n": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None,
+    }
+
+METRICS = [
+    ("first_token", "end-of-turn -> first token"),
+    ("first_render", "end-of-turn -> first token rendered"),
+    ("last_render", "end-of-turn -> last token rendered"),
+    ("ttft_warm", "request -> first token, warm connection"),
+    ("ttft_cold", "request -> first token, cold connection"),
+    ("endpoint_delay", "last word -> STT end-of-turn (audio)"),
+]
+
+def print_report(report):
+    print(f"\nRuns: {report['runs']}  generations started: {report['started']}  completed: {report['completed']}")
+    print(f"Input tokens: {report['input_tokens']}  cached: {report['cached_tokens']}")
+    if report["turn_kinds"]:
+        kinds = report["turn_kinds"]
+        print(f"Turns: {kinds.get('question', 0)} questions  {kinds.get('follow-up', 0)} follow-ups  "
+              f"{kinds.get('noise', 0)} ignored as noise")
+    wasted = {reason: count for reason, count in report["wasted"].items() if reason != "continued"}
+    detail = ", ".join(f"{count} {reason}" for reason, count in sorted(wasted.items()))
+    per_answer = f"  {report['wasted_per_answer']:.2f} per answer" if report["wasted_per_answer"] is not None else ""
+    budget = f" (budget {report['wasted_budget']:g})" if report["wasted_budget"] is not None else ""
+    print(f"Wasted generations: {sum(wasted.values())}{f' ({detail})' if detail else ''}{per_answer}{budget}  "
+          f"fragments merged: {report['merged']}  continued mid-answer: {report['wasted'].get('continued', 0)}")
+    if report["cache_hits"]:
+        print(f"Answer cache hits: {report['cache_hits']}")
+    if report["models"]:
+        print(f"Models: {report['models']}")
+    if report["endpoint_delay"]["n"]:
+        print(f"Turns ended early (ForceEndpoint): {report['forced_endpoints']}  false starts: {report['false_starts']}")
+    if report["stt_reconnects"]:
+        print(f"STT reconnects: {report['stt_reconnects']}  downtime: {report['stt_downtime_ms']} ms")
+    print(f"{'metric':<38}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+    for key, label in METRICS:
+        stats = report[key]
+        cells = "".join(f"{stats[c]:>10.1f}" if stats[c] is not None else f"{'-':>10}" for c in ("p50", "p95", "p99", "mean"))
+        print(f"{label:<38}{stats['n']:>6}{cells}")
+
+# ========================
+# Capture Benchmark
+# ========================
+
+CAPTURE_FORMATS = [(16000, 1), (44100, 1), (44100, 2), (48000, 1), (48000, 2)]
+
+def tone(rate, channels, seconds, freq, amplitude=8000.0):
+    t = np.arange(int(rate * seconds)) / rate
+    mono = amplitude * np.sin(2 * np.pi * freq * t)
+    return np.repeat(mono[:, None], channels, axis=1).astype(np.int16)
+
+def tone_error_db(out, freq, skip):
+    # Residual after a least-squares fit of the expected tone, relative to the tone.
+    y = out[skip:].astype(np.float64)
+    t = np.arange(len(y)) / sc.RATE
+    basis = np.stack([np.sin(2 * np.pi * freq * t), np.cos(2 * np.pi * freq * t)], axis=1)
+    fit = basis @ np.linalg.lstsq(basis, y, rcond=None)[0]
+    return 10 * np.log10(np.mean((y - fit) ** 2) / np.mean(fit ** 2))
+
+def time_blocks(feed, blocks, rounds=3):
+    # Per-block cost (us) of feed(block), plus the peak bytes allocated by one
+    # pass beyond what the same loop allocates around a no-op feed.
+    import tracemalloc
+    for block in blocks[:20]:
+        feed(block)
+    costs = []
+    for _ in range(rounds):
+        for block in blocks:
+            t0 = time.perf_counter()
+            feed(block)
+            costs.append((time.perf_counter() - t0) * 1e6)
+    peaks = []
+    for fn in (lambda block: None, feed):
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for block in blocks:
+            fn(block)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+    return costs, max(0, peaks[1] - peaks[0])
+
+def bench_capture(args):
+    # Per-block cost of the capture path (downmix + resample, and the
+    # multi-source mix) on synthetic blocks; no audio device is opened.
+    rows = []
+    for rate, channels in CAPTURE_FORMATS:
+        resampler = sc.PolyphaseResampler(rate, sc.RATE, channels)
+        signal = tone(rate, channels, 4.0, 1000.0)
+        step = resampler.block_frames
+        blocks = [signal[i:i + step].tobytes() for i in range(0, len(signal) - step + 1, step)]
+        costs, peak = time_blocks(resampler.process, blocks)
+        outputs = []
+        for block in blocks:
+            outputs.append(resampler.process(block).copy())
+        error_db = tone_error_db(np.concatenate(outputs), 1000.0, skip=sc.RATE // 10)
+        alias = sc.PolyphaseResampler(rate, sc.RATE, channels)
+        high = tone(rate, channels, 1.0, 11000.0) if rate > 22000 else None
+        rejection_db = None
+        if high is not None:
+            out = np.concatenate([alias.process(high[i:i + step].tobytes()).copy()
+                                  for i in range(0, len(high) - step + 1, step)])[sc.RATE // 10:]
+            rejection_db = 20 * np.log10(max(np.sqrt(np.mean(out.astype(np.float64) ** 2)), 1e-9) / (8000 / np.sqrt(2)))
+        rows.append({"case": f"{rate} Hz x{channels}", "block_ms": 1000 * step / rate, "taps": resampler.taps,
+                     "p50_us": percentile(costs, 50), "p99_us": percentile(costs, 99), "alloc_bytes": peak,
+                     "tone_error_db": error_db, "alias_db": rejection_db})
+
+    configured_mode = sc.AUDIO_SOURCE_MODE
+    for mode in ("mix", "tag"):
+        sc.AUDIO_SOURCE_MODE = mode
+        capture = sc.AudioCapture()
+        lead = capture.add_source(sc.CaptureSource(capture, "lead", 48000, 2))
+        other = capture.add_source(sc.CaptureSource(capture, "other", 44100, 1))
+        lead_signal = tone(48000, 2, 4.0, 1000.0)
+        other_signal = tone(44100, 1, 4.0, 300.0)
+        lead_step, other_step = lead.resampler.block_frames, other.resampler.block_frames
+        count = min(len(lead_signal) // lead_step, len(other_signal) // other_step)
+        blocks = [(lead_signal[i * lead_step:(i + 1) * lead_step].tobytes(),
+                   other_signal[i * other_step:(i + 1) * other_step].tobytes()) for i in range(count)]
+
+        def feed(block):
+            other.feed(block[1])
+            lead.feed(block[0])
+            with capture.cond:
+                # Stand-in for the sender draining the ring.
+                capture.read_pos, capture.size = (capture.read_pos + capture.size) % len(capture.ring), 0
+
+        costs, peak = time_blocks(feed, blocks)
+        rows.append({"case": f"{mode}: 48000x2 + 44100x1", "block_ms": 1000 * lead_step / 48000, "taps": None,
+                     "p50_us": percentile(costs, 50), "p99_us": percentile(costs, 99), "alloc_bytes": peak,
+                     "tone_error_db": None, "alias_db": None})
+    sc.AUDIO_SOURCE_MODE = configured_mode
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return 0
+    print(f"{'case':<28}{'block':>7}{'taps':>6}{'p50 us':>9}{'p99 us':>9}{'x realtime':>12}"
+          f"{'alloc B':>9}{'tone err dB':>13}{'alias dB':>10}")
+    for row in rows:
+        cells = [f"{row['block_ms']:>5.0f}ms", f"{row['taps'] or '-':>6}", f"{row['p50_us']:>9.1f}",
+                 f"{row['p99_us']:>9.1f}", f"{row['block_ms'] * 1000 / row['p50_us']:>12.0f}", f"{row['alloc_bytes']:>9}"]
+        cells += [f"{row[key]:>{width}.1f}" if row[key] is not None else f"{'-':>{width}}"
+                  for key, width in (("tone_error_db", 13), ("alias_db", 10))]
+        print(f"{row['case']:<28}" + "".join(cells))
+    return 0
+
+# ========================
+# Load Test
+# ========================
+
+def question_ends(turns, speed, start):
+    # Wall-clock time each scripted question ends (its last word), for clients streaming audio.
+    ends, seen = [], set()
+    for msg in turns:
+        if msg.get("end_of_turn") and msg.get("turn_order") not in seen:
+            seen.add(msg.get("turn_order"))
+            words = msg.get("words") or []
+            end_ms = words[-1]["end"] if words else msg.get("t_ms", 0)
+            ends.append(start + end_ms / 1000.0 / speed)
+    return ends
+
+async def load_client(url, turns, pcm, speed, offset_s, level):
+    # One simulated session. Latency runs from the end of the question (the
+    # first end_of_turn message sent, or the last word's audio sent) to the
+    # first token of each answer that reaches the client.
+    import asyncio
+    import bisect
+    import websockets
+    await asyncio.sleep(offset_s)
+    ends = []
+    async with websockets.connect(url, max_size=None) as conn:
+        json.loads(await conn.recv())  # {"type": "session", "id": ...}
+        last_message = [time.perf_counter()]
+
+        async def receive():
+            seen = set()
+            async for message in conn:
+                now = time.perf_counter()
+                last_message[0] = now
+                msg = json.loads(message)
+                if msg.get("type") == "error":
+                    level["errors"] += 1
+                elif msg.get("type") == "text" and msg.get("gen") not in seen:
+                    seen.add(msg.get("gen"))
+                    i = bisect.bisect_right(ends, now)
+                    if i:
+                        level["first_token"].append((now - ends[i - 1]) * 1000.0)
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.perf_counter()
+        if pcm is None:
+            ended = set()
+            for msg in turns:
+                delay = start + msg.get("t_ms", 0) / 1000.0 / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if msg.get("end_of_turn") and msg.get("turn_order") not in ended:
+                    ended.add(msg.get("turn_order"))
+                    ends.append(time.perf_counter())
+                await conn.send(json.dumps({k: v for k, v in msg.items() if k != "t_ms"}))
+        else:
+            ends.extend(question_ends(turns, speed, start))
+            packet = sc.AUDIO_PACKET_MS * BYTES_PER_MS
+            for offset in range(0, len(pcm), packet):
+                delay = start + offset / BYTES_PER_MS / 1000.0 / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await conn.send(pcm[offset:offset + packet])
+        # Done once the answers have gone quiet.
+        quiet_since = time.perf_counter()
+        while time.perf_counter() - max(last_message[0], quiet_since) < 1.5 and time.perf_counter() - quiet_since < 15:
+            await asyncio.sleep(0.1)
+        receiver.cancel()
+
+def run_load_level(server, url, turns, pcm, speed, sessions):
+    import asyncio
+    import contextlib
+    import io
+    level = {"sessions": sessions, "first_token": [], "errors": 0}
+    server.stats["max_loop_lag_ms"] = 0.0
+    rng = random.Random(sessions)
+    log = io.StringIO()
+    cpu, wall = time.process_time(), time.perf_counter()
+
+    async def run_clients():
+        clients = [load_client(url, turns, pcm, speed, rng.uniform(0, 1.0), level) for _ in range(sessions)]
+        results = await asyncio.gather(*clients, return_exceptions=True)
+        level["failed_clients"] = sum(isinstance(r, Exception) for r in results)
+
+    # Server and session output goes to a buffer; its [ERROR] lines are counted.
+    with contextlib.redirect_stdout(log):
+        asyncio.run(run_clients())
+        deadline = time.perf_counter() + 5
+        while server.sessions and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)  # closing sessions print their STT reports
+    level["cpu_pct"] = 100.0 * (time.process_time() - cpu) / (time.perf_counter() - wall)
+    level["loop_lag_ms"] = server.stats["max_loop_lag_ms"]
+    level["errors"] += log.getvalue().count("[ERROR]") + level["failed_clients"]
+    level["answers"] = len(level["first_token"])
+    level["p50"] = percentile(level["first_token"], 50)
+    level["p95"] = percentile(level["first_token"], 95)
+    return level
+
+def run_load_test(turns, pcm, args, llm, stt):
+    # Ramps up concurrent sessions against one HeadlessServer (the stand-ins
+    # run in this process too, so the numbers are conservative). A level is
+    # sustained while its p95 stays within the limit, every session got all
+    # its answers and nothing failed.
+    async_client = sc.build_async_openai_client(api_key="replay", base_url=llm.base_url, max_retries=0)
+    sc.client = sc.build_openai_client(api_key="replay", base_url=llm.base_url, max_retries=0)
+    levels = [int(n) for n in args.sessions.split(",")]
+    server = sc.HeadlessServer(port=0, stt_url=stt.url if stt else sc.STT_URL, async_client=async_client,
+                               max_sessions=max(levels)).start()
+    url = f"ws://127.0.0.1:{server.port}/sessions"
+    results = []
+    limit = args.max_p95_first_token_ms
+    try:
+        for sessions in levels:
+            level = run_load_level(server, url, turns, pcm if stt else None, args.speed, sessions)
+            if limit is None:
+                limit = 1.5 * (level["p95"] or 0) + 100.0
+            per_session = results[0]["answers"] if results else level["answers"]
+            level["sustained"] = (level["p95"] is not None and level["p95"] <= limit and level["errors"] == 0
+                                  and level["answers"] >= per_session * sessions)
+            results.append(level)
+            if not args.json:
+                print(f"{sessions:>8}{level['answers']:>9}{level['p50'] or 0:>10.0f}{level['p95'] or 0:>10.0f}"
+                      f"{level['errors']:>8}{level['loop_lag_ms']:>14.0f}{level['cpu_pct']:>8.0f}"
+                      f"{'  ok' if level['sustained'] else '  over'}")
+            if not level["sustained"]:
+                break
+    finally:
+        server.stop()
+    sustained = max([level["sessions"] for level in results if level["sustained"]], default=0)
+    if args.json:
+        print(json.dumps({"limit_p95_ms": limit, "sustained_sessions": sustained,
+                          "levels": [{k: v for k, v in level.items() if k != "first_token"} for level in results]},
+                         indent=2))
+    else:
+        print(f"Sustained: {sustained} concurrent sessions (p95 end of question -> first token <= {limit:.0f} ms, "
+              f"all answers, no errors)")
+    return 0 if sustained else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded session offline and report answer latency.")
+    parser.add_argument("scenario", nargs="?", help="recorded session folder or turns.jsonl file")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier for audio/transcript timing")
+    parser.add_argument("--through-stt", action="store_true",
+                        help="stream PCM through websocket_stream and a local STT stand-in instead of calling on_message directly")
+    parser.add_argument("--stt-delay-ms", type=float, default=150.0, help="STT stand-in message latency")
+    parser.add_argument("--stt-drop-at-ms", type=float, help="STT stand-in drops the connection once at this point of the script")
+    parser.add_argument("--stt-outage-ms", type=float, default=2000.0, help="how long the STT stand-in refuses reconnects after a drop")
+    parser.add_argument("--llm-ttft-ms", type=float, default=300.0, help="LLM stand-in time to first token")
+    parser.add_argument("--llm-token-ms", type=float, default=15.0, help="LLM stand-in gap between tokens")
+    parser.add_argument("--llm-connect-ms", type=float, default=0.0,
+                        help="LLM stand-in setup cost per new connection (DNS/TLS)")
+    parser.add_argument("--no-llm-warm", action="store_true", help="disable LLM_WARM_MODE for comparison")
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0,
+                        help="share of LLM stand-in streams whose first token is delayed by --llm-stall-ms")
+    parser.add_argument("--llm-stall-ms", type=float, default=3000.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of LLM stand-in streams that fail with 503")
+    parser.add_argument("--no-hedge", action="store_true", help="disable HEDGE_MODE for comparison")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default=sc.PIPELINE_ENGINE,
+                        help="pipeline engine to replay through")
+    parser.add_argument("--no-speculative", action="store_true", help="disable SPECULATIVE_MODE for comparison")
+    parser.add_argument("--no-endpointing", action="store_true", help="disable ENDPOINT_MODE for comparison")
+    parser.add_argument("--no-turn-merge", action="store_true", help="disable TURN_MERGE_MODE for comparison")
+    parser.add_argument("--no-turn-filter", action="store_true", help="disable TURN_FILTER_MODE (back to the length check)")
+    parser.add_argument("--noise-threshold", type=float, default=sc.TURN_NOISE_THRESHOLD,
+                        help="TURN_NOISE_THRESHOLD to replay with")
+    parser.add_argument("--turn-log", help="write the classifier's per-turn decisions (JSONL) to this file")
+    parser.add_argument("--trace-out", help="also write the app's per-turn traces (JSONL) to this file")
+    parser.add_argument("--check-transcripts", action="store_true",
+                        help="only check the question text built from the STT messages (scenario or folder of scenarios)")
+    parser.add_argument("--load-test", action="store_true",
+                        help="ramp up concurrent sessions against the headless server and report how many it sustains")
+    parser.add_argument("--sessions", default="1,2,4,8,16,32,64", help="load test: concurrent sessions per level")
+    parser.add_argument("--bench-capture", action="store_true",
+                        help="only measure the per-block cost of audio capture resampling and mixing")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-p95-first-token-ms", type=float,
+                        help="exit non-zero if p95 first token exceeds this (load test: the per-level limit, "
+                             "default 1.5x the single-session p95 + 100 ms)")
+    parser.add_argument("--max-p95-last-render-ms", type=float, help="exit non-zero if p95 last render exceeds this")
+    parser.add_argument("--max-wasted-per-answer", type=float, default=1.0,
+                        help="exit non-zero if more generations per answer were thrown away (speculative, "
+                             "restarted); the OpenAI calls beyond one per answer")
+    args = parser.parse_args(argv)
+    if args.bench_capture:
+        return bench_capture(args)
+    if args.scenario is None:
+        parser.error("a scenario is required")
+    if args.check_transcripts:
+        return check_transcripts(args.scenario)
+
+    turns, pcm = load_scenario(args.scenario)
+    if args.no_speculative:
+        sc.SPECULATIVE_MODE = False
+    if args.no_llm_warm:
+        sc.LLM_WARM_MODE = False
+    if args.no_endpointing:
+        sc.ENDPOINT_MODE = False
+    if args.no_hedge:
+        sc.HEDGE_MODE = False
+    if args.no_turn_filter:
+        sc.TURN_FILTER_MODE = False
+    if args.no_turn_merge:
+        sc.TURN_MERGE_MODE = False
+    sc.turn_classifier = sc.TurnClassifier(path=args.turn_log, threshold=args.noise_threshold)
+    llm = FakeResponsesServer(ttft_ms=args.llm_ttft_ms, token_ms=args.llm_token_ms,
+                              connect_ms=args.llm_connect_ms, stall_rate=args.llm_stall_rate,
+                              stall_ms=args.llm_stall_ms, error_rate=args.llm_error_rate).start()
+    sc.connection_warmer.start()
+    sc.turn_tracer = sc.TurnTracer(path=args.trace_out).start()
+    stt = None
+    if args.through_stt:
+        if pcm is None:
+            pcm = synthesize_pcm(turns)
+        stt = FakeSTTServer(turns, stt_delay_ms=args.stt_delay_ms, speed=args.speed,
+                            drop_at_ms=args.stt_drop_at_ms, outage_ms=args.stt_outage_ms).start()
+
+    if args.load_test:
+        if not args.json:
+            print(f"{'sessions':>8}{'answers':>9}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'loop lag ms':>14}{'cpu %':>8}")
+        try:
+            return run_load_test(turns, pcm, args, llm, stt)
+        finally:
+            llm.stop()
+            if stt:
+                stt.stop()
+
+    collected = {"first_token": [], "first_render": [], "last_render": [], "started": 0, "completed": 0,
+                 "input_tokens": 0, "cached_tokens": 0, "stt_reconnects": 0, "stt_downtime_ms": 0, "cache_hits": 0,
+                 "ttft_warm": [], "ttft_cold": [], "false_starts": 0, "wasted": collections.Counter(), "merged": 0}
+    collected.update(endpoint_delay=[], forced_endpoints=0)
+    try:
+        for _ in range(args.runs):
+            if stt:
+                stt.reset()
+            samples = run_once(turns, pcm, args, llm.base_url, stt.url if stt else None)
+            for key in samples:
+                if key in collected:
+                    collected[key] += samples[key]
+            if stt:
+                collected["endpoint_delay"] += stt.endpoint_delays
+                collected["forced_endpoints"] += stt.forced_endpoints
+    finally:
+        llm.stop()
+        if stt:
+            stt.stop()
+
+    report = {key: collected[key] for key in ("started", "completed", "input_tokens", "cached_tokens",
+                                              "stt_reconnects", "stt_downtime_ms", "cache_hits",
+                                              "forced_endpoints", "false_starts", "merged")}
+    report["wasted"] = dict(collected["wasted"])
+    report["runs"] = args.runs
+    report["models"] = sc.model_stats.summary_text().replace("\n", "; ")
+    report["turn_kinds"] = dict(sc.turn_classifier.counts)
+    # Per question answered, whether or not its answer was left to finish.
+    wasted = sum(count for reason, count in report["wasted"].items() if reason != "continued")
+    answered = report["turn_kinds"].get("question", 0) + report["turn_kinds"].get("follow-up", 0) or report["completed"]
+    report["wasted_per_answer"] = wasted / answered if answered else None
+    report["wasted_budget"] = args.max_wasted_per_answer
+    for key, _ in METRICS:
+        report[key] = summarize(collected[key])
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    failed = False
+    if args.max_p95_first_token_ms is not None and (report["first_token"]["p95"] or 0) > args.max_p95_first_token_ms:
+        print(f"[FAIL] p95 first token {report['first_token']['p95']:.1f} ms > {args.max_p95_first_token_ms} ms")
+        failed = True
+    if args.max_p95_last_render_ms is not None and (report["last_render"]["p95"] or 0) > args.max_p95_last_render_ms:
+        print(f"[FAIL] p95 last render {report['last_render']['p95']:.1f} ms > {args.max_p95_last_render_ms} ms")
+        failed = True
+    if report["completed"] == 0:
+        print("[FAIL] No answers completed during replay.")
+        failed = True
+    if (args.max_wasted_per_answer is not None and report["wasted_per_answer"] is not None
+            and report["wasted_per_answer"] > args.max_wasted_per_answer):
+        print(f"[FAIL] {report['wasted_per_answer']:.2f} wasted generations per answer > {args.max_wasted_per_answer:g}")
+        failed = True
+    if args.no_llm_warm and report["ttft_cold"]["n"] == 0:
+        # Without pre-connecting the first request must open a connection; none
+        # counted means the request generation didn't reach the connection trace.
+        print("[FAIL] No cold-connection first tokens measured with --no-llm-warm.")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
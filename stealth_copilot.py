@@ -1,362 +1,4366 @@
 import threading
 import queue
 import time
-import tkinter as tk
-import customtkinter as ctk
-from tkinter import filedialog
-from pynput import keyboard
-import pyaudio
+STARTUP_T0 = time.perf_counter()  # Launch reference for the startup-time breakdown
+import asyncio
+import collections
 import websocket
 import json
-import requests
 import sys
 import ctypes
 import os
-import PyPDF2
-from docx import Document
-from openai import OpenAI
-from tkinter import simpledialog
+import re
+import difflib
+import random
+import math
+import zlib
+import hashlib
+import itertools
+import sqlite3
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+import numpy as np
+# PyPDF2, python-docx, openai, pynput and pyaudio are imported where they are first used,
+# and tkinter / customtkinter by create_app(), so --serve and the replay harness never load them.
+
+# ========================
+# Startup
+# ========================
+
+class StartupProfile:
+    # Launch-to-listening timeline. mark() stamps when a step finished; measure()
+    # and record() keep a step's start and end, for steps that overlap. The
+    # breakdown is printed once, when audio first reaches an open STT session.
+    def __init__(self, t0):
+        self.t0 = t0
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.done = False
+
+    def record(self, name, start, end=None):
+        with self.lock:
+            self.steps.setdefault(name, (start, end if end is not None else time.perf_counter()))
+
+    def mark(self, name):
+        self.record(name, None)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def finish(self):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+            listening = time.perf_counter()
+            parts = []
+            for name, (start, end) in sorted(self.steps.items(), key=lambda item: item[1][1]):
+                if start is None:
+                    parts.append(f"{name} @{(end - self.t0) * 1000:.0f}")
+                else:
+                    parts.append(f"{name} {(start - self.t0) * 1000:.0f}-{(end - self.t0) * 1000:.0f}")
+            self.steps["listening"] = (None, listening)
+        print(f"[INFO] Listening {(listening - self.t0) * 1000:.0f} ms after launch ({', '.join(parts)} ms)")
+
+startup = StartupProfile(STARTUP_T0)
+
+class DeferredClient:
+    # Stands in for the OpenAI client while the openai package (a large share of
+    # import time) is loaded and the client built on a background thread.
+    # Attribute access waits for it, or builds it on the spot if start() was
+    # never called.
+    def __init__(self, factory, name):
+        self._factory = factory
+        self._name = name
+        self._lock = threading.Lock()
+        self._client = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._get, daemon=True)
+            self._thread.start()
+        return self
+
+    def _get(self):
+        with self._lock:
+            if self._client is None:
+                with startup.measure(self._name):
+                    self._client = self._factory()
+            return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
 
 # ========================
 # Configuration & Constants
 # ========================
 
-import config
-OPENAI_API_KEY = config.OPENAI_API_KEY
-ASSEMBLYAI_API_KEY = config.ASSEMBLYAI_API_KEY
+import config
+OPENAI_API_KEY = config.OPENAI_API_KEY
+ASSEMBLYAI_API_KEY = config.ASSEMBLYAI_API_KEY
+
+AI_MODEL = "gpt-4o-mini"  # Faster, lower-latency model
+HOTKEY = '<ctrl>+<alt>+h'
+HOTKEY_UPLOAD = '<ctrl>+<alt>+u'
+HOTKEY_COMPANY = '<ctrl>+<alt>+c'
+HOTKEY_STAGE = '<ctrl>+<alt>+s'
+HOTKEY_DEBUG = '<ctrl>+<alt>+d'  # Show/hide the latency debug panel
+DEBUG_MODE = False  # Set to True for verbose logging
+CLEAR_ON_NEW_TURN = False  # Keep history so you can scroll
+MAX_HISTORY_LINES = 1000  # Trim history to last N lines for performance
+STEALTH_HELP_TIMEOUT_MS = 7000  # Hide helper text after a few seconds
+INGEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".stealth_copilot", "extract_cache")  # Extracted text by file hash; None disables
+INGEST_PROCESSES = max(1, min(4, (os.cpu_count() or 2) - 1))  # Worker processes for large PDFs
+INGEST_PARALLEL_MIN_PAGES = 12  # Smaller PDFs are read in the ingest thread
+SESSION_DB_PATH = os.path.join(os.path.expanduser("~"), ".stealth_copilot", "sessions.db")  # None disables saving
+SESSION_RESUME_HOURS = 6  # Reopen the last session (history included) if it was active this recently
+SESSION_FLUSH_MS = 500  # Session changes are written in one batch per interval
+RENDER_FRAME_MS = 16  # Answer tokens arriving within one frame are drawn with a single insert
+RENDER_IDLE_POLL_MS = 1000  # Safety check of answer_queue in case a wake-up was missed
+TRIM_CHECK_LINES = 100  # New lines drawn before the history length is checked and trimmed
+TRACE_PATH = os.path.join(os.path.expanduser("~"), ".stealth_copilot", "traces.jsonl")  # Per-turn timing traces; None disables the file
+TRACE_WINDOW = 200  # Recent turns behind the rolling percentiles
+METRICS_PORT = None  # Set to a port (e.g. 9464) to serve the rolling metrics on 127.0.0.1
+SESSION_RECORD_DIR = None  # Set to a folder to record audio + STT messages for replay_harness.py
+PIPELINE_ENGINE = "threads"  # "threads" or "asyncio" (one event loop for audio, STT and OpenAI)
+SPECULATIVE_MODE = True  # Start answering from interim text once it looks like a finished question
+SPECULATIVE_MIN_WORDS = 4  # Shortest interim transcript worth speculating on
+SPECULATIVE_MATCH_THRESHOLD = 0.9  # Word-level similarity needed to keep a speculative answer
+SPECULATIVE_MAX_PER_TURN = 4  # Cap on speculative restarts while one question is still being spoken
+SPECULATIVE_STABLE_MS = 250  # Interim text must stay unchanged this long before it is speculated on...
+SPECULATIVE_STABLE_FACTOR = 1.5  # ...and at least this many times the speaker's usual gap between interim words
+ANSWER_CACHE_MODE = True  # Answer repeated questions from memory instead of calling OpenAI again
+ANSWER_CACHE_SIZE = 64  # Cached answers kept (least recently used are evicted)
+ANSWER_CACHE_THRESHOLD = 0.7  # Estimated n-gram similarity needed for a fuzzy hit
+ANSWER_CACHE_REFRESH = False  # After a hit, regenerate that answer in the background for next time
+PREWARM_MODE = True  # Pre-generate answers to likely questions whenever the context changes
+PREWARM_QUESTIONS = 12  # Questions derived from the uploaded context (plus a few common ones)
+PREWARM_CONCURRENCY = 3  # Parallel prewarm requests (for all sessions together in server mode)
+PREWARM_REQUESTS_PER_MIN = 30  # Rate limit for prewarm requests
+PREWARM_DEBOUNCE_MS = 1500  # Wait for edits to settle before prewarming
+PREWARM_PRICE_PER_1M = (0.15, 0.60)  # USD per 1M input/output tokens for AI_MODEL, for the cost estimate
+
+LLM_WARM_MODE = True  # Keep a pooled connection to OpenAI open so questions skip DNS/TLS setup
+LLM_KEEPALIVE_S = 20  # After this long without OpenAI traffic, a lightweight request keeps the connection open
+LLM_POOL_IDLE_S = 120  # Idle pooled connections are kept this long (httpx closes them after 5 s by default)
+HEDGE_MODE = True  # Send a backup request when the first token is late; whichever streams first is shown
+HEDGE_BACKUP_MODEL = "gpt-4.1-mini"  # Model for backup requests (retries reuse the failed request's model); None reuses AI_MODEL
+HEDGE_DEADLINE_MS = 1500  # Hedge deadline until a model has enough latency samples
+HEDGE_DEADLINE_RANGE_MS = (600, 4000)  # Bounds for the learned deadline (the model's recent p95 time to first token)
+LLM_MAX_RETRIES = 2  # Retries after transient errors (timeouts, 429, 5xx) before showing [AI Error]
+LLM_RETRY_BASE_MS = 300  # Retry backoff base; each delay is random up to base * 2^retry
+LLM_MAX_CONNECTIONS = 100  # Pooled OpenAI connections, shared by every answer (and every session in server mode)
+BACKGROUND_WORKERS = 4  # Shared threads for history summaries
+SERVER_PORT = 8765  # python stealth_copilot.py --serve: headless websocket API on 127.0.0.1
+SERVER_MAX_SESSIONS = 64  # Further clients are turned away with 503
+
+llm_request_gen = contextvars.ContextVar("llm_request_gen", default=None)  # Answer generation a request belongs to
+current_session = contextvars.ContextVar("current_session", default=None)  # Server mode: the HeadlessSession being served
+
+def trace_connection(name, info):
+    # httpcore trace hook: an answer whose request had to open a new connection is a cold one.
+    if name == "connection.connect_tcp.started":
+        connection_warmer.connecting(llm_request_gen.get())
+
+async def trace_connection_async(name, info):
+    trace_connection(name, info)
+
+def openai_http_options(use_async=False):
+    # Pool settings for the OpenAI clients; HTTP/2 is used when the h2 package is installed.
+    def add_trace(request):
+        request.extensions["trace"] = trace_connection_async if use_async else trace_connection
+
+    async def add_trace_async(request):
+        add_trace(request)
+
+    options = {"event_hooks": {"request": [add_trace_async if use_async else add_trace]}}
+    if LLM_WARM_MODE:
+        import importlib.util
+        import openai
+        # Limits of whichever HTTP client this openai build uses, so httpx is never imported directly.
+        limits_type = type(openai.DEFAULT_CONNECTION_LIMITS)
+        options["limits"] = limits_type(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=20,
+                                        keepalive_expiry=LLM_POOL_IDLE_S)
+        options["http2"] = importlib.util.find_spec("h2") is not None
+    return options
+
+def build_openai_client(**options):
+    from openai import OpenAI, DefaultHttpxClient
+    options.setdefault("api_key", OPENAI_API_KEY)
+    return OpenAI(http_client=DefaultHttpxClient(**openai_http_options()), **options)
+
+def build_async_openai_client(**options):
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    options.setdefault("api_key", OPENAI_API_KEY)
+    return AsyncOpenAI(http_client=DefaultAsyncHttpxClient(**openai_http_options(use_async=True)), **options)
+
+# Initialize OpenAI Client (built in the background at launch)
+client = DeferredClient(build_openai_client, "llm client")
+
+# Audio Constants
+CHUNK = 1024
+CHANNELS = 1
+RATE = 16000
+AUDIO_PACKET_MS = 50  # Audio sent to the STT service in packets of this length
+AUDIO_MAX_PACKET_MS = 400  # Largest batch sent at once when the sender has fallen behind
+AUDIO_RING_SECONDS = 10  # Capture ring buffer size; older audio is overwritten beyond this
+AUDIO_SOURCES = []  # Input device names (substring match) captured together, e.g. ["CABLE Output", "Microphone"]; empty: VB-CABLE, else the default input
+AUDIO_SOURCE_MODE = "mix"  # With several sources: "mix" sums them, "tag" keeps the loudest per block and notes which it was
+AUDIO_BLOCK_MS = 20  # Device callback block; rounded so every block resamples to the same length
+AUDIO_MIX_SLACK_MS = 80  # Jitter buffer per extra source; clock drift beyond this drops or pads its audio
+RESAMPLE_TAPS = 24  # Capture resampler FIR length in output samples (longer: sharper cutoff, more work per block)
+STT_URL = "wss://streaming.assemblyai.com/v3/ws"
+STT_RECONNECT_BASE_MS = 500  # First reconnect delay after the STT connection drops
+STT_RECONNECT_MAX_MS = 15000  # Reconnect backoff cap
+STT_STABLE_SECONDS = 10  # A connection that lasted this long resets the backoff
+STT_REPLAY_MAX_SECONDS = 30  # Audio kept while the STT is down (and of an unfinished turn) for replay
+STT_END_OF_TURN_MS = 1600  # STT end-of-turn silence when ENDPOINT_MODE is off
+VAD_MODE = True  # Stop uploading microphone audio during silence
+VAD_FRAME_MS = 10  # Analysis frame for the energy / zero-crossing detector
+VAD_MIN_DBFS = -50  # Frames quieter than this are never speech
+VAD_MARGIN_DB = 9  # Speech must be this far above the tracked noise floor
+VAD_HANGOVER_MS = 3000  # Keep sending at least this long after speech
+VAD_HANGOVER_MARGIN_MS = 1000  # ...and this much longer than the STT's current end-of-turn silence
+VAD_PREROLL_MS = 300  # Audio kept from before a speech onset so it isn't clipped
+VAD_KEEPALIVE_MS = 5000  # While gated, still send one packet this often so the session stays alive
+ENDPOINT_MODE = True  # End turns from local silence + transcript cues, learning the speaker's pauses
+ENDPOINT_MIN_SILENCE_MS = 350  # Shortest silence ever treated as the end of a turn
+ENDPOINT_FALLBACK_MS = (1200, 3000)  # Range for the STT's own end-of-turn silence, adapted to the speaker
+ENDPOINT_PAUSE_WINDOW = 100  # Recent mid-turn pauses behind the speaker's pause distribution
+TURN_FILTER_MODE = True  # Score finished turns locally; noise ("can you hear me", echoed answers) is never sent
+TURN_NOISE_THRESHOLD = 0.6  # Noise probability at or above which a turn is ignored
+TURN_MERGE_MODE = True  # A question that goes on after a pause extends the answer instead of restarting it
+TURN_MERGE_WINDOW_MS = (1500, 5000)  # Range for the learned pause between fragments of one question
+TURN_HOLD_MS = 700  # A turn that ends mid-sentence ("and", trailing comma) waits this long for more speech
+TURN_LOG_PATH = os.path.join(os.path.expanduser("~"), ".stealth_copilot", "turn_decisions.jsonl")  # Classifier decisions for tuning; None disables
+
+# ========================
+# Global State
+# ========================
+
+class AnswerQueue:
+    # Per-generation delivery. Messages from a generation older than the current
+    # one are dropped on put, and starting a generation swaps in an empty buffer,
+    # so stale tokens are never buffered and nothing has to be drained.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.generation = 0
+        self.listener = None  # Called after each accepted put, e.g. to wake the UI
+
+    def set_listener(self, listener):
+        self.listener = listener
+
+    def begin_generation(self, gen):
+        with self.lock:
+            if gen >= self.generation:
+                self.generation = gen
+                self.items = collections.deque()
+
+    def put(self, msg):
+        with self.lock:
+            if msg.get("gen", self.generation) < self.generation:
+                return False
+            self.items.append(msg)
+        if self.listener:
+            self.listener()
+        return True
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.items:
+                raise queue.Empty
+            return self.items.popleft()
+
+    def drain(self):
+        with self.lock:
+            items = self.items
+            self.items = collections.deque()
+        return items
+
+    def empty(self):
+        return not self.items
+
+# Queue now holds dicts: {"type": "text"|"clear"|"error", "content": ...}
+answer_queue = AnswerQueue()
+ws = None
+is_running = True
+CONVERSATION_CONTEXT_MAX_TURNS = 100
+MEMORY_VERBATIM_TURNS = 6  # Most recent Q/A pairs kept word for word in the prompt
+MEMORY_SUMMARY_BATCH = 4  # Older turns are folded into the summary this many at a time
+HISTORY_TOKEN_BUDGET = 1500  # Hard cap for summary + verbatim history in each prompt
+SUMMARY_TOKEN_BUDGET = 300  # Max length of the running summary
+SUMMARY_MODEL = AI_MODEL  # Model used by the background summarizer
+PROMPT_CACHE_KEY = "stealth-copilot"  # Routes requests to the same server-side prompt cache
+RETRIEVAL_MODE = True  # Send only the context chunks relevant to each question
+CONTEXT_TOKEN_BUDGET = 800  # Max context tokens per question (smaller contexts are sent whole)
+RETRIEVAL_TOP_K = 6  # Max chunks considered per question
+RETRIEVAL_CHUNK_CHARS = 600  # Target chunk size when indexing uploaded files
+
+# Context Management
+system_instruction_default = """PERSONA:
+You are answering as a senior professional with 6-7 years of real-world experience.
+
+CONTEXT:
+- You are in a live technical interview.
+- Your answers must sound confident, concise, knowledgeable, and experience-driven.
+- Speak like someone who has worked on real production systems.
+- Avoid textbook explanations and unnecessary theory.
+- Structure responses clearly but naturally, as in a spoken interview.
+- Do NOT over-explain unless asked.
+
+DOMAIN BEHAVIOR:
+- If the question is about DevOps, answer as a DevOps Engineer with 6-7 years of hands-on experience.
+- If the domain is not explicitly stated, infer it from the question and respond as a senior professional in that domain.
+
+COMMANDS & CONFIGS:
+- Include practical commands only when they add value.
+- Keep commands minimal and accurate.
+- Explain briefly why the command is used, not how it works.
+
+DISPLAY RULES (STRICT):
+1. NO labels like 'Question:', 'Direct Answer:', 'Key Details:'. Just output the answer.
+2. UNIFIED RESPONSE: Provide ONE clear, cohesive technical answer.
+3. Style:
+   - Start immediately with the core answer (Yes/No/Action).
+   - If a command is needed, put the command first, then a brief explanation.
+   - Otherwise, follow with 1-2 brief sentences of context.
+   - Do not repeat phrases or restate the question.
+   - Never echo the question.
+   - Do not ask clarifying questions; give the best direct answer.
+   - If the question names a tool or service, address it directly.
+   - Use concrete numbers and examples (e.g., "reduce P99 latency by 20%", "rotate on-call every 5 days").
+   - Include what happens next and end with a short prevention step.
+   - If using an anecdote, keep it to one short line and stop.
+   - Avoid hedging; speak with confidence.
+   - Keep it to 2-4 short lines total.
+4. Format:
+   - Do not use bold or asterisks in the output.
+   - Put any commands in a fenced code block with a language hint (e.g., ```bash).
+   - Never output a bare language label or raw code without a code fence.
+   - No bullet lists unless explicitly asked.
+   - Keep it visually clean and short.
+
+STT HANDLING: The user's question is transcribed from audio. If you see obvious typos or phonetic errors (e.g., 'cube control' instead of 'kubectl', 'pro pod' instead of 'production pod'), interpret them logically.
+
+NOISE FILTERING & INTENT:
+- The transcript may include background noise, fillers ('um', 'uh'), or preamble ('Okay, moving on...').
+- IGNORE these. Focus ONLY on the core technical inquiry.
+- If the input is purely conversational noise (e.g., 'Can you hear me?', 'Just a second'), do not generate a technical answer. Output a polite, short status check or nothing.
+
+Goal: Produce an answer that looks clean, readable, and understandable at a glance during a live interview."""
+
+global_context = ""
+company_name = ""
+interview_stage = ""
+custom_instructions = system_instruction_default
+
+def current_settings():
+    # (instructions, context, company, stage) behind the prompt: the app's
+    # globals, or the settings of the server session being served.
+    session = current_session.get()
+    if session is not None:
+        return session.settings
+    return custom_instructions, global_context, company_name, interview_stage
+
+# ========================
+# File Processing
+# ========================
+
+EXTRACTOR_VERSION = 1  # Bump when extraction changes so cached text is re-extracted
+
+def extract_pdf_pages(file_path, start, stop):
+    # Runs in a worker process for large PDFs; returns the text of pages [start, stop).
+    import PyPDF2
+    with open(file_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+ingest_pool = None
+
+def get_ingest_pool():
+    # Created on first use and kept, so worker start-up is paid once per session.
+    global ingest_pool
+    if ingest_pool is None:
+        ingest_pool = ProcessPoolExecutor(max_workers=INGEST_PROCESSES)
+    return ingest_pool
+
+def extract_text_from_file(file_path, progress=None):
+    # progress(done, total) is called as PDF pages are read.
+    ext = os.path.splitext(file_path)[1].lower()
+    text = ""
+    try:
+        if ext == ".pdf":
+            import PyPDF2
+            with open(file_path, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                total = len(reader.pages)
+                parallel = total >= INGEST_PARALLEL_MIN_PAGES and INGEST_PROCESSES > 1
+                parts = []
+                if not parallel:
+                    for page in reader.pages:
+                        parts.append(page.extract_text() or "")
+                        if progress:
+                            progress(len(parts), total)
+            if parallel:
+                # Page ranges in worker processes; results are collected in order.
+                step = -(-total // (INGEST_PROCESSES * 4))
+                pool = get_ingest_pool()
+                futures = [pool.submit(extract_pdf_pages, file_path, start, min(start + step, total))
+                           for start in range(0, total, step)]
+                for future in futures:
+                    parts.extend(future.result())
+                    if progress:
+                        progress(len(parts), total)
+            text = "\n".join(parts)
+        elif ext == ".docx":
+            from docx import Document
+            doc = Document(file_path)
+            text = "\n".join(para.text for para in doc.paragraphs)
+        elif ext == ".txt":
+            with open(file_path, "r", encoding="utf-8") as f:
+                text = f.read()
+        return text.strip()
+    except Exception as e:
+        print(f"[ERROR] Failed to read {file_path}: {e}")
+        return ""
+
+def cached_extract_text(file_path, progress=None):
+    # Returns (text, from_cache). Text is cached on disk under the file's content
+    # hash, so the same resume uploaded in a later session is not parsed again.
+    ext = os.path.splitext(file_path)[1].lower()
+    cache_path = None
+    if INGEST_CACHE_DIR:
+        try:
+            with open(file_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            cache_path = os.path.join(INGEST_CACHE_DIR, f"{digest}{ext}.v{EXTRACTOR_VERSION}.txt")
+            if os.path.exists(cache_path):
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    return f.read(), True
+        except OSError as e:
+            print(f"[WARN] Extraction cache unavailable: {e}")
+            cache_path = None
+    text = extract_text_from_file(file_path, progress)
+    if text and cache_path:
+        try:
+            os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"[WARN] Could not cache extracted text: {e}")
+    return text, False
+
+# One ingest at a time, off the Tk thread, so context_index updates never race.
+ingest_executor = ThreadPoolExecutor(max_workers=1)
+
+# ========================
+# Context Retrieval
+# ========================
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "to", "of", "for", "with", "about", "in", "on", "at",
+    "from", "by", "is", "are", "was", "were", "be", "been", "it", "this", "that", "you", "your",
+    "i", "me", "my", "we", "our", "do", "does", "did", "can", "could", "would", "will", "how",
+    "what", "why", "when", "where", "which", "who", "tell", "so", "as", "if", "have", "has",
+}
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def tokenize_terms(text):
+    return [w for w in re.findall(r"[a-z0-9][a-z0-9+#.\-]*", text.lower()) if w not in STOPWORDS]
+
+def chunk_document(name, text):
+    # Packs lines into ~RETRIEVAL_CHUNK_CHARS chunks; long lines are split on spaces.
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines():
+        line = line.strip()
+        while len(line) > RETRIEVAL_CHUNK_CHARS:
+            cut = line.rfind(" ", 0, RETRIEVAL_CHUNK_CHARS)
+            cut = cut if cut > 0 else RETRIEVAL_CHUNK_CHARS
+            line_part, line = line[:cut], line[cut:].strip()
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line_part)
+        if not line:
+            continue
+        if size + len(line) > RETRIEVAL_CHUNK_CHARS and current:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return [(name, chunk) for chunk in chunks]
+
+class ContextIndex:
+    # BM25 over chunks of the uploaded files. The index is a dense term x chunk
+    # weight matrix, so a query is one row gather and sum in NumPy.
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.vocab = {}
+        self.weights = None
+        self.total_tokens = 0
+
+    def add_document(self, name, text):
+        with self.lock:
+            chunks = self.chunks + chunk_document(name, text)
+        self._build(chunks)
+
+    def clear(self):
+        with self.lock:
+            self.chunks = []
+            self.vocab = {}
+            self.weights = None
+            self.total_tokens = 0
+
+    def _build(self, chunks):
+        vocab = {}
+        rows = []
+        cols = []
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for idx, (_, chunk) in enumerate(chunks):
+            terms = tokenize_terms(chunk)
+            lengths[idx] = len(terms)
+            for term in terms:
+                rows.append(vocab.setdefault(term, len(vocab)))
+                cols.append(idx)
+        tf = np.zeros((len(vocab), len(chunks)), dtype=np.float32)
+        np.add.at(tf, (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)), 1.0)
+        doc_freq = np.count_nonzero(tf, axis=1).astype(np.float32)
+        idf = np.log(1.0 + (len(chunks) - doc_freq + 0.5) / (doc_freq + 0.5))
+        avg_len = float(lengths.mean()) if len(chunks) else 1.0
+        norm = self.K1 * (1.0 - self.B + self.B * lengths / max(avg_len, 1.0))
+        weights = idf[:, None] * tf * (self.K1 + 1.0) / (tf + norm[None, :])
+        with self.lock:
+            self.chunks = chunks
+            self.vocab = vocab
+            self.weights = weights
+            self.total_tokens = sum(estimate_tokens(chunk) for _, chunk in chunks)
+
+    def search(self, query, token_budget, top_k=RETRIEVAL_TOP_K):
+        # Returns the best chunks (in document order) that fit token_budget. With no
+        # keyword hits, falls back to the leading chunks (summary/headline sections).
+        with self.lock:
+            chunks, vocab, weights = self.chunks, self.vocab, self.weights
+        if not chunks:
+            return []
+        ids = sorted({vocab[t] for t in tokenize_terms(query) if t in vocab})
+        if ids:
+            scores = weights[ids].sum(axis=0)
+            k = min(top_k, len(chunks))
+            best = np.argpartition(-scores, k - 1)[:k]
+            ranked = [int(i) for i in best[np.argsort(-scores[best])] if scores[i] > 0]
+        else:
+            ranked = list(range(min(top_k, len(chunks))))
+        selected = []
+        used = 0
+        for idx in ranked:
+            cost = estimate_tokens(chunks[idx][1])
+            if used + cost > token_budget:
+                continue
+            selected.append(idx)
+            used += cost
+        return [chunks[idx] for idx in sorted(selected)]
+
+context_index = ContextIndex()
+
+def format_context_excerpts(excerpts):
+    return "\n\n".join(f"[{name}]\n{chunk}" for name, chunk in excerpts)
+
+# ========================
+# AI Interaction (Streaming with Cancellation)
+# ========================
+
+class PromptBuilder:
+    # Keeps the prompt cache-friendly: the static parts (instructions, context,
+    # company, stage) are one byte-identical system message that is only rebuilt
+    # when one of them changes, and history (see ConversationMemory) is rendered
+    # once per turn and appended, so each request's input starts with the
+    # previous request's input.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prefix_key = None
+        self.prefix = ""
+        self.cache_stats = {"requests": 0, "input_tokens": 0, "cached_tokens": 0}
+
+    def use_retrieval(self):
+        return RETRIEVAL_MODE and context_index.total_tokens > CONTEXT_TOKEN_BUDGET
+
+    def system_prefix(self):
+        # A context that fits the budget stays in the cached prefix; a larger one is
+        # retrieved per question and sent after the history instead.
+        retrieval = self.use_retrieval()
+        instructions, context_text, company, stage = current_settings()
+        key = (instructions, context_text, company, stage, retrieval)
+        with self.lock:
+            if key != self.prefix_key:
+                context = "" if retrieval else f"\n\nRELEVANT CONTEXT (Resume/Job Description):\n{context_text}"
+                company_block = f"\n\nCOMPANY:\n{company}" if company.strip() else ""
+                stage_block = f"\n\nINTERVIEW STAGE:\n{stage}" if stage.strip() else ""
+                self.prefix = (
+                    f"{instructions}"
+                    f"{context}"
+                    f"{company_block}"
+                    f"{stage_block}"
+                )
+                self.prefix_key = key
+            return self.prefix
+
+    def build_input(self, transcript, with_history=True, continue_from=None):
+        messages = [{"role": "system", "content": self.system_prefix()}]
+        history_text = conversation_memory.render() if with_history else ""
+        if history_text:
+            messages.append({"role": "system", "content": f"RECENT CONVERSATION:\n{history_text}"})
+        if self.use_retrieval():
+            start = time.perf_counter()
+            excerpts = context_index.search(transcript, CONTEXT_TOKEN_BUDGET)
+            if DEBUG_MODE:
+                print(f"[DEBUG] Retrieved {len(excerpts)} context chunks in {(time.perf_counter() - start) * 1000:.2f} ms")
+            if excerpts:
+                messages.append({
+                    "role": "system",
+                    "content": f"RELEVANT CONTEXT (Resume/Job Description excerpts):\n{format_context_excerpts(excerpts)}"
+                })
+        messages.append({"role": "user", "content": f"{transcript}"})
+        if continue_from:
+            # The question went on after the answer had started: keep the start and extend it.
+            messages.append({"role": "assistant", "content": continue_from})
+            messages.append({"role": "user", "content": (
+                "The question above was finished after you started answering. Continue your answer "
+                "from where it stops, taking the full question into account. Do not repeat yourself."
+            )})
+        return messages
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "input_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) or 0
+        with self.lock:
+            self.cache_stats["requests"] += 1
+            self.cache_stats["input_tokens"] += usage.input_tokens or 0
+            self.cache_stats["cached_tokens"] += cached
+        if DEBUG_MODE:
+            print(f"[DEBUG] Prompt cache: {cached}/{usage.input_tokens} input tokens cached")
+
+prompt_builder = PromptBuilder()
+
+# Summaries run here, for every ConversationMemory (one per session in server mode).
+background_pool = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="background")
+
+class ConversationMemory:
+    # Last MEMORY_VERBATIM_TURNS pairs verbatim plus a running summary of older
+    # ones, kept under HISTORY_TOKEN_BUDGET. Older pairs stay visible until a
+    # background job has folded them into the summary, so summarizing never
+    # sits on the request path. Batches are summarized in order by one job at a
+    # time on background_pool.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []  # (turn number, rendered entry, tokens)
+        self.entries_text = ""
+        self.summary = ""
+        self.scheduled_through = 0
+        self.cleared_through = 0
+        self.turn_count = 0
+        self.recent = collections.deque(maxlen=CONVERSATION_CONTEXT_MAX_TURNS)  # (question, answer), for the turn classifier
+        self.jobs = collections.deque()
+        self.summarizing = False
+
+    def add(self, question, answer):
+        with self.lock:
+            self.turn_count += 1
+            n = self.turn_count
+            entry = f"Q{n}: {question}\nA{n}: {answer}"
+            self.entries.append((n, entry, estimate_tokens(entry)))
+            self.entries_text = f"{self.entries_text}\n{entry}" if self.entries_text else entry
+            self.recent.append((question, answer))
+            self._trim_and_schedule()
+
+    def recent_turns(self, n):
+        with self.lock:
+            return list(self.recent)[-n:]
+
+    def _used_tokens(self):
+        summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+        return summary_tokens + sum(tokens for _, _, tokens in self.entries)
+
+    def _trim_and_schedule(self):
+        # Caller holds the lock. The hard budget removes the oldest entries at once;
+        # entries past the verbatim window are summarized in batches.
+        dropped = []
+        while len(self.entries) > 1 and self._used_tokens() > HISTORY_TOKEN_BUDGET:
+            dropped.append(self.entries.pop(0))
+        truncated = self.entries and self._used_tokens() > HISTORY_TOKEN_BUDGET
+        if truncated:
+            # A single pair over the budget is cut short rather than sent whole.
+            n, entry, tokens = self.entries[0]
+            max_chars = max(0, HISTORY_TOKEN_BUDGET - (self._used_tokens() - tokens) - 1) * 4
+            entry = entry[:max(0, max_chars - 3)] + "..."
+            self.entries[0] = (n, entry, estimate_tokens(entry))
+        if dropped or truncated:
+            self.entries_text = "\n".join(entry for _, entry, _ in self.entries)
+        overflow = self.entries[:max(0, len(self.entries) - MEMORY_VERBATIM_TURNS)]
+        batch = [e for e in dropped + overflow if e[0] > self.scheduled_through]
+        if batch and (dropped or len(batch) >= MEMORY_SUMMARY_BATCH):
+            self.scheduled_through = batch[-1][0]
+            self.jobs.append(batch)
+            if not self.summarizing:
+                self.summarizing = True
+                background_pool.submit(self._summarize_jobs)
+
+    def _summarize_jobs(self):
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.summarizing = False
+                    return
+                batch = self.jobs.popleft()
+                previous = self.summary
+            summary = summarize_turns(previous, [entry for _, entry, _ in batch])
+            through = batch[-1][0]
+            with self.lock:
+                if through <= self.cleared_through:
+                    continue  # Cleared while this batch was being summarized
+                self.summary = truncate_to_tokens(summary, SUMMARY_TOKEN_BUDGET)
+                self.entries = [e for e in self.entries if e[0] > through]
+                self.entries_text = "\n".join(entry for _, entry, _ in self.entries)
+                self._trim_and_schedule()
+                saved_summary = self.summary
+            if session_store:
+                session_store.set_setting("memory_summary", json.dumps({"summary": saved_summary, "through": through}))
+            if DEBUG_MODE:
+                print(f"[DEBUG] Memory summary updated through Q{through} ({estimate_tokens(summary)} tokens).")
+
+    def render(self):
+        with self.lock:
+            summary, entries_text = self.summary, self.entries_text
+        if summary:
+            return f"Summary of earlier questions and answers: {summary}\n{entries_text}".rstrip()
+        return entries_text
+
+    def restore(self, summary, summarized_through, turns):
+        # Warm start from the session store: turns are numbered 1..N in the order
+        # they were asked, and those up to summarized_through are in the summary.
+        with self.lock:
+            self.summary = summary
+            self.scheduled_through = summarized_through
+            self.turn_count = len(turns)
+            self.entries = []
+            for n, (question, answer) in enumerate(turns, 1):
+                if n > summarized_through:
+                    entry = f"Q{n}: {question}\nA{n}: {answer}"
+                    self.entries.append((n, entry, estimate_tokens(entry)))
+            self.recent.extend(turns[summarized_through:][-CONVERSATION_CONTEXT_MAX_TURNS:])
+            self.entries_text = "\n".join(entry for _, entry, _ in self.entries)
+            self._trim_and_schedule()
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+            self.entries_text = ""
+            self.summary = ""
+            self.recent.clear()
+            self.jobs.clear()
+            self.scheduled_through = self.cleared_through = self.turn_count
+            through = self.turn_count
+        if session_store:
+            # A restart then restores none of the cleared turns.
+            session_store.set_setting("memory_summary", json.dumps({"summary": "", "through": through}))
+
+conversation_memory = ConversationMemory()
+
+def truncate_to_tokens(text, max_tokens):
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    # Keep the newest part of the summary.
+    return text[-max_chars:].split(" ", 1)[-1]
+
+def summarize_turns(previous_summary, entries):
+    transcript = "\n".join(entries)
+    try:
+        response = client.responses.create(
+            model=SUMMARY_MODEL,
+            input=[
+                {"role": "system", "content": (
+                    "Maintain a compact running summary of a job interview for later context. "
+                    "Merge the new Q/A pairs into the existing summary. Keep topics asked, "
+                    "claims and numbers the candidate gave, and commitments. Plain sentences, "
+                    f"under {SUMMARY_TOKEN_BUDGET} tokens."
+                )},
+                {"role": "user", "content": f"EXISTING SUMMARY:\n{previous_summary or '(none)'}\n\nNEW Q/A:\n{transcript}"}
+            ],
+            max_output_tokens=SUMMARY_TOKEN_BUDGET,
+            temperature=0
+        )
+        summary = response.output_text.strip()
+        if summary:
+            return summary
+    except Exception as e:
+        print(f"[ERROR] Summary failed: {e}")
+    # Fallback: keep just the questions so topics are not forgotten.
+    questions = [entry.split("\n", 1)[0] for entry in entries]
+    return f"{previous_summary} Earlier questions: {'; '.join(questions)}".strip()
+
+def add_to_history(question, answer):
+    if not question or not answer:
+        return
+    conversation_memory.add(question.strip(), answer.strip())
+    if session_store:
+        session_store.add_turn(question.strip(), answer.strip())
+
+def format_conversation_history():
+    return conversation_memory.render()
+
+QUESTION_STARTERS = {
+    "what", "why", "how", "when", "where", "which", "who", "whose", "can", "could", "would",
+    "what's", "how's", "where's", "who's", "can't", "couldn't", "wouldn't", "don't",
+    "will", "do", "does", "did", "is", "are", "was", "were", "have", "has", "should",
+    "tell", "walk", "explain", "describe", "give", "share", "talk", "define", "compare",
+    "design", "implement", "write", "build",
+}
+DANGLING_WORDS = {
+    "a", "an", "the", "and", "or", "but", "to", "of", "for", "with", "about", "in", "on", "at",
+    "from", "by", "like", "um", "uh", "so", "because", "if", "then", "that", "which", "your",
+    "my", "you", "is", "are", "me", "between", "how", "what", "when", "where", "why", "into",
+}
+
+def normalize_words(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def transcripts_match(a, b):
+    # Close enough to reuse an answer: same last two words (so a question that kept
+    # going does not match its prefix) and high word-level similarity overall.
+    words_a = normalize_words(a)
+    words_b = normalize_words(b)
+    if not words_a or words_a[-2:] != words_b[-2:]:
+        return False
+    return difflib.SequenceMatcher(None, words_a, words_b).ratio() >= SPECULATIVE_MATCH_THRESHOLD
+
+def looks_like_complete_question(text):
+    # Interim transcripts are unformatted, so judge by wording: a question opener
+    # near the start and no dangling word (article, preposition, filler) at the end.
+    if text.rstrip().endswith("?"):
+        return True
+    words = normalize_words(text)
+    if len(words) < SPECULATIVE_MIN_WORDS:
+        return False
+    if not any(w in QUESTION_STARTERS for w in words[:4]):
+        return False
+    return words[-1] not in DANGLING_WORDS
+
+FILLER_WORDS = {"um", "uh", "erm", "hmm", "ah", "uhm", "mm"}
+LEADING_FILLERS = {"so", "okay", "ok", "alright", "right", "and", "well", "now"}
+
+def normalize_question(text):
+    # Cache key: lowercase words without punctuation, fillers or a leading "so"/"okay".
+    words = [w for w in normalize_words(text) if w not in FILLER_WORDS]
+    while words and words[0] in LEADING_FILLERS:
+        words.pop(0)
+    return " ".join(words)
+
+NOISE_PHRASES = [
+    "can you hear me", "can you hear me now", "can everyone hear me", "you're on mute", "you are on mute",
+    "i think you're muted", "can you see my screen", "can you see it", "let me share my screen",
+    "one second", "one sec", "give me a second", "give me a sec", "hold on", "just a moment", "bear with me",
+    "sorry go ahead", "go ahead", "no you go", "sorry about that", "you cut out", "you're breaking up",
+    "is that better", "thank you", "thanks", "okay", "ok", "great", "cool", "perfect", "sounds good",
+    "got it", "makes sense", "yeah", "yes", "no", "right", "sure", "alright", "mhm", "uh huh", "i see",
+]
+FOLLOW_UP_OPENERS = {"and", "but", "so", "why", "really", "also", "then", "okay", "ok"}
+FOLLOW_UP_PHRASES = [
+    "what about", "how about", "why is that", "why not", "how so", "how come", "for example", "such as",
+    "can you elaborate", "could you elaborate", "elaborate on", "go deeper", "more detail", "say more",
+    "what do you mean", "and then", "what else", "anything else", "what if", "in that case",
+]
+REFERRING_WORDS = {"that", "it", "this", "those", "these", "them", "there", "then", "one"}
+
+class TurnClassifier:
+    # Scores a finished turn as "question", "follow-up" or "noise" with a small
+    # linear model over cheap text features (no network, a few microseconds).
+    # Noise covers meeting logistics, acknowledgements, filler, garbled low-
+    # confidence text and the candidate reading the last answer back into the
+    # cable. A turn is only dropped as noise when most of it is such phrases or
+    # an echo of the last answers; a short topic ("SQL versus NoSQL.") or an
+    # acknowledgement in front of a request ("Sure. Describe ...") is answered.
+    # Every decision is appended to TURN_LOG_PATH with its features so the
+    # weights and TURN_NOISE_THRESHOLD can be tuned from replayed sessions.
+    WEIGHTS = {
+        "question": {"bias": 0.5, "starter": 2.0, "qmark": 1.5, "length": 2.0, "short": -0.5,
+                     "phrase": -4.0, "echo": -3.0, "filler": -2.0, "low_conf": -2.0},
+        "follow-up": {"bias": -1.0, "starter": 2.0, "qmark": 1.5, "short": 0.5, "opener": 1.5, "cue": 3.0,
+                      "refers": 2.0, "phrase": -4.0, "echo": -3.0, "filler": -2.0, "low_conf": -2.0},
+        "noise": {"bias": -0.5, "phrase": 5.0, "echo": 5.0, "filler": 3.0, "low_conf": 3.0, "bare": 2.0},
+    }
+    NOISE_MIN_PHRASE = 0.75  # Share of the turn in noise phrases needed to drop it (or NOISE_MIN_ECHO)
+    NOISE_MIN_ECHO = 0.5  # Share of the turn's trigrams found in the last answers
+
+    def __init__(self, path=TURN_LOG_PATH, threshold=TURN_NOISE_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.noise_phrases = collections.defaultdict(list)  # first word -> phrases starting with it
+        for phrase in NOISE_PHRASES:
+            words = normalize_words(phrase)
+            self.noise_phrases[words[0]].append(words)
+        self.follow_up_phrases = [" ".join(normalize_words(p)) for p in FOLLOW_UP_PHRASES]
+
+    def features(self, text, words=None, history=None):
+        tokens = normalize_words(text)
+        content = [w for w in tokens if w not in FILLER_WORDS]
+        n = len(content)
+        has_history = bool(history)
+        joined = " ".join(content)
+        confidences = [w.get("confidence") for w in (words or []) if w.get("confidence") is not None]
+        mean_conf = sum(confidences) / len(confidences) if confidences else 1.0
+        opener = bool(content) and content[0] in FOLLOW_UP_OPENERS and has_history
+        cue = has_history and any(p in joined for p in self.follow_up_phrases)
+        refers = has_history and n <= 8 and any(w in REFERRING_WORDS for w in content)
+        qmark = text.rstrip().endswith("?")
+        covered = self._phrase_words(content)
+        # Question starters count after any leading acknowledgement ("Sure. Go
+        # ahead and describe ...", "Right. Design ...").
+        lead = 0
+        while lead < n and (covered[lead] or content[lead] in LEADING_FILLERS):
+            lead += 1
+        return {
+            "words": n,
+            "starter": float(any(w in QUESTION_STARTERS for w in content[lead:lead + 3])),
+            "qmark": float(qmark),
+            "length": min(n, 20) / 20.0,
+            "short": float(n <= 3),
+            "phrase": sum(covered) / n if n else 1.0,
+            "echo": self._echo(content, history),
+            "filler": (len(tokens) - n) / len(tokens) if tokens else 1.0,
+            "low_conf": max(0.0, 0.75 - mean_conf) / 0.75,
+            "opener": float(opener),
+            "cue": float(cue),
+            "refers": float(refers),
+            "bare": float(n <= 3 and not qmark and not opener and not refers),
+        }
+
+    def _phrase_words(self, content):
+        # Which of the turn's words are inside known logistics / acknowledgement phrases.
+        covered = [False] * len(content)
+        for i, word in enumerate(content):
+            for phrase in self.noise_phrases.get(word, ()):
+                if content[i:i + len(phrase)] == phrase:
+                    covered[i:i + len(phrase)] = [True] * len(phrase)
+        return covered
+
+    def _echo(self, content, history):
+        # Share of the turn's word trigrams found in the latest answers: the
+        # candidate reading an answer aloud, picked up by the meeting audio.
+        if len(content) < 3 or not history:
+            return 0.0
+        answer_grams = set()
+        for _, answer in history:
+            answer_words = normalize_words(answer)
+            answer_grams.update(zip(answer_words, answer_words[1:], answer_words[2:]))
+        grams = list(zip(content, content[1:], content[2:]))
+        return sum(g in answer_grams for g in grams) / len(grams)
+
+    def score(self, features):
+        logits = {label: sum(w * features.get(name, 1.0 if name == "bias" else 0.0) for name, w in weights.items())
+                  for label, weights in self.WEIGHTS.items()}
+        top = max(logits.values())
+        exps = {label: math.exp(v - top) for label, v in logits.items()}
+        total = sum(exps.values())
+        return {label: v / total for label, v in exps.items()}
+
+    def classify(self, text, words=None, history=None, log=True):
+        # Returns (label, probabilities). Noise needs at least `threshold` and a
+        # turn made up of noise phrases or echoed answer; otherwise the likelier
+        # of question / follow-up wins.
+        started = time.perf_counter()
+        features = self.features(text, words, history)
+        probs = self.score(features)
+        noise_cue = features["phrase"] >= self.NOISE_MIN_PHRASE or features["echo"] >= self.NOISE_MIN_ECHO
+        if features["words"] == 0 or (probs["noise"] >= self.threshold and noise_cue):
+            label = "noise"
+        else:
+            label = "follow-up" if probs["follow-up"] > probs["question"] else "question"
+        elapsed_us = (time.perf_counter() - started) * 1e6
+        if log:
+            self.counts[label] += 1
+            self._log({"ts": round(time.time(), 3), "text": text, "label": label,
+                       "probs": {k: round(v, 3) for k, v in probs.items()},
+                       "features": {k: round(v, 3) for k, v in features.items()}, "us": round(elapsed_us, 1)})
+        return label, probs
+
+    def _log(self, record):
+        if DEBUG_MODE:
+            print(f"\n[DEBUG] Turn classified as {record['label']} {record['probs']}: {record['text'][:80]}")
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"[ERROR] Could not write turn decision: {e}")
+            self.path = None
+
+    def report(self):
+        if self.counts:
+            print(f"[INFO] Turns: {self.counts['question']} questions, {self.counts['follow-up']} follow-ups, "
+                  f"{self.counts['noise']} ignored as noise.")
+
+turn_classifier = TurnClassifier()
+
+class AnswerCache:
+    # LRU of finished answers keyed by normalized question. Misses on the exact
+    # key fall back to MinHash over character 3-grams, compared against all
+    # cached signatures at once, which tolerates small STT differences ("a bit
+    # about", dropped words). A fuzzy candidate must also differ by at most one
+    # content word, so "readiness vs liveness" never answers "liveness vs
+    # startup". Answers depend on the instructions, context, company and stage,
+    # so the cache empties itself whenever any of them change.
+    NUM_HASHES = 96
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, capacity=ANSWER_CACHE_SIZE, threshold=ANSWER_CACHE_THRESHOLD):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # normalized question -> (signature, content words, answer)
+        self.context_key = None
+        rng = np.random.default_rng(1234)
+        self.hash_a = rng.integers(1, 1 << 31, self.NUM_HASHES, dtype=np.uint64)
+        self.hash_b = rng.integers(0, self.PRIME, self.NUM_HASHES, dtype=np.uint64)
+        self.stats = {"hits": 0, "fuzzy_hits": 0, "misses": 0, "invalidations": 0}
+
+    def signature(self, key):
+        padded = f" {key} "
+        shingles = {padded[i:i + 3] for i in range(len(padded) - 2)}
+        values = np.array([zlib.crc32(s.encode()) for s in shingles], dtype=np.uint64)
+        # (a * x + b) mod p per hash function; a < 2**31 and x < 2**32 keep it in uint64.
+        hashed = (values[:, None] * self.hash_a[None, :] + self.hash_b[None, :]) % np.uint64(self.PRIME)
+        return hashed.min(axis=0)
+
+    def _check_context(self):
+        key = current_settings()
+        if key != self.context_key:
+            if self.entries:
+                self.stats["invalidations"] += 1
+                if DEBUG_MODE:
+                    print(f"[DEBUG] Answer cache cleared ({len(self.entries)} entries): context changed")
+            self.entries.clear()
+            self.context_key = key
+
+    def lookup(self, question):
+        key = normalize_question(question)
+        if not key:
+            return None
+        with self.lock:
+            self._check_context()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[2]
+            if self.entries:
+                keys = list(self.entries)
+                signatures = np.stack([self.entries[k][0] for k in keys])
+                scores = (signatures == self.signature(key)).mean(axis=1)
+                terms = set(tokenize_terms(key))
+                for best in np.argsort(-scores)[:3]:
+                    if scores[best] < self.threshold:
+                        break
+                    _, cached_terms, answer = self.entries[keys[best]]
+                    if len(terms ^ cached_terms) <= 1:
+                        self.entries.move_to_end(keys[best])
+                        self.stats["fuzzy_hits"] += 1
+                        if DEBUG_MODE:
+                            print(f"[DEBUG] Answer cache fuzzy hit ({scores[best]:.2f}): {keys[best]}")
+                        return answer
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, question, answer):
+        key = normalize_question(question)
+        if not key or not answer.strip():
+            return
+        signature = self.signature(key)
+        with self.lock:
+            self._check_context()
+            self.entries[key] = (signature, set(tokenize_terms(key)), answer)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+answer_cache = AnswerCache()
+
+COMMON_INTERVIEW_QUESTIONS = [
+    "Tell me about yourself.",
+    "Walk me through your resume.",
+    "Why are you interested in this role?",
+    "What are your greatest strengths?",
+    "What is your biggest weakness?",
+    "Why are you leaving your current job?",
+    "Tell me about a challenge you overcame at work.",
+    "Do you have any questions for us?",
+]
+
+class RateLimiter:
+    # Spaces calls evenly at per_minute; acquire() sleeps until the next slot.
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.perf_counter()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+# Prewarm requests of every AnswerBank share these workers.
+prewarm_pool = ThreadPoolExecutor(max_workers=PREWARM_CONCURRENCY, thread_name_prefix="prewarm")
+
+class AnswerBank:
+    # Answers to likely questions, generated in the background whenever the
+    # instructions, context, company or stage change. Questions come from a
+    # common list plus ones derived from the uploaded context; answers are
+    # generated on prewarm_pool under a rate limit and looked up through an
+    # AnswerCache, so a live question that matches is shown at once. A newer
+    # change supersedes a running job: its remaining answers are skipped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = AnswerCache(capacity=PREWARM_QUESTIONS + len(COMMON_INTERVIEW_QUESTIONS) + 4)
+        self.limiter = RateLimiter(PREWARM_REQUESTS_PER_MIN)
+        self.job = 0
+        self.timer = None
+        self.progress = {"total": 0, "done": 0, "failed": 0, "input_tokens": 0, "output_tokens": 0, "running": False}
+
+    def schedule(self):
+        # Called on every context change; only the last change in a burst runs.
+        with self.lock:
+            self.job += 1
+            job = self.job
+            if self.timer:
+                self.timer.cancel()
+            # The job runs with the caller's context, so a server session's job uses that session's state.
+            self.timer = threading.Timer(PREWARM_DEBOUNCE_MS / 1000.0, contextvars.copy_context().run,
+                                         args=(self._run, job))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        # Supersedes any scheduled or running job.
+        with self.lock:
+            self.job += 1
+            if self.timer:
+                self.timer.cancel()
+
+    def is_current(self, job):
+        return job == self.job
+
+    def lookup(self, question):
+        return self.cache.lookup(question)
+
+    def cost_usd(self):
+        price_in, price_out = PREWARM_PRICE_PER_1M
+        return (self.progress["input_tokens"] * price_in + self.progress["output_tokens"] * price_out) / 1e6
+
+    def status_text(self):
+        p = self.progress
+        if not p["total"]:
+            return ""
+        state = "preparing" if p["running"] else "ready"
+        failed = f", {p['failed']} failed" if p["failed"] else ""
+        return f"Answer bank {state}: {p['done']}/{p['total']}{failed} (~${self.cost_usd():.4f})"
+
+    def _record_usage(self, usage):
+        if usage is None:
+            return
+        with self.lock:
+            self.progress["input_tokens"] += usage.input_tokens or 0
+            self.progress["output_tokens"] += usage.output_tokens or 0
+
+    def _run(self, job):
+        if not self.is_current(job):
+            return
+        start = time.perf_counter()
+        with self.lock:
+            self.progress.update({"total": 0, "done": 0, "failed": 0, "running": True})
+        questions = self.candidate_questions(job)
+        if not self.is_current(job):
+            return
+        with self.lock:
+            self.progress["total"] = len(questions)
+        print(f"[INFO] Preparing answers for {len(questions)} likely questions...")
+        wait_futures([prewarm_pool.submit(contextvars.copy_context().run, self._answer, job, question)
+                      for question in questions])
+        if self.is_current(job):
+            with self.lock:
+                self.progress["running"] = False
+            print(f"[INFO] {self.status_text()} in {time.perf_counter() - start:.1f}s")
+
+    def candidate_questions(self, job):
+        questions = list(COMMON_INTERVIEW_QUESTIONS)
+        _, context, company, stage = current_settings()
+        if company.strip():
+            questions += [f"Why do you want to work at {company}?", f"What do you know about {company}?"]
+        if context.strip() or stage.strip():
+            questions += self.derive_questions(job)
+        unique = {}
+        for question in questions:
+            unique.setdefault(normalize_question(question), question)
+        return [q for key, q in unique.items() if key]
+
+    def derive_questions(self, job):
+        # One request for the questions this interviewer is most likely to ask.
+        _, context, company, stage = current_settings()
+        context = context[:CONTEXT_TOKEN_BUDGET * 4 * 3]
+        try:
+            self.limiter.acquire()
+            if not self.is_current(job):
+                return []
+            response = client.responses.create(
+                model=AI_MODEL,
+                input=[
+                    {"role": "system", "content": (
+                        f"List the {PREWARM_QUESTIONS} questions the interviewer is most likely to ask this candidate, "
+                        "based on the job description, resume, company and interview stage. One question per line, "
+                        "no numbering, no other text."
+                    )},
+                    {"role": "user", "content": (
+                        f"COMPANY: {company or '(unknown)'}\nINTERVIEW STAGE: {stage or '(unknown)'}\n\n"
+                        f"CONTEXT:\n{context or '(none)'}"
+                    )},
+                ],
+                max_output_tokens=40 * PREWARM_QUESTIONS,
+                temperature=0.3
+            )
+            self._record_usage(response.usage)
+        except Exception as e:
+            print(f"[ERROR] Deriving likely questions failed: {e}")
+            return []
+        questions = []
+        for line in response.output_text.splitlines():
+            line = re.sub(r"^\s*(?:[-*\u2022]|\d+[.)])\s*", "", line).strip()
+            if len(line) > 10:
+                questions.append(line)
+        return questions[:PREWARM_QUESTIONS]
+
+    def _answer(self, job, question):
+        self.limiter.acquire()
+        if not self.is_current(job):
+            return
+        try:
+            args = stream_manager._request_args(prompt_builder.build_input(question, with_history=False))
+            response = client.responses.create(**args)
+            self._record_usage(response.usage)
+            if self.is_current(job):
+                self.cache.store(question, response.output_text)
+                with self.lock:
+                    self.progress["done"] += 1
+                if DEBUG_MODE:
+                    print(f"[DEBUG] {self.status_text()}")
+        except Exception as e:
+            with self.lock:
+                self.progress["failed"] += 1
+            if DEBUG_MODE:
+                print(f"[DEBUG] Prewarm failed for '{question}': {e}")
+
+answer_bank = AnswerBank()
+
+class ConnectionWarmer:
+    # Keeps the pooled OpenAI connection open between questions. warm() connects
+    # right away (at launch and whenever an STT session begins); after
+    # LLM_KEEPALIVE_S without traffic a background thread sends a models.retrieve
+    # request so the connection does not idle out. A stream closed before it
+    # finished (superseded, or a hedge that lost) takes its HTTP/1.1 connection
+    # with it, so stream_closed() connects again at once. Time to first token
+    # over the last TRACE_WINDOW answers is kept separately for answers that
+    # reused a pooled connection (warm) and answers that had to open one (cold).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.last_activity = None
+        self.last_attempt = None
+        self.sent = {}  # gen -> (request start, no new connection was needed)
+        self.ttft = {kind: collections.deque(maxlen=TRACE_WINDOW) for kind in ("warm", "cold")}
+        self.stats = {"pings": 0, "ping_failures": 0}
+
+    def start(self):
+        if LLM_WARM_MODE and self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def warm(self):
+        self.wake.set()
+
+    def touch(self):
+        with self.lock:
+            self.last_activity = time.perf_counter()
+
+    def _until_ping(self):
+        # Seconds until the next keep-alive; None before the first connection,
+        # when only warm() starts one.
+        with self.lock:
+            times = [t for t in (self.last_activity, self.last_attempt) if t is not None]
+        if not times:
+            return None
+        return max(0.0, LLM_KEEPALIVE_S - (time.perf_counter() - max(times)))
+
+    def _run(self):
+        while True:
+            forced = self.wake.wait(self._until_ping())
+            self.wake.clear()
+            if forced or self._until_ping() == 0:
+                self._ping(forced)
+
+    def _ping(self, forced):
+        with self.lock:
+            # A long answer still streaming keeps its connection open by itself;
+            # look again after another LLM_KEEPALIVE_S.
+            self.last_attempt = time.perf_counter()
+            if self.sent and not forced:
+                return
+        start = time.perf_counter()
+        try:
+            stream_manager.warm_connection()
+        except Exception as e:
+            self.stats["ping_failures"] += 1
+            if DEBUG_MODE:
+                print(f"[DEBUG] OpenAI keep-alive failed: {e}")
+            return
+        self.touch()
+        self.stats["pings"] += 1
+        if self.stats["pings"] == 1:
+            startup.record("llm connect", start)
+        if DEBUG_MODE:
+            print(f"[DEBUG] OpenAI keep-alive {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def request_sent(self, gen):
+        # Called on the thread (or in the task) that sends the request, so the
+        # connection trace hook can tell which answer it belongs to.
+        llm_request_gen.set(gen)
+        with self.lock:
+            self.sent[gen] = (time.perf_counter(), True)
+
+    def connecting(self, gen):
+        with self.lock:
+            if gen in self.sent:
+                self.sent[gen] = (self.sent[gen][0], False)
+
+    def first_token(self, gen):
+        with self.lock:
+            started = self.sent.pop(gen, None)
+            if started is None:
+                return
+            start, warm = started
+            ttft_ms = (time.perf_counter() - start) * 1000
+            self.ttft["warm" if warm else "cold"].append(ttft_ms)
+        if DEBUG_MODE:
+            print(f"[DEBUG] First token after {ttft_ms:.0f} ms ({'warm' if warm else 'cold'} connection)")
+
+    def request_done(self, gen):
+        # A finished request leaves its connection idle in the pool; the
+        # keep-alive timer takes it from here.
+        with self.lock:
+            self.sent.pop(gen, None)
+        self.touch()
+
+    def stream_closed(self):
+        self.warm()
+
+    def report(self):
+        parts = []
+        for kind in ("warm", "cold"):
+            values = sorted(self.ttft[kind])
+            if values:
+                parts.append(f"{kind} p50 {values[len(values) // 2]:.0f} ms (n={len(values)})")
+        if parts:
+            print(f"[INFO] OpenAI time to first token: {', '.join(parts)}; {self.stats['pings']} keep-alive pings")
+
+connection_warmer = ConnectionWarmer()
+
+def is_transient_error(e):
+    # Worth retrying: timeouts, dropped connections, rate limits and server errors.
+    import openai
+    if isinstance(e, (openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(e, "status_code", None)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+def retry_delay(retry):
+    # Exponential backoff with full jitter, in seconds.
+    return random.uniform(0, LLM_RETRY_BASE_MS * 2 ** retry) / 1000
+
+class ModelLatencyStats:
+    # Rolling time to first token and request outcomes per model. A model's hedge
+    # deadline is its recent p95, so only the slowest few requests get a backup.
+    # A request stopped because its backup won counts with the time it had waited.
+    WINDOW = 50
+    MIN_SAMPLES = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ttft = collections.defaultdict(lambda: collections.deque(maxlen=self.WINDOW))
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def record_ttft(self, model, ttft_ms):
+        with self.lock:
+            self.ttft[model].append(ttft_ms)
+
+    def count(self, model, name):
+        with self.lock:
+            self.counts[model][name] += 1
+
+    def deadline_ms(self, model):
+        with self.lock:
+            values = sorted(self.ttft[model])
+        if len(values) < self.MIN_SAMPLES:
+            return HEDGE_DEADLINE_MS
+        low, high = HEDGE_DEADLINE_RANGE_MS
+        return min(high, max(low, values[int(len(values) * 0.95)]))
+
+    def summary_text(self):
+        lines = []
+        with self.lock:
+            models = {model: (sorted(values), dict(self.counts[model])) for model, values in self.ttft.items()}
+            for model, counts in self.counts.items():
+                models.setdefault(model, ([], dict(counts)))
+        for model, (values, counts) in sorted(models.items()):
+            latency = f"ttft p50 {values[len(values) // 2]:.0f} p95 {values[int(len(values) * 0.95)]:.0f} ms" if values else "no tokens yet"
+            lines.append(f"{model}: {latency}, {counts.get('requests', 0)} requests, {counts.get('hedges', 0)} hedged, "
+                         f"{counts.get('hedge_wins', 0)} hedge wins, {counts.get('errors', 0)} errors, "
+                         f"deadline {self.deadline_ms(model):.0f} ms")
+        return "\n".join(lines)
+
+    def report(self):
+        text = self.summary_text()
+        if text:
+            print("[INFO] OpenAI models: " + text.replace("\n", "; "))
+
+model_stats = ModelLatencyStats()
+
+class AnswerRace:
+    # The requests competing to answer one generation: the first one, a hedge
+    # sent when its first token is late, and retries after transient errors.
+    # The first request to stream a token wins and the others are stopped.
+    # `changed` (a threading or asyncio Event) is set on every claim and end.
+    def __init__(self, changed):
+        self.lock = threading.Lock()
+        self.changed = changed
+        self.models = {}  # attempt -> model
+        self.started = {}  # attempt -> request start
+        self.first_token = set()
+        self.live = set()
+        self.workers = {}  # attempt -> task (asyncio engine)
+        self.winner = None
+        self.finished = False
+        self.hedge = None
+        self.retries = 0
+        self.deadline = None  # when to send the hedge, while no token has arrived
+        self.errors = []
+        self.last_failed = None  # attempt whose failure is the latest error; a retry reuses its model
+
+    def add(self, model):
+        with self.lock:
+            attempt = len(self.models)
+            self.models[attempt] = model
+            self.started[attempt] = time.perf_counter()
+            self.live.add(attempt)
+        return attempt
+
+    def got_token(self, attempt):
+        # First token of an attempt: records its TTFT, then claims the race.
+        # Attempts still waiting on a winner's behalf count with their wait so far.
+        now = time.perf_counter()
+        with self.lock:
+            self.first_token.add(attempt)
+            model_stats.record_ttft(self.models[attempt], (now - self.started[attempt]) * 1000)
+            if self.winner is not None:
+                return False
+            self.winner = attempt
+            self.deadline = None
+            for other in self.live - self.first_token:
+                model_stats.record_ttft(self.models[other], (now - self.started[other]) * 1000)
+        self.changed.set()
+        return True
+
+    def claim(self, attempt):
+        with self.lock:
+            if self.winner is None:
+                self.winner = attempt
+                self.deadline = None
+            won = self.winner == attempt
+        self.changed.set()
+        return won
+
+    def wait_timeout(self):
+        # Seconds until the hedge is due; None (wait for a change) once there is
+        # a winner or no hedge pending.
+        with self.lock:
+            if self.winner is not None or self.deadline is None:
+                return None
+            return max(0.0, self.deadline - time.perf_counter())
+
+    def retry_model(self):
+        return self.models[self.last_failed]
+
+    def end(self, attempt, error=None):
+        with self.lock:
+            self.live.discard(attempt)
+            if attempt == self.winner:
+                self.finished = True
+            elif error is not None:
+                self.errors.append(error)
+                self.last_failed = attempt
+        self.changed.set()
+
+# Generation ids are unique across stream managers, since the tracer and the
+# connection warmer key answers by id for every server session at once.
+generation_ids = itertools.count(1)
+
+class StreamManager:
+    def __init__(self):
+        self.generation = 0  # Latest generation id handed out
+        self.started = 0
+        self.current_generation = 0
+        self.lock = threading.RLock()  # Re-entrant: _discard may run while it is held
+        self.current_thread = None
+        self.responses = {}  # gen -> {attempt: open response stream}, so they can be closed on cancel
+        # Speculative state: a generation started from interim text that buffers
+        # its tokens until the final transcript confirms (or rejects) it.
+        self.speculative = None
+        self.speculative_count = 0
+        # Interim text waiting out SPECULATIVE_STABLE_MS: each new word of a
+        # question that is still going on restarts the wait, not a generation.
+        self.pending_speculation = None
+        self.speculation_timer = None
+        self.interim_words = None
+        self.interim_at = None
+        self.interim_gaps = collections.deque(maxlen=20)  # ms between interim updates that added words
+        self.promoted_transcript = None
+        self.promoted_turn = None  # STT turn_order the promoted answer belongs to
+        # A follow-up ("why is that?") depends on the previous answer, so it is
+        # never answered from, or stored in, the answer cache.
+        self.current_follow_up = False
+        # Text on screen for the current generation, so a question that goes on
+        # after a pause can be continued from it (see continue_stream).
+        self.shown = []
+        self.delivered = 0  # Tokens the current generation itself has put on screen
+        self.continuations = {}  # gen -> {"shown": text, "recorded": already in history}
+        self.wasted = collections.Counter()  # superseded generations by reason ("continued" ones kept their text)
+
+    def start_new_stream(self, transcript, follow_up=False):
+        # Runs on the STT callback thread, so it must never wait on the old stream.
+        cached = answer_cache.lookup(transcript) if ANSWER_CACHE_MODE and not follow_up else None
+        if cached is None and PREWARM_MODE and not follow_up:
+            cached = answer_bank.lookup(transcript)
+        # 1. Bump generation to invalidate any in-flight stream; the queue drops
+        #    anything older from here on.
+        with self.lock:
+            old_gen = self.current_generation
+            gen = self._next_generation()
+            self.current_generation = gen
+            self.current_follow_up = follow_up
+            self.shown = []
+            self.delivered = 0
+            answer_queue.begin_generation(gen)
+            old_spec = self.speculative
+            self.speculative = None
+            self._drop_pending()
+            self.promoted_transcript = None
+        turn_tracer.begin(gen, transcript)
+        if old_spec:
+            self.wasted["speculative"] += 1
+            self._discard(old_spec["gen"], old_spec["thread"])
+        
+        # 2. Close the old stream's HTTP connection right away
+        is_interrupting = self._is_running(self.current_thread)
+        if is_interrupting:
+            self.wasted["restarted"] += 1
+            self._discard(old_gen, self.current_thread)
+            
+        # 3. If we interrupted, tell UI to wipe the previous partial turn
+        if is_interrupting:
+             answer_queue.put({"type": "remove_last_turn", "gen": gen})
+        
+        # 4. Show a cached answer at once, or start the new thread
+        if cached is not None:
+            self.current_thread = None
+            self._serve_cached(transcript, gen, cached)
+            return
+        self.current_thread = self._spawn(transcript, gen)
+
+    def _next_generation(self):
+        # Caller holds the lock.
+        self.generation = next(generation_ids)
+        self.started += 1
+        return self.generation
+
+    def _serve_cached(self, transcript, gen, answer):
+        if DEBUG_MODE:
+            print(f"[DEBUG] Answer cache hit: {transcript[:100]}")
+        turn_tracer.update(gen, source="cache")
+        turn_tracer.mark(gen, "first_token")
+        turn_tracer.mark(gen, "last_token")
+        turn_tracer.ended(gen)
+        answer_queue.put({"type": "new_turn", "gen": gen, "content": f"\n\n{transcript}\n\n"})
+        answer_queue.put({"type": "text", "gen": gen, "content": answer})
+        with self.lock:
+            if gen == self.current_generation:
+                self.shown = [answer]
+                self.delivered = 1
+        add_to_history(transcript, answer)
+        if ANSWER_CACHE_REFRESH:
+            threading.Thread(target=contextvars.copy_context().run, args=(self._refresh_cached, transcript),
+                             daemon=True).start()
+
+    def _refresh_cached(self, transcript):
+        # Regenerates a cached answer off screen so the next hit reflects the
+        # latest conversation.
+        try:
+            args = self._request_args(prompt_builder.build_input(transcript))
+            response = client.responses.create(**args)
+            prompt_builder.record_usage(response.usage)
+            answer_cache.store(transcript, response.output_text)
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"[DEBUG] Answer cache refresh failed: {e}")
+
+    def offer_speculative(self, transcript, complete):
+        # Called on every interim transcript; `complete` if it looks like a
+        # finished question. That text is speculated on once no new words have
+        # come for _stable_ms().
+        with self.lock:
+            words = normalize_words(transcript)
+            self._interim_changed(words)
+            if complete and self.pending_speculation is not None and (
+                    words == normalize_words(self.pending_speculation)):
+                return
+            self._drop_pending()
+            spec = self.speculative
+            if not complete or (spec and transcripts_match(spec["transcript"], transcript)):
+                return
+            self.pending_speculation = transcript
+            self.speculation_timer = threading.Timer(self._stable_ms() / 1000.0, contextvars.copy_context().run,
+                                                     args=(self._speculate_pending,))
+            self.speculation_timer.daemon = True
+            self.speculation_timer.start()
+
+    def _interim_changed(self, words):
+        # Learns the speaker's pace from interim updates that added words; a
+        # gap over a second is a pause, not pace.
+        now = time.perf_counter()
+        if words != self.interim_words:
+            if self.interim_at is not None and now - self.interim_at < 1.0:
+                self.interim_gaps.append((now - self.interim_at) * 1000)
+            self.interim_at = now
+            self.interim_words = words
+
+    def _stable_ms(self):
+        if not self.interim_gaps:
+            return SPECULATIVE_STABLE_MS
+        gaps = sorted(self.interim_gaps)
+        return max(SPECULATIVE_STABLE_MS, SPECULATIVE_STABLE_FACTOR * gaps[len(gaps) // 2])
+
+    def _drop_pending(self):
+        # Caller holds self.lock.
+        self.pending_speculation = None
+        if self.speculation_timer is not None:
+            self.speculation_timer.cancel()
+            self.speculation_timer = None
+
+    def _speculate_pending(self):
+        with self.lock:
+            transcript, self.pending_speculation = self.pending_speculation, None
+            self.speculation_timer = None
+            if transcript is not None:
+                self.start_speculative(transcript)
+
+    def start_speculative(self, transcript):
+        # Starts (or restarts) a background generation without touching what is
+        # on screen.
+        with self.lock:
+            spec = self.speculative
+            if spec and transcripts_match(spec["transcript"], transcript):
+                return
+            if self.speculative_count >= SPECULATIVE_MAX_PER_TURN:
+                return
+            if spec:
+                self.wasted["speculative"] += 1
+                self._discard(spec["gen"], spec["thread"])
+            self.speculative_count += 1
+            gen = self._next_generation()
+            spec = {
+                "gen": gen, "transcript": transcript, "tokens": [],
+                "done": False, "response": "", "error": None,
+            }
+            self.speculative = spec
+            turn_tracer.begin(gen, transcript, speculative=True)
+            spec["thread"] = self._spawn(transcript, gen, spec)
+        if DEBUG_MODE:
+            print(f"\n[DEBUG] Speculating on: {transcript}")
+
+    def _spawn(self, transcript, gen, spec=None):
+        thread = threading.Thread(
+            target=self.generate_and_stream_response,
+            args=(transcript, gen, spec),
+            daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _is_running(self, worker):
+        return worker is not None and worker.is_alive()
+
+    def _discard(self, gen, worker):
+        # Stop a superseded worker without waiting: closing its responses shuts the
+        # sockets, so the blocked reads fail at once and the threads exit quietly.
+        with self.lock:
+            self.continuations.pop(gen, None)
+            response_streams = self.responses.pop(gen, {})
+        self._close_streams(response_streams.values())
+
+    def _close_streams(self, response_streams):
+        closed = False
+        for response_stream in response_streams:
+            closed = True
+            try:
+                response_stream.close()
+            except Exception:
+                pass
+        if closed:
+            connection_warmer.stream_closed()
+
+    def _attach(self, gen, spec, response_stream, attempt=0):
+        # Registers the open stream for _discard; False if it was superseded while
+        # the request was being sent.
+        with self.lock:
+            if not self._is_wanted(gen, spec):
+                return False
+            self.responses.setdefault(gen, {})[attempt] = response_stream
+            return True
+
+    def _detach(self, gen, attempt):
+        with self.lock:
+            response_streams = self.responses.get(gen)
+            if response_streams is not None:
+                response_streams.pop(attempt, None)
+                if not response_streams:
+                    del self.responses[gen]
+
+    def _stop_losers(self, gen, race, winner):
+        with self.lock:
+            response_streams = self.responses.get(gen, {})
+            losers = [response_streams.pop(a) for a in list(response_streams) if a != winner]
+        self._close_streams(losers)
+
+    def cancel_speculative(self):
+        with self.lock:
+            spec = self.speculative
+            self.speculative = None
+            self.speculative_count = 0
+            self._drop_pending()
+        if spec:
+            self.wasted["speculative"] += 1
+            self._discard(spec["gen"], spec["thread"])
+
+    def promote_speculative(self, transcript, follow_up=False, turn=None):
+        # Called on end_of_turn. Returns True if a speculative answer (or the one
+        # already promoted for this same turn) matches the final transcript and
+        # was kept on screen. A later turn repeating the question gets its own answer.
+        with self.lock:
+            self.speculative_count = 0
+            self._drop_pending()
+            if (self.promoted_transcript and self.promoted_turn == turn
+                    and transcripts_match(self.promoted_transcript, transcript)):
+                return True
+            spec = self.speculative
+            self.speculative = None
+            if not spec or spec["error"] or not transcripts_match(spec["transcript"], transcript):
+                if spec:
+                    self.wasted["speculative"] += 1
+                    self._discard(spec["gen"], spec["thread"])
+                return False
+
+            # Swap the speculative generation in and flush its buffered tokens while
+            # holding the lock, so its thread cannot deliver ahead of the header.
+            gen = spec["gen"]
+            old_gen, old_thread = self.current_generation, self.current_thread
+            is_interrupting = self._is_running(old_thread)
+            self.current_generation = gen
+            self.current_follow_up = follow_up
+            self.current_thread = spec["thread"]
+            self.promoted_transcript = transcript
+            self.promoted_turn = turn
+            self.shown = list(spec["tokens"])
+            self.delivered = len(spec["tokens"])
+            spec["transcript"] = transcript
+            answer_queue.begin_generation(gen)
+            if is_interrupting:
+                answer_queue.put({"type": "remove_last_turn", "gen": gen})
+            answer_queue.put({"type": "new_turn", "gen": gen, "content": f"\n\n{transcript}\n\n"})
+            for token in spec["tokens"]:
+                answer_queue.put({"type": "text", "gen": gen, "content": token})
+            spec["tokens"] = []
+            finished_response = spec["response"] if spec["done"] else ""
+
+        if is_interrupting:
+            self.wasted["restarted"] += 1
+            self._discard(old_gen, old_thread)
+        if finished_response.strip():
+            add_to_history(transcript, finished_response)
+            if ANSWER_CACHE_MODE and not follow_up:
+                answer_cache.store(transcript, finished_response)
+        if DEBUG_MODE:
+            print(f"[DEBUG] Kept speculative answer (gen {gen}).")
+        return True
+
+    def _is_wanted(self, gen, spec):
+        return gen == self.current_generation or (spec is not None and self.speculative is spec)
+
+    def continue_stream(self, question, follow_up=False):
+        # The speaker went on after the turn ended ("walk me through your
+        # monitoring setup, ... for a Kubernetes cluster"). Whatever is already on
+        # screen stays, and a new generation picks up from it with the full
+        # question; nothing shown yet means the answer simply restarts.
+        with self.lock:
+            old_gen, old_thread = self.current_generation, self.current_thread
+            shown = "".join(self.shown)
+            gen = self._next_generation()
+            self.current_generation = gen
+            self.current_follow_up = follow_up
+            answer_queue.begin_generation(gen)
+            old_spec = self.speculative
+            self.speculative = None
+            self.speculative_count = 0
+            self._drop_pending()
+            self.promoted_transcript = None
+            is_interrupting = self._is_running(old_thread)
+            produced = self.delivered > 0
+            self.delivered = 0
+            if shown.strip():
+                # A finished answer is already in history; a cut-off one is recorded with the rest.
+                self.continuations[gen] = {"shown": shown, "recorded": not is_interrupting,
+                                           "separator": "" if shown.endswith("\n") else "\n"}
+                self.shown = [shown]
+            else:
+                self.shown = []
+        turn_tracer.begin(gen, question)
+        turn_tracer.update(gen, continued=bool(shown.strip()))
+        if old_spec:
+            self.wasted["speculative"] += 1
+            self._discard(old_spec["gen"], old_spec["thread"])
+        if is_interrupting:
+            self.wasted["continued" if produced else "merged"] += 1
+            self._discard(old_gen, old_thread)
+        if not shown.strip():
+            answer_queue.put({"type": "remove_last_turn", "gen": gen})
+        self.current_thread = self._spawn(question, gen)
+
+    def report(self):
+        wasted = {reason: count for reason, count in self.wasted.items() if reason != "continued"}
+        if self.started:
+            detail = ", ".join(f"{count} {reason}" for reason, count in sorted(wasted.items()))
+            print(f"[INFO] Generations: {self.started} started, {sum(wasted.values())} wasted"
+                  f"{f' ({detail})' if detail else ''}, {self.wasted['continued']} continued mid-answer.")
+
+    def _deliver_token(self, gen, token, spec):
+        with self.lock:
+            if gen == self.current_generation:
+                continuation = self.continuations.get(gen)
+                if continuation and continuation["separator"]:
+                    token = continuation["separator"] + token
+                    continuation["separator"] = ""
+                answer_queue.put({"type": "text", "gen": gen, "content": token})
+                self.shown.append(token)
+                self.delivered += 1
+                return True
+            if spec is not None and self.speculative is spec:
+                spec["tokens"].append(token)
+                return True
+            return False
+
+    def generate_and_stream_response(self, transcript, gen, spec=None):
+        # The generation's worker: runs the race between the request, its hedge
+        # and any retries (each on its own thread) until one has streamed the
+        # whole answer or the turn is superseded.
+        prompt_input = self._begin_response(transcript, gen, spec)
+        if prompt_input is None:
+            return
+        race = AnswerRace(threading.Event())
+        try:
+            self._launch_attempt(race, AI_MODEL, gen, spec, transcript, prompt_input)
+            while True:
+                race.changed.clear()
+                step = self._next_step(race, gen, spec)
+                if step == "wait":
+                    race.changed.wait(race.wait_timeout())
+                elif step == "hedge":
+                    self._hedge(race, gen, spec, transcript, prompt_input)
+                elif step == "retry":
+                    time.sleep(self._before_retry(race))
+                    if self._is_wanted(gen, spec):
+                        self._launch_attempt(race, race.retry_model(), gen, spec, transcript, prompt_input)
+                elif step == "fail":
+                    self._fail_response(gen, spec, race.errors[-1])
+                    return
+                else:
+                    return
+        finally:
+            connection_warmer.request_done(gen)
+            turn_tracer.ended(gen)
+
+    def _spawn_attempt(self, race, attempt, gen, spec, transcript, prompt_input):
+        # Run in a copy of this context so the attempt's requests keep
+        # llm_request_gen (cold/warm tracking) and, in server mode, the session.
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._stream_attempt, race, attempt, gen, spec, transcript, prompt_input),
+            daemon=True
+        ).start()
+
+    def _stream_attempt(self, race, attempt, gen, spec, transcript, prompt_input):
+        model = race.models[attempt]
+        response_parts = []
+        error = None
+        try:
+            request_args = self._request_args(prompt_input, model)
+            with client.with_options(max_retries=0).responses.stream(**request_args) as response_stream:
+                if not self._attach(gen, spec, response_stream, attempt):
+                    return
+                
+                if DEBUG_MODE:
+                    print(f"[DEBUG] Stream started ({model})...")
+                for event in response_stream:
+                    if not self._handle_event(event, gen, spec, response_parts, race, attempt):
+                        return
+            
+            if race.claim(attempt):
+                self._finish_response(transcript, gen, spec, "".join(response_parts))
+        except Exception as e:
+            error = e
+            self._attempt_failed(race, attempt, gen, spec, e)
+        finally:
+            self._detach(gen, attempt)
+            race.end(attempt, error)
+
+    # Race policy, shared by both engines.
+    def _launch_attempt(self, race, model, gen, spec, transcript, prompt_input, hedge=False):
+        # One hedge per answer: until it is sent, each new request gets a deadline.
+        attempt = race.add(model)
+        model_stats.count(model, "requests")
+        if hedge:
+            race.hedge = attempt
+            race.deadline = None
+        elif HEDGE_MODE and race.hedge is None:
+            race.deadline = time.perf_counter() + model_stats.deadline_ms(model) / 1000
+        self._spawn_attempt(race, attempt, gen, spec, transcript, prompt_input)
+        return attempt
+
+    def _next_step(self, race, gen, spec):
+        # What the race needs now: "wait", "hedge", "retry", "fail" or "done".
+        if not self._is_wanted(gen, spec):
+            return "done"
+        with race.lock:
+            if race.finished:
+                return "done"
+            if race.winner is not None:
+                return "wait"
+            if not race.live:
+                if not race.errors:
+                    return "done"
+                if race.retries < LLM_MAX_RETRIES and is_transient_error(race.errors[-1]):
+                    return "retry"
+                return "fail"
+        if race.deadline is not None and time.perf_counter() >= race.deadline:
+            return "hedge"
+        return "wait"
+
+    def _hedge(self, race, gen, spec, transcript, prompt_input):
+        primary = race.models[0]
+        model_stats.count(primary, "hedges")
+        if DEBUG_MODE:
+            print(f"[DEBUG] No first token from {primary} in {model_stats.deadline_ms(primary):.0f} ms; sending a backup request.")
+        self._launch_attempt(race, HEDGE_BACKUP_MODEL or AI_MODEL, gen, spec, transcript, prompt_input, hedge=True)
+
+    def _before_retry(self, race):
+        # Returns the jittered delay before the next retry.
+        delay = retry_delay(race.retries)
+        race.retries += 1
+        print(f"[WARN] OpenAI request failed ({race.errors[-1]}); retry {race.retries}/{LLM_MAX_RETRIES} "
+              f"in {delay * 1000:.0f} ms.")
+        return delay
+
+    def _attempt_failed(self, race, attempt, gen, spec, e):
+        # A failure after winning is the answer's failure; before that, the race decides.
+        if race.winner == attempt:
+            self._fail_response(gen, spec, e)
+        elif race.winner is None and self._is_wanted(gen, spec):
+            model_stats.count(race.models[attempt], "errors")
+            if DEBUG_MODE:
+                print(f"[DEBUG] {race.models[attempt]} request failed: {e}")
+
+    # Shared by the thread and asyncio engines: everything except how the
+    # request is awaited.
+    def _begin_response(self, transcript, gen, spec):
+        if not self._is_wanted(gen, spec):
+            turn_tracer.ended(gen)
+            return None
+        if DEBUG_MODE:
+            print(f"[DEBUG] Sending to OpenAI (Stream): {transcript[:100]}...")
+        
+        # Send the question as a clean header; avoid extra labels/separators
+        # (speculative answers get theirs when promoted, continued ones keep theirs).
+        with self.lock:
+            continuation = self.continuations.get(gen)
+        if spec is None and continuation is None:
+            answer_queue.put({
+                "type": "new_turn",
+                "gen": gen,
+                "content": f"\n\n{transcript}\n\n"
+            })
+        
+        turn_tracer.mark(gen, "prompt_started")
+        prompt_input = prompt_builder.build_input(
+            transcript, continue_from=continuation["shown"] if continuation else None)
+        turn_tracer.prompt_built(gen, prompt_input)
+        turn_tracer.mark(gen, "request_sent")
+        connection_warmer.request_sent(gen)
+        return prompt_input
+
+    def warm_connection(self):
+        client.models.retrieve(AI_MODEL, timeout=10)
+
+    def _request_args(self, prompt_input, model=AI_MODEL):
+        return {
+            "model": model,
+            "input": prompt_input,
+            "max_output_tokens": 120,
+            "temperature": 0.1,
+            "extra_body": {"prompt_cache_key": PROMPT_CACHE_KEY},
+        }
+
+    def _handle_event(self, event, gen, spec, response_parts, race, attempt):
+        # Returns False once a newer turn has started, or another request of the
+        # race won, and the stream should stop.
+        if not self._is_wanted(gen, spec):
+            return False
+
+        if event.type == "response.output_text.delta":
+            token = event.delta
+            if token:
+                if not response_parts:
+                    if not race.got_token(attempt):
+                        return False
+                    self._stop_losers(gen, race, attempt)
+                    if attempt == race.hedge:
+                        model_stats.count(race.models[attempt], "hedge_wins")
+                    connection_warmer.first_token(gen)
+                    turn_tracer.mark(gen, "first_token")
+                    turn_tracer.update(gen, model=race.models[attempt], attempts=len(race.models))
+                turn_tracer.mark(gen, "last_token", last=True)
+                response_parts.append(token)
+                
+                # SAFETY: Prevent "split-brain" double answers
+                # If the model tries to output "Direct Answer" a second time, cut it off.
+                # (Removed strict check as prompt no longer uses "Direct Answer" header)
+                # if full_response_so_far.count("Direct Answer") > 1: ...
+
+                return self._deliver_token(gen, token, spec)
+        elif event.type == "response.completed":
+            prompt_builder.record_usage(event.response.usage)
+            turn_tracer.usage(gen, event.response.usage)
+        return True
+
+    def _finish_response(self, transcript, gen, spec, response_text):
+        if DEBUG_MODE:
+            print("[DEBUG] Stream finished.")
+        turn_tracer.update(gen, completed=True)
+        with self.lock:
+            is_current = gen == self.current_generation
+            follow_up = self.current_follow_up
+            continuation = self.continuations.pop(gen, None)
+            if continuation:
+                # History and cache keep the whole answer to the whole question,
+                # unless the first part was already recorded on its own.
+                cached_text = continuation["shown"] + "\n" + response_text
+                if not continuation["recorded"]:
+                    response_text = cached_text
+            else:
+                cached_text = response_text
+            if spec is not None:
+                spec["done"] = True
+                spec["response"] = response_text
+                transcript = spec["transcript"]
+        if is_current and response_text.strip():
+            add_to_history(transcript, response_text)
+        if ANSWER_CACHE_MODE and is_current and not follow_up:
+            answer_cache.store(transcript, cached_text)
+
+    def _fail_response(self, gen, spec, e):
+        if spec is not None:
+            spec["error"] = e
+        if self._is_wanted(gen, spec):
+            turn_tracer.update(gen, error=str(e))
+        if gen == self.current_generation: # Only report error if we weren't cancelled
+            print(f"[ERROR] OpenAI error: {e}")
+            answer_queue.put({"type": "error", "gen": gen, "content": f"\n[AI Error: {str(e)}]"})
+
+stream_manager = StreamManager()
+
+# ========================
+# Tracing & Metrics
+# ========================
+
+TRACE_INTERVALS = [
+    # (name, from mark, to mark) reported per turn and as rolling percentiles
+    ("audio_to_eot", "audio_sent", "end_of_turn"),
+    ("prompt_build", "prompt_started", "prompt_built"),
+    ("eot_to_request", "end_of_turn", "request_sent"),
+    ("ttft", "request_sent", "first_token"),
+    ("eot_to_first_token", "end_of_turn", "first_token"),
+    ("eot_to_first_render", "end_of_turn", "first_render"),
+    ("eot_to_last_render", "end_of_turn", "last_render"),
+    ("generation", "first_token", "last_token"),
+]
+
+class TurnTracer:
+    # One trace per answer generation: perf_counter marks for each pipeline step
+    # plus prompt size and token usage. Callers only update a dict under a lock;
+    # a background thread finalizes traces once their stream has ended and the
+    # last tokens had time to render, appends them to TRACE_PATH as JSONL and
+    # keeps the last TRACE_WINDOW answered turns for rolling percentiles.
+    SETTLE_S = 1.0  # Wait after the last mark before a trace is written
+    SPEC_WAIT_S = 10.0  # A finished speculative answer may still be promoted this long
+
+    def __init__(self, path=TRACE_PATH, window=TRACE_WINDOW):
+        self.path = path
+        self.lock = threading.Lock()
+        self.open = {}  # gen -> trace
+        self.recent = collections.deque(maxlen=window)  # intervals of answered turns
+        self.counts = collections.Counter()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, daemon=True)
+            self.thread.start()
+        return self
+
+    def begin(self, gen, question, speculative=False):
+        with self.lock:
+            self.open[gen] = {
+                "gen": gen, "ts": time.time(), "t0": time.perf_counter(), "question": question,
+                "speculative": speculative, "source": "llm", "marks": {}, "ended": None,
+            }
+
+    def mark(self, gen, name, t=None, last=False):
+        # First occurrence wins unless last=True (last token / last render).
+        t = t if t is not None else time.perf_counter()
+        with self.lock:
+            trace = self.open.get(gen)
+            if trace is not None and (last or name not in trace["marks"]):
+                trace["marks"][name] = t
+
+    def update(self, gen, **fields):
+        with self.lock:
+            trace = self.open.get(gen)
+            if trace is not None:
+                trace.update(fields)
+
+    def end_of_turn(self, gen, t, audio_sent, question):
+        with self.lock:
+            trace = self.open.get(gen)
+            if trace is None:
+                return
+            trace["marks"].setdefault("end_of_turn", t)
+            if audio_sent is not None:
+                trace["marks"].setdefault("audio_sent", audio_sent)
+            trace["question"] = question
+
+    def prompt_built(self, gen, prompt_input):
+        serialized = json.dumps(prompt_input)
+        self.mark(gen, "prompt_built")
+        self.update(gen, prompt_chars=len(serialized), prompt_tokens_est=estimate_tokens(serialized))
+
+    def usage(self, gen, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "input_tokens_details", None)
+        self.update(gen, usage={
+            "input_tokens": usage.input_tokens or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "output_tokens": usage.output_tokens or 0,
+        })
+
+    def ended(self, gen):
+        self.update(gen, ended=time.perf_counter())
+
+    def rendered(self, gens, t):
+        with self.lock:
+            for gen in gens:
+                trace = self.open.get(gen)
+                if trace is not None:
+                    trace["marks"].setdefault("first_render", t)
+                    trace["marks"]["last_render"] = t
+
+    def _ready(self, now):
+        with self.lock:
+            ready = []
+            for gen, trace in list(self.open.items()):
+                if trace["ended"] is None:
+                    continue
+                latest = max([trace["ended"]] + list(trace["marks"].values()))
+                wait = self.SETTLE_S if "end_of_turn" in trace["marks"] else self.SPEC_WAIT_S
+                if now - latest >= wait:
+                    ready.append(self.open.pop(gen))
+            return ready
+
+    def _finalize(self, trace):
+        marks = trace["marks"]
+        if trace.get("error"):
+            outcome = "error"
+        elif "end_of_turn" not in marks:
+            outcome = "discarded"
+        elif trace["source"] != "llm":
+            outcome = trace["source"]
+        elif trace.get("completed"):
+            outcome = "answered"
+        else:
+            outcome = "cancelled"
+        intervals = {}
+        for name, start, end in TRACE_INTERVALS:
+            if start in marks and end in marks:
+                intervals[name] = round((marks[end] - marks[start]) * 1000, 1)
+        record = {key: trace[key] for key in ("gen", "ts", "question", "speculative", "source")}
+        record["outcome"] = outcome
+        for key in ("kind", "continued", "input_source", "model", "attempts", "prompt_chars", "prompt_tokens_est", "usage", "error"):
+            if key in trace:
+                record[key] = trace[key]
+        record["marks_ms"] = {name: round((t - trace["t0"]) * 1000, 1)
+                              for name, t in sorted(marks.items(), key=lambda item: item[1])}
+        record["intervals_ms"] = intervals
+        with self.lock:
+            self.counts[outcome] += 1
+            if outcome in ("answered", "cache"):
+                self.recent.append(intervals)
+        return record
+
+    def _writer(self):
+        out = None
+        while True:
+            time.sleep(0.5)
+            records = [self._finalize(trace) for trace in self._ready(time.perf_counter())]
+            if not records or not self.path:
+                continue
+            try:
+                if out is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    out = open(self.path, "a", encoding="utf-8")
+                out.write("".join(json.dumps(record) + "\n" for record in records))
+                out.flush()
+            except OSError as e:
+                print(f"[WARN] Trace file disabled: {e}")
+                self.path = None
+
+    def percentiles(self, pcts=(50, 95)):
+        # {interval: {"n": count, 50: ms, 95: ms}} over the rolling window.
+        with self.lock:
+            recent = list(self.recent)
+        stats = {}
+        for name, _, _ in TRACE_INTERVALS:
+            values = sorted(intervals[name] for intervals in recent if name in intervals)
+            if values:
+                stats[name] = {"n": len(values)}
+                for pct in pcts:
+                    stats[name][pct] = values[min(len(values) - 1, int(len(values) * pct / 100))]
+        return stats
+
+    def summary_text(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lines = ["turns " + "  ".join(f"{outcome} {n}" for outcome, n in sorted(counts.items()))]
+        for name, stats in self.percentiles().items():
+            lines.append(f"{name:<20} p50 {stats[50]:>7.0f}  p95 {stats[95]:>7.0f} ms  n={stats['n']}")
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lines = ["# TYPE stealth_copilot_turns_total counter"]
+        for outcome, n in sorted(counts.items()):
+            lines.append(f'stealth_copilot_turns_total{{outcome="{outcome}"}} {n}')
+        lines.append("# TYPE stealth_copilot_latency_ms summary")
+        for name, stats in self.percentiles((50, 95, 99)).items():
+            for pct in (50, 95, 99):
+                lines.append(f'stealth_copilot_latency_ms{{interval="{name}",quantile="{pct / 100}"}} {stats[pct]}')
+            lines.append(f'stealth_copilot_latency_ms_count{{interval="{name}"}} {stats["n"]}')
+        return "\n".join(lines) + "\n"
+
+turn_tracer = TurnTracer()
+
+def start_metrics_server(port):
+    # Local-only endpoint: /metrics in Prometheus text format, /metrics.json as JSON.
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = turn_tracer.prometheus_text().encode(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(turn_tracer.percentiles((50, 95, 99))).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as e:
+        print(f"[ERROR] Metrics endpoint failed to start: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics at http://127.0.0.1:{port}/metrics")
+    return server
+
+# ========================
+# Session Persistence
+# ========================
+
+class SessionStore:
+    # SQLite copy of the session (settings, uploaded documents, Q/A turns) so a
+    # restart mid-interview picks up where it left off. Callers only enqueue
+    # changes; a writer thread applies everything queued within SESSION_FLUSH_MS
+    # in one transaction, so the answer path never waits on the disk.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, started_at REAL, updated_at REAL);
+        CREATE TABLE IF NOT EXISTS settings (session_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (session_id, key));
+        CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, session_id INTEGER, name TEXT, text TEXT);
+        CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY, session_id INTEGER, question TEXT, answer TEXT, created_at REAL);
+        CREATE INDEX IF NOT EXISTS turns_by_session ON turns (session_id, id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.session_id = None
+        self.ops = queue.Queue()
+        self.ready = threading.Event()
+        self.failed = False  # open() failed: writes are dropped instead of queued
+        self.stats = {"batches": 0, "writes": 0}
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self):
+        # Picks the session to continue and returns its saved state, or None for a
+        # fresh start. A recent session is resumed as is; an older one only lends
+        # its settings and documents to a new session.
+        conn = None
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = self._connect()
+            conn.executescript(self.SCHEMA)
+            now = time.time()
+            last = conn.execute("SELECT id, updated_at FROM sessions ORDER BY id DESC LIMIT 1").fetchone()
+            with conn:
+                if last and now - last[1] < SESSION_RESUME_HOURS * 3600:
+                    self.session_id = last[0]
+                    resumed = True
+                else:
+                    self.session_id = conn.execute("INSERT INTO sessions VALUES (NULL, ?, ?)", (now, now)).lastrowid
+                    resumed = False
+                    if last:
+                        conn.execute("INSERT INTO settings SELECT ?, key, value FROM settings "
+                                     "WHERE session_id = ? AND key != 'memory_summary'", (self.session_id, last[0]))
+                        conn.execute("INSERT INTO documents (session_id, name, text) SELECT ?, name, text FROM documents "
+                                     "WHERE session_id = ? ORDER BY id", (self.session_id, last[0]))
+            self.ready.set()
+            if not last:
+                return None
+            sid = self.session_id
+            return {
+                "resumed": resumed,
+                "settings": dict(conn.execute("SELECT key, value FROM settings WHERE session_id = ?", (sid,))),
+                "documents": conn.execute("SELECT name, text FROM documents WHERE session_id = ? ORDER BY id", (sid,)).fetchall(),
+                "turns": conn.execute("SELECT question, answer FROM turns WHERE session_id = ? ORDER BY id", (sid,)).fetchall(),
+            }
+        finally:
+            if conn is not None:
+                conn.close()
+            if not self.ready.is_set():
+                # No session was picked, so the writer must not wait for one.
+                self._fail()
+
+    def _fail(self):
+        # Releases the writer, which then exits, and stops further queueing.
+        self.failed = True
+        self.ready.set()
+        with self.ops.mutex:
+            self.ops.queue.clear()
+
+    def enqueue(self, sql, args):
+        if not self.failed:
+            self.ops.put((sql, args))
+
+    # Each queued write is (sql, args); the session id is bound as the first parameter.
+    def set_setting(self, key, value):
+        self.enqueue("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)", (key, value))
+
+    def add_document(self, name, text):
+        self.enqueue("INSERT INTO documents (session_id, name, text) VALUES (?, ?, ?)", (name, text))
+
+    def clear_documents(self):
+        self.enqueue("DELETE FROM documents WHERE session_id = ?", ())
+
+    def add_turn(self, question, answer):
+        self.enqueue("INSERT INTO turns (session_id, question, answer, created_at) VALUES (?, ?, ?, ?)",
+                     (question, answer, time.time()))
+
+    def _writer(self):
+        self.ready.wait()
+        if self.failed:
+            return
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            print(f"[ERROR] Session store unavailable: {e}")
+            self._fail()
+            return
+        closing = False
+        while not closing:
+            batch = [self.ops.get()]
+            deadline = time.perf_counter() + SESSION_FLUSH_MS / 1000.0
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.ops.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            closing = None in batch
+            writes = [op for op in batch if op is not None]
+            if not writes:
+                continue
+            try:
+                with conn:
+                    for sql, args in writes:
+                        conn.execute(sql, (self.session_id,) + args)
+                    conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), self.session_id))
+                self.stats["batches"] += 1
+                self.stats["writes"] += len(writes)
+            except sqlite3.Error as e:
+                print(f"[ERROR] Session store write failed: {e}")
+        conn.close()
+
+    def close(self, timeout=2):
+        # Flushes what is queued; called on exit.
+        self.ops.put(None)
+        if self.ready.is_set():
+            self.thread.join(timeout)
+
+session_store = None
+
+# ========================
+# Audio / WebSocket
+# ========================
+
+class SessionRecorder:
+    # Writes the raw PCM sent to the STT service and every STT message received,
+    # stamped with the audio clock, so a session can be replayed offline.
+    def __init__(self, record_dir):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(record_dir, f"session-{stamp}")
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.audio_bytes = 0
+        self.audio_file = open(os.path.join(self.path, "audio.pcm"), "wb")
+        self.turns_file = open(os.path.join(self.path, "turns.jsonl"), "w", encoding="utf-8")
+
+    def audio_ms(self):
+        return self.audio_bytes * 1000 // (RATE * CHANNELS * 2)
+
+    def write_audio(self, data):
+        with self.lock:
+            self.audio_file.write(data)
+            self.audio_bytes += len(data)
+
+    def write_message(self, data):
+        with self.lock:
+            record = {"t_ms": self.audio_ms()}
+            record.update(data)
+            self.turns_file.write(json.dumps(record) + "\n")
+            self.turns_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.audio_file.close()
+            self.turns_file.close()
+
+session_recorder = None
+
+class TurnTracker:
+    # One deduplicated transcript per STT turn. Streaming partials are
+    # cumulative (each Turn message carries the turn so far), so a message
+    # replaces what is held for its turn_order instead of being appended. Words
+    # are merged by start time: anything from the new message's first word on
+    # is replaced, so revised non-final words and tail-only updates both land
+    # once. Each update is linear in the length of the turn.
+    KEEP_TURNS = 4  # A formatted final can arrive after the next turn has started
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = collections.OrderedDict()  # turn_order -> {"words": [...], "text": str}
+
+    def update(self, data):
+        # Returns the turn's text after this message.
+        order = data.get("turn_order")
+        words = data.get("words") or []
+        transcript = (data.get("transcript") or "").strip()
+        with self.lock:
+            turn = self.turns.get(order)
+            if turn is None:
+                turn = self.turns[order] = {"words": [], "text": ""}
+                while len(self.turns) > self.KEEP_TURNS:
+                    self.turns.popitem(last=False)
+            if words:
+                kept = turn["words"]
+                first = words[0].get("start")
+                cut = len(kept) if first is not None else 0
+                while cut and kept[cut - 1].get("start", 0) >= first:
+                    cut -= 1
+                del kept[cut:]
+                kept.extend(words)
+            if data.get("turn_is_formatted") and transcript:
+                # Punctuated and cased; it covers the whole turn.
+                turn["text"] = transcript
+            elif turn["words"]:
+                turn["text"] = " ".join(w.get("text", "") for w in turn["words"]).strip()
+            elif transcript:
+                turn["text"] = transcript
+            return turn["text"]
+
+    def reset(self):
+        # A new STT session restarts turn_order.
+        with self.lock:
+            self.turns.clear()
+
+turn_tracker = TurnTracker()
+
+def on_message(ws, message):
+    try:
+        data = json.loads(message)
+        if session_recorder:
+            session_recorder.write_message(data)
+        msg_type = data.get("type")
+
+        if msg_type == "Turn":
+            transcript = data.get("transcript", "")
+            end_of_turn = data.get("end_of_turn", False)
+            turn_text = turn_tracker.update(data)
+
+            if end_of_turn:
+                eot_at = time.perf_counter()
+                if ENDPOINT_MODE:
+                    endpointer.on_end_of_turn(data)
+                words = data.get("words") or []
+                stt_supervisor.turn_finished(words[-1].get("end") if words else None)
+                on_final_turn(data, turn_text, transcript, words, eot_at)
+            else:
+                if DEBUG_MODE:
+                    print(f"[DEBUG] Hearing: {turn_text}", end="\r", flush=True)
+                if ENDPOINT_MODE:
+                    endpointer.on_interim(data)
+                if TURN_MERGE_MODE:
+                    turn_assembler.on_interim(data.get("turn_order"))
+                # Partials are cumulative per turn, so the latest one is the question so far.
+                if SPECULATIVE_MODE:
+                    complete = looks_like_complete_question(transcript) and not (
+                        TURN_FILTER_MODE and turn_classifier.classify(
+                            transcript, data.get("words"), conversation_memory.recent_turns(2), log=False)[0] == "noise")
+                    stream_manager.offer_speculative(transcript, complete)
+
+        elif msg_type == "Begin":
+            print(f"[INFO] AssemblyAI session started: {data.get('id')}")
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"\n[DEBUG] Message error: {e}")
+
+def on_final_turn(data, question, transcript, words, eot_at):
+    # Tag mode: which input the turn's audio mostly came from.
+    source = audio_capture.take_source() if audio_capture else None
+    turn = data.get("turn_order")
+    how = "new"
+    if TURN_MERGE_MODE:
+        question, how = turn_assembler.add(turn, question, words)
+        if how == "repeat" and turn_assembler.settled(question):
+            # The same turn re-sent (the formatted final): a held question picks up
+            # the new text, and a running answer already fits it.
+            return
+    if TURN_FILTER_MODE:
+        kind, _ = turn_classifier.classify(question, words, conversation_memory.recent_turns(2))
+    else:
+        kind = "question" if len(question) > 10 else "noise"
+
+    if kind == "noise" and how == "new":
+        # Noise never interrupts the answer on screen; only a pending speculation is dropped.
+        stream_manager.cancel_speculative()
+        return
+    continued = False
+    if TURN_MERGE_MODE:
+        # A held question was never shown, so its merged version starts fresh.
+        held = turn_assembler.take_hold()
+        if how == "new":
+            turn_assembler.begin(turn, question, words)
+        elif held is None:
+            continued = how == "merged" or turn_assembler.continued
+        # Only a question nothing has been shown for yet is held.
+        if (how == "new" or held is not None) and turn_cue(question) == "incomplete":
+            turn_assembler.hold(lambda q: answer_turn(q, kind, eot_at, transcript, continued, source, turn))
+            return
+    answer_turn(question, kind, eot_at, transcript, continued, source, turn)
+
+def answer_turn(question, kind, eot_at, transcript, continued=False, source=None, turn=None):
+    print("\n" + "-" * 60)
+    print(f"Question ({source}): {question}" if source else f"Question: {question}")
+    follow_up = kind == "follow-up"
+    if continued:
+        stream_manager.continue_stream(question, follow_up)
+    # Keep a matching speculative answer; otherwise start (and safely cancel old) streams
+    elif not (SPECULATIVE_MODE and stream_manager.promote_speculative(transcript, follow_up, turn)):
+        stream_manager.start_new_stream(question, follow_up)
+    turn_tracer.end_of_turn(stream_manager.current_generation, eot_at,
+                            stt_supervisor.last_sent_at, question)
+    turn_tracer.update(stream_manager.current_generation, kind=kind)
+    if source:
+        turn_tracer.update(stream_manager.current_generation, input_source=source)
+    if TURN_MERGE_MODE:
+        turn_assembler.started_with(question, continued)
+
+def on_error(ws, error):
+    print(f"\n[ERROR] WebSocket error: {error}")
+
+def on_close(ws, close_status_code, close_msg):
+    print(f"\n[INFO] WebSocket closed.")
+
+def on_open(ws):
+    print("[INFO] WebSocket connected!")
+
+def find_capture_devices(p, names=None):
+    # Device info for each configured source, in AUDIO_SOURCES order. Without
+    # a list: VB-CABLE if installed, else the default input.
+    names = AUDIO_SOURCES if names is None else names
+    inputs = [dev for dev in (p.get_device_info_by_index(i) for i in range(p.get_device_count()))
+              if dev['maxInputChannels'] > 0]
+    if not names:
+        for dev in inputs:
+            if 'CABLE Output' in dev['name'] or 'VB-Audio' in dev['name']:
+                return [dev]
+        print("[WARN] VB-CABLE not found. Using default input.")
+        return [p.get_default_input_device_info()]
+    found = []
+    for name in names:
+        dev = next((d for d in inputs if name.lower() in d['name'].lower() and d not in found), None)
+        if dev is None:
+            print(f"[WARN] Audio input '{name}' not found.")
+        else:
+            found.append(dev)
+    return found
+
+class PolyphaseResampler:
+    # Downmix + rational resampling of fixed-size int16 blocks to RATE mono
+    # (48000 -> 16000 is 1/3, 44100 -> 16000 is 160/441). A Kaiser-windowed
+    # sinc low-pass is split into `up` phases; output sample n is the dot
+    # product of phase (n * down) % up with the input ending at (n * down) // up.
+    # Blocks hold a whole number of resampling periods, so every block yields
+    # the same number of samples and the gather indices and per-output taps are
+    # computed once. process() only writes into preallocated arrays and views,
+    # so a block allocates nothing.
+    CUTOFF = 0.85  # Pass band edge, as a fraction of the lower Nyquist frequency
+    KAISER_BETA = 7.0  # ~70 dB stop band
+
+    def __init__(self, in_rate, out_rate=RATE, channels=1, block_ms=AUDIO_BLOCK_MS, taps=RESAMPLE_TAPS):
+        g = math.gcd(in_rate, out_rate)
+        self.up, self.down = out_rate // g, in_rate // g
+        periods = max(1, round(in_rate * block_ms / 1000 / self.down))
+        self.block_frames = periods * self.down
+        self.out_frames = periods * self.up
+        self.channels = channels
+        self.passthrough = self.up == self.down
+        # Taps per phase, counted in input samples.
+        self.taps = 1 if self.passthrough else math.ceil(taps * max(1.0, in_rate / out_rate))
+        history = self.taps - 1
+        self.raw = np.zeros(self.block_frames * channels, dtype=np.int16)
+        self.raw_bytes = memoryview(self.raw.view(np.uint8))
+        self.frames = self.raw.reshape(self.block_frames, channels)
+        self.samples = np.zeros((self.block_frames, channels), dtype=np.float32)
+        # Downmix weights: an average, or a plain sum when the filter taps
+        # already carry the 1/channels gain.
+        self.weights = np.full(channels, 1.0 if not self.passthrough else 1.0 / channels, dtype=np.float32)
+        self.x = np.zeros(history + self.block_frames, dtype=np.float32)
+        self.mono = self.x[history:]
+        self.out = self.mono if self.passthrough else np.zeros(self.out_frames, dtype=np.float32)
+        if self.passthrough:
+            return
+        self.history_dst, self.history_src = self.x[:history], self.x[self.block_frames:]
+        length = self.taps * self.up
+        t = np.arange(length) - (length - 1) / 2
+        cutoff = self.CUTOFF * 0.5 / max(self.up, self.down)
+        h = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, self.KAISER_BETA)
+        h *= self.up / h.sum() / channels  # unity gain per phase; downmix is a plain sum
+        phases = h.reshape(self.taps, self.up).T
+        pos = np.arange(self.out_frames) * self.down
+        k = np.arange(self.taps)
+        self.index = (history + pos // self.up)[:, None] - k[None, :]
+        self.coef = np.ascontiguousarray(phases[pos % self.up], dtype=np.float32)
+        self.gathered = np.zeros_like(self.coef)
+        self.ones = np.ones(self.taps, dtype=np.float32)
+
+    def process(self, data):
+        # data: one block of interleaved int16 frames (bytes-like). Returns a
+        # float32 array in int16 scale, overwritten by the next call. (NumPy
+        # reductions with axis=, casting ufuncs and np.take(mode=...) allocate,
+        # so the downmix and the row sums are dots into preallocated outputs
+        # and the gather is the take method.)
+        self.raw_bytes[:] = data
+        np.copyto(self.samples, self.frames)
+        np.dot(self.samples, self.weights, out=self.mono)
+        if self.passthrough:
+            return self.out
+        self.x.take(self.index, out=self.gathered, mode="clip")
+        np.multiply(self.gathered, self.coef, out=self.gathered)
+        np.dot(self.gathered, self.ones, out=self.out)
+        # The block's tail is the next block's filter history.
+        np.copyto(self.history_dst, self.history_src)
+        return self.out
+
+class SampleFifo:
+    # Preallocated float32 jitter buffer between an extra capture source and
+    # the mix. Reads wait until `prime` samples are buffered (one mix block plus
+    # one of the source's own), so its block-sized bursts don't leave gaps; a
+    # source whose clock runs fast loses its oldest audio once full, one that
+    # runs slow is zero-padded for a block and primes again. Writes and reads
+    # are always one block of the source and of the mix, so they go through
+    # precomputed index arrays; put/take with mode="wrap" handle the wrap.
+    def __init__(self, block, read_block, prime, capacity):
+        self.buf = np.zeros(capacity, dtype=np.float32)
+        self.prime = prime
+        self.write_base = np.arange(block, dtype=np.intp)
+        self.write_index = np.zeros(block, dtype=np.intp)
+        self.read_base = np.arange(read_block, dtype=np.intp)
+        self.read_index = np.zeros(read_block, dtype=np.intp)
+        self.offset = np.zeros((), dtype=np.intp)
+        self.start = 0
+        self.size = 0
+        self.primed = False
+        self.dropped = 0
+        self.padded = 0
+
+    def write(self, samples):
+        capacity = len(self.buf)
+        n = len(samples)
+        excess = self.size + n - capacity
+        if excess > 0:
+            self.start = (self.start + excess) % capacity
+            self.size -= excess
+            self.dropped += excess
+        self.offset[...] = self.start + self.size
+        np.add(self.write_base, self.offset, out=self.write_index)
+        self.buf.put(self.write_index, samples, mode="wrap")
+        self.size += n
+
+    def read_into(self, out):
+        n = len(out)
+        if not self.primed and self.size >= self.prime:
+            self.primed = True
+        if not self.primed or self.size < n:
+            if self.primed:
+                self.padded += n
+                self.primed = False
+            out.fill(0)
+            return
+        self.offset[...] = self.start
+        np.add(self.read_base, self.offset, out=self.read_index)
+        self.buf.take(self.read_index, out=out, mode="wrap")
+        self.start = (self.start + n) % len(self.buf)
+        self.size -= n
+
+class CaptureSource:
+    # One input device opened at its native rate and channel count (asking
+    # PortAudio for 16 kHz mono makes many drivers convert slowly, or refuse).
+    # Each callback block is downmixed and resampled on the PortAudio thread
+    # and handed to the owning AudioCapture. Blocks of another size than
+    # requested are re-chunked through a preallocated buffer; the usual
+    # exact-size block is processed as delivered.
+    def __init__(self, owner, name, rate, channels, block_ms=AUDIO_BLOCK_MS):
+        self.owner = owner
+        self.name = name
+        self.rate = rate
+        self.channels = channels
+        self.resampler = PolyphaseResampler(rate, RATE, channels, block_ms)
+        self.block_bytes = self.resampler.block_frames * channels * 2
+        self.pending = memoryview(bytearray(self.block_bytes))
+        self.pending_len = 0
+        self.fifo = None  # Set by the owner for every source but the first
+        self.block = None  # Owner's per-source mix buffer
+        self.energy = None  # Tag mode: the block's energy, a 0-d view into the owner's array
+        self.stream = None
+
+    def open(self, p, device_index):
+        import pyaudio
+        self.overflow_flag = pyaudio.paInputOverflow
+        self.callback_result = (None, pyaudio.paContinue)
+        self.stream = p.open(format=pyaudio.paInt16, channels=self.channels, rate=self.rate, input=True,
+                             input_device_index=device_index, frames_per_buffer=self.resampler.block_frames,
+                             stream_callback=self._callback, start=False)
+        return self
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if status & self.overflow_flag:
+            self.owner.stats["overflow_events"] += 1
+        self.feed(in_data)
+        return self.callback_result
+
+    def feed(self, data):
+        if not self.pending_len and len(data) == self.block_bytes:
+            self.owner.mix_block(self, self.resampler.process(data))
+            return
+        data = memoryview(data)
+        block = self.block_bytes
+        while len(data):
+            if not self.pending_len and len(data) >= block:
+                self.owner.mix_block(self, self.resampler.process(data[:block]))
+                data = data[block:]
+                continue
+            n = min(block - self.pending_len, len(data))
+            self.pending[self.pending_len:self.pending_len + n] = data[:n]
+            self.pending_len += n
+            data = data[n:]
+            if self.pending_len == block:
+                self.pending_len = 0
+                self.owner.mix_block(self, self.resampler.process(self.pending))
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception:
+                pass
+
+class AudioCapture:
+    # PyAudio callback-mode capture into a preallocated ring buffer of RATE mono
+    # audio. Sources are opened at their native format (see CaptureSource); the
+    # first one drives the mix, and the others' resampled audio is taken from
+    # their jitter buffers on each of its blocks, summed ("mix") or reduced to
+    # the loudest source ("tag"; a change of source is crossfaded over one
+    # block so the switch doesn't click). The sender pulls AUDIO_PACKET_MS packets,
+    # or larger batches (up to AUDIO_MAX_PACKET_MS) when it has fallen behind. If
+    # the sender stalls long enough to fill the ring, the oldest audio is
+    # overwritten so latency stays bounded, and the loss is counted in stats.
+    # The mix and crossfade buffers, ring index arrays and clamp bounds are
+    # preallocated, and each block is written into them with out= operations.
+    TAG_SWITCH_RATIO = 2.0  # Tag mode: energy ratio (3 dB) another source needs to take over
+
+    def __init__(self, packet_ms=AUDIO_PACKET_MS, ring_seconds=AUDIO_RING_SECONDS):
+        self.bytes_per_ms = RATE * CHANNELS * 2 // 1000
+        self.frame_bytes = CHANNELS * 2
+        self.packet_bytes = packet_ms * self.bytes_per_ms
+        self.max_packet_bytes = max(self.packet_bytes, AUDIO_MAX_PACKET_MS * self.bytes_per_ms)
+        self.ring = bytearray(ring_seconds * 1000 * self.bytes_per_ms)
+        self.view = memoryview(self.ring)
+        self.ring_samples = np.frombuffer(self.ring, dtype=np.int16)
+        self.read_pos = 0
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.sources = []
+        self.mix_lock = threading.Lock()
+        self.source_ms = collections.Counter()  # Tag mode: ms each source was the loudest
+        self.tagged = None  # Tag mode: the source currently passed through
+        self.tag_floor = (32768 * 10 ** (VAD_MIN_DBFS / 20)) ** 2  # Mean square below which no source is tagged
+        self.stats = {
+            "captured_frames": 0, "dropped_frames": 0, "overflow_events": 0,
+            "packets_sent": 0, "max_backlog_ms": 0,
+        }
+
+    def start(self):
+        import pyaudio
+        p = pyaudio.PyAudio()
+        for dev in find_capture_devices(p):
+            rate = int(dev['defaultSampleRate'])
+            channels = min(int(dev['maxInputChannels']), 2)  # Beyond stereo, extra inputs are rarely the voice
+            try:
+                source = CaptureSource(self, dev['name'], rate, channels).open(p, dev['index'])
+            except Exception as e:
+                print(f"[WARN] Could not open audio device {dev['name']}: {e}")
+                continue
+            self.add_source(source)
+            print(f"[INFO] Using Audio Device: {dev['name']} ({rate} Hz, {channels} ch)")
+        if not self.sources:
+            raise RuntimeError("No audio input device could be opened")
+        for source in self.sources:
+            source.stream.start_stream()
+        return self
+
+    def add_source(self, source):
+        with self.mix_lock:
+            n = source.resampler.out_frames
+            if not self.sources:
+                self.mix = np.zeros(n, dtype=np.float32)
+                self.scratch = np.zeros(n, dtype=np.float32)
+                self.out = np.zeros(n, dtype=np.int16)
+                self.low = np.array(-32768, dtype=np.float32)
+                self.high = np.array(32767, dtype=np.float32)
+                self.ring_base = np.arange(n, dtype=np.intp)
+                self.ring_index = np.zeros(n, dtype=np.intp)
+                self.ring_offset = np.zeros((), dtype=np.intp)
+                # Linear ramps summing to one, so a voice picked up by both
+                # sources keeps its level through a tag-mode switch.
+                self.fade_in = ((np.arange(n) + 0.5) / n).astype(np.float32)
+                self.fade_out = (1 - self.fade_in).astype(np.float32)
+                self.block_ms = n * 1000 / RATE
+                self.tagged = source
+            else:
+                prime = len(self.mix) + n
+                source.fifo = SampleFifo(n, len(self.mix), prime, prime + AUDIO_MIX_SLACK_MS * RATE // 1000)
+            self.sources.append(source)
+            source.block = np.zeros(len(self.mix), dtype=np.float32)
+            self.energies = np.zeros(len(self.sources), dtype=np.float32)
+            for i, other in enumerate(self.sources):
+                other.energy = self.energies[i:i + 1].reshape(())
+        return source
+
+    def mix_block(self, source, samples):
+        # Called on each source's PortAudio thread with its resampled block.
+        if source.fifo is not None:
+            with self.mix_lock:
+                source.fifo.write(samples)
+            return
+        np.copyto(self.mix, samples)
+        if len(self.sources) > 1:
+            self._combine()
+        np.maximum(self.mix, self.low, out=self.mix)
+        np.minimum(self.mix, self.high, out=self.mix)
+        np.rint(self.mix, out=self.mix)
+        np.copyto(self.out, self.mix, casting="unsafe")
+        self.write_block()
+
+    def _combine(self):
+        with self.mix_lock:
+            if AUDIO_SOURCE_MODE == "tag":
+                self._tag()
+                return
+            for source in self.sources:
+                if source.fifo is not None:
+                    source.fifo.read_into(source.block)
+                    np.add(self.mix, source.block, out=self.mix)
+
+    def _tag(self):
+        # self.mix holds the first source's block on entry and the tagged
+        # source's on return. Another source takes over only when clearly
+        # louder, so two similar levels don't flap between sources.
+        np.copyto(self.sources[0].block, self.mix)
+        loudest = self.tagged
+        for source in self.sources:
+            if source.fifo is not None:
+                source.fifo.read_into(source.block)
+            np.dot(source.block, source.block, out=source.energy)
+            if float(source.energy) > float(loudest.energy):
+                loudest = source
+        if float(loudest.energy) <= self.TAG_SWITCH_RATIO * float(self.tagged.energy):
+            loudest = self.tagged
+        if loudest is self.tagged:
+            np.copyto(self.mix, loudest.block)
+        else:
+            np.multiply(self.tagged.block, self.fade_out, out=self.mix)
+            np.multiply(loudest.block, self.fade_in, out=self.scratch)
+            np.add(self.mix, self.scratch, out=self.mix)
+            self.tagged = loudest
+        if float(loudest.energy) > self.tag_floor * len(self.mix):
+            self.source_ms[loudest.name] += self.block_ms
+
+    def take_source(self):
+        # Tag mode: the source that was loudest for most of the audio since the
+        # previous call (None when untagged or silent).
+        with self.mix_lock:
+            tally, self.source_ms = self.source_ms, collections.Counter()
+        return tally.most_common(1)[0][0] if tally else None
+
+    def write_block(self):
+        # Appends the mixed block in self.out to the ring through a precomputed
+        # index array; put with mode="wrap" handles the wrap.
+        capacity = len(self.ring)
+        n = self.out.nbytes
+        with self.cond:
+            excess = self.size + n - capacity
+            if excess > 0:
+                self.read_pos = (self.read_pos + excess) % capacity
+                self.size -= excess
+                self.stats["dropped_frames"] += excess // self.frame_bytes
+            self.ring_offset[...] = (self.read_pos + self.size) // 2
+            np.add(self.ring_base, self.ring_offset, out=self.ring_index)
+            self.ring_samples.put(self.ring_index, self.out, mode="wrap")
+            self.size += n
+            self.stats["captured_frames"] += n // self.frame_bytes
+            backlog_ms = self.size // self.bytes_per_ms
+            if backlog_ms > self.stats["max_backlog_ms"]:
+                self.stats["max_backlog_ms"] = backlog_ms
+            # The reader only waits while less than a packet is buffered.
+            if self.size >= self.packet_bytes > self.size - n:
+                self.cond.notify()
+
+    def read_packet(self):
+        # Blocks until at least one packet is buffered. Returns b"" once closed
+        # and drained, which ends the sender loop.
+        with self.cond:
+            self.cond.wait_for(lambda: self.size >= self.packet_bytes or self.closed)
+            if self.closed:
+                n = self.size
+            else:
+                n = min(self.size - self.size % self.packet_bytes, self.max_packet_bytes)
+            capacity = len(self.ring)
+            end = self.read_pos + n
+            if end <= capacity:
+                data = bytes(self.view[self.read_pos:end])
+            else:
+                data = bytes(self.view[self.read_pos:]) + bytes(self.view[:end - capacity])
+            self.read_pos = end % capacity
+            self.size -= n
+            if n:
+                self.stats["packets_sent"] += 1
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for source in self.sources:
+            source.close()
+
+class VoiceActivityGate:
+    # Energy / zero-crossing VAD over VAD_FRAME_MS frames, vectorized per packet.
+    # A packet is speech if enough frames are loud relative to a tracked noise
+    # floor, or slightly quieter but with a high zero-crossing rate (fricatives).
+    # After speech the gate stays open for the hangover (see hangover_ms) so the
+    # STT still sees the silence that ends a turn; on reopening, the buffered
+    # pre-roll is sent first so onsets aren't clipped.
+    def __init__(self):
+        self.frame_samples = RATE * VAD_FRAME_MS // 1000
+        self.bytes_per_ms = RATE * CHANNELS * 2 // 1000
+        self.noise_floor = -60.0
+        self.open = False
+        self.speech = False  # Decision for the latest packet
+        self.hangover_ms = 0
+        self.gated_ms = 0
+        self.preroll = collections.deque()
+        self.preroll_ms = 0
+        self.stats = {"bytes_in": 0, "bytes_sent": 0, "bytes_saved": 0, "speech_segments": 0}
+
+    def is_speech(self, data):
+        samples = np.frombuffer(data, dtype=np.int16)
+        if CHANNELS > 1:
+            samples = samples[:len(samples) - len(samples) % CHANNELS].reshape(-1, CHANNELS).mean(axis=1)
+        usable = len(samples) - len(samples) % self.frame_samples
+        if not usable:
+            return self.open
+        frames = samples[:usable].reshape(-1, self.frame_samples).astype(np.float32)
+        power = np.mean(frames * frames, axis=1)
+        energy_db = 10 * np.log10(power + 1e-3) - 90.3  # dBFS for int16
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.frame_samples
+
+        threshold = max(VAD_MIN_DBFS, self.noise_floor + VAD_MARGIN_DB)
+        voiced = energy_db > threshold
+        unvoiced = (energy_db > threshold - 6) & (zcr > 0.3)
+        speech_frames = np.count_nonzero(voiced | unvoiced)
+
+        # Noise floor drops immediately to quieter frames and creeps up slowly.
+        quietest = float(energy_db.min())
+        if quietest < self.noise_floor:
+            self.noise_floor = quietest
+        else:
+            self.noise_floor += 0.05 * (quietest - self.noise_floor)
+        return speech_frames >= max(2, len(frames) // 5)
+
+    def full_hangover_ms(self):
+        # The STT's end-of-turn silence adapts (ENDPOINT_FALLBACK_MS), and the
+        # gate must outlast it or a turn only ends at the next keep-alive packet.
+        stt_silence = endpointer.max_silence_ms if ENDPOINT_MODE else STT_END_OF_TURN_MS
+        return max(VAD_HANGOVER_MS, stt_silence + VAD_HANGOVER_MARGIN_MS)
+
+    def process(self, data):
+        # Returns the bytes to send for this packet, or None while gated.
+        packet_ms = len(data) // self.bytes_per_ms
+        self.stats["bytes_in"] += len(data)
+        self.speech = self.is_speech(data)
+        if self.speech:
+            if not self.open:
+                self.stats["speech_segments"] += 1
+                if DEBUG_MODE:
+                    print(f"[DEBUG] VAD open (noise floor {self.noise_floor:.1f} dBFS)")
+            self.open = True
+            self.hangover_ms = self.full_hangover_ms()
+        elif self.open:
+            self.hangover_ms -= packet_ms
+            if self.hangover_ms <= 0:
+                self.open = False
+                self.gated_ms = 0
+                if DEBUG_MODE:
+                    print("[DEBUG] VAD closed")
+
+        if self.open:
+            if self.preroll:
+                self.preroll.append(data)
+                data = b"".join(self.preroll)
+                self.preroll.clear()
+                self.preroll_ms = 0
+            self.stats["bytes_sent"] += len(data)
+            return data
+
+        self.gated_ms += packet_ms
+        if self.gated_ms >= VAD_KEEPALIVE_MS:
+            self.gated_ms = 0
+            self.stats["bytes_sent"] += len(data)
+            return data
+        self.preroll.append(data)
+        self.preroll_ms += packet_ms
+        while self.preroll_ms - len(self.preroll[0]) // self.bytes_per_ms >= VAD_PREROLL_MS:
+            dropped = self.preroll.popleft()
+            self.preroll_ms -= len(dropped) // self.bytes_per_ms
+            self.stats["bytes_saved"] += len(dropped)
+        return None
+
+    def report(self):
+        total = self.stats["bytes_in"]
+        if total:
+            saved = self.stats["bytes_saved"]
+            print(f"[INFO] VAD skipped {saved / 1024:.0f} KB of silence ({100 * saved / total:.0f}% of audio), "
+                  f"{self.stats['speech_segments']} speech segments.")
+
+def voice_gated(read_audio, gate, controller=None):
+    # Wraps a blocking packet reader so it only returns audio worth sending.
+    # The endpoint controller, if given, sees every packet with the gate's
+    # speech decision instead of running its own detector.
+    def read_voiced():
+        while True:
+            data = read_audio()
+            if not data:
+                return data
+            sent = gate.process(data)
+            if controller is not None:
+                controller.observe(data, gate.speech)
+            if sent:
+                return sent
+    return read_voiced
+
+class STTSupervisor:
+    # Bookkeeping that lets the audio path survive STT disconnects. Audio sent
+    # since the last finished turn is kept, and audio captured while the socket is
+    # down is buffered; on reconnect both are replayed into the new session so the
+    # interrupted question is transcribed in full. The engines own the sockets
+    # and call these methods; all of them are safe from any thread.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.bytes_per_ms = RATE * CHANNELS * 2 // 1000
+        self.max_bytes = STT_REPLAY_MAX_SECONDS * 1000 * self.bytes_per_ms
+        self.connected = False
+        self.stopped = False
+        self.send_fn = None
+        self.control_fn = None
+        self.session_ms = 0
+        self.unfinished = collections.deque()  # (session start ms, packet) since the last finished turn
+        self.unfinished_bytes = 0
+        self.backlog = collections.deque()  # packets captured while disconnected
+        self.backlog_bytes = 0
+        self.attempt = 0
+        self.connected_at = None
+        self.down_since = None
+        self.created_at = time.perf_counter()
+        self.last_sent_at = None  # when the latest audio packet went out, for turn traces
+        self.stats = {"connects": 0, "reconnects": 0, "downtime_ms": 0, "replayed_bytes": 0, "dropped_bytes": 0}
+
+    def backoff_delay(self):
+        delay_ms = min(STT_RECONNECT_MAX_MS, STT_RECONNECT_BASE_MS * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(0.5, 1.0) * delay_ms / 1000
+
+    def begin_session(self):
+        # New STT session: its turns start from scratch, so drop half-heard text
+        # and queue the unfinished turn's audio ahead of anything buffered.
+        with self.lock:
+            turn_tracker.reset()
+            turn_assembler.new_session()
+            stream_manager.cancel_speculative()
+            self.stats["connects"] += 1
+            if self.stats["connects"] == 1:
+                startup.record("stt connect", self.created_at)
+            if self.down_since is not None:
+                outage_ms = int((time.perf_counter() - self.down_since) * 1000)
+                self.stats["reconnects"] += 1
+                self.stats["downtime_ms"] += outage_ms
+                replay_kb = (self.unfinished_bytes + self.backlog_bytes) / 1024
+                print(f"[INFO] STT reconnected after {outage_ms / 1000:.1f}s "
+                      f"(reconnect #{self.stats['reconnects']}, replaying {replay_kb:.0f} KB of audio).")
+                self.down_since = None
+            self.backlog.extendleft(packet for _, packet in reversed(self.unfinished))
+            self.backlog_bytes += self.unfinished_bytes
+            self.unfinished.clear()
+            self.unfinished_bytes = 0
+            self.session_ms = 0
+            self.connected_at = time.perf_counter()
+        endpointer.reset_session()
+        connection_warmer.warm()
+
+    def take_backlog(self):
+        with self.lock:
+            packets = list(self.backlog)
+            self.backlog.clear()
+            self.stats["replayed_bytes"] += self.backlog_bytes
+            self.backlog_bytes = 0
+            return packets
+
+    def mark_connected(self, send_fn=None, control_fn=None):
+        with self.lock:
+            self.send_fn = send_fn
+            self.control_fn = control_fn
+            self.connected = True
+
+    def send_control(self, message):
+        # JSON control message (ForceEndpoint, UpdateConfiguration) on the open session.
+        with self.lock:
+            control_fn = self.control_fn if self.connected else None
+        if control_fn is None:
+            return False
+        try:
+            control_fn(json.dumps(message))
+            return True
+        except Exception as e:
+            print(f"[WARN] STT control message failed: {e}")
+            return False
+
+    def disconnected(self):
+        with self.lock:
+            if self.connected_at and time.perf_counter() - self.connected_at >= STT_STABLE_SECONDS:
+                self.attempt = 0
+            self.connected = False
+            self.send_fn = None
+            self.control_fn = None
+            self.connected_at = None
+            if self.down_since is None:
+                self.down_since = time.perf_counter()
+
+    def sent(self, data):
+        if not startup.done:
+            startup.finish()
+        self.last_sent_at = time.perf_counter()
+        with self.lock:
+            self.unfinished.append((self.session_ms, data))
+            self.unfinished_bytes += len(data)
+            self.session_ms += len(data) // self.bytes_per_ms
+            while self.unfinished_bytes > self.max_bytes:
+                _, old = self.unfinished.popleft()
+                self.unfinished_bytes -= len(old)
+
+    def buffer(self, data):
+        with self.lock:
+            self.backlog.append(data)
+            self.backlog_bytes += len(data)
+            while self.backlog_bytes > self.max_bytes:
+                old = self.backlog.popleft()
+                self.backlog_bytes -= len(old)
+                self.stats["dropped_bytes"] += len(old)
+
+    def send(self, data):
+        # Threaded engine: send now if connected, otherwise keep for replay. The
+        # packet is recorded under the lock but sent outside it, so a slow socket
+        # never holds up transcript handling on the STT thread. A packet whose
+        # send fails is already in the unfinished audio and is replayed.
+        with self.lock:
+            send_fn = self.send_fn if self.connected else None
+            if send_fn is None:
+                self.buffer(data)
+                return
+            self.sent(data)
+        try:
+            send_fn(data)
+        except Exception as e:
+            print(f"[WARN] STT send failed: {e}")
+            with self.lock:
+                if self.send_fn is send_fn:
+                    self.disconnected()
+
+    def turn_finished(self, end_ms=None):
+        # Audio up to the turn's last word no longer needs replaying.
+        with self.lock:
+            if end_ms is None:
+                end_ms = self.session_ms
+            while self.unfinished and self.unfinished[0][0] + len(self.unfinished[0][1]) // self.bytes_per_ms <= end_ms:
+                _, old = self.unfinished.popleft()
+                self.unfinished_bytes -= len(old)
+
+    def report(self):
+        if self.stats["reconnects"]:
+            print(f"[INFO] STT reconnects: {self.stats['reconnects']}, downtime {self.stats['downtime_ms'] / 1000:.1f}s, "
+                  f"replayed {self.stats['replayed_bytes'] / 1024:.0f} KB, dropped {self.stats['dropped_bytes'] / 1024:.0f} KB.")
+
+stt_supervisor = STTSupervisor()
+audio_capture = None
+voice_gate = None
+
+def turn_cue(text, confidence=0.0):
+    # How finished the interim text sounds: "complete" (question wording, a
+    # question mark, or the STT's own end-of-turn confidence), "incomplete"
+    # (trailing comma or a dangling word such as "and" / "the") or "neutral".
+    text = text.strip()
+    if not text or text.endswith((",", ";", ":", "-")):
+        return "incomplete"
+    words = normalize_words(text)
+    if not words or words[-1] in DANGLING_WORDS:
+        return "incomplete"
+    if confidence >= 0.5 or looks_like_complete_question(text):
+        return "complete"
+    return "neutral"
+
+class EndpointController:
+    # Ends turns earlier than the STT's fixed silence when it is safe to. Local
+    # audio energy gives the current silence, the interim transcript gives the
+    # cue, and the speaker's own mid-turn pauses (word gaps in finished turns)
+    # give how long a silence has to be: past the speaker's 90th percentile for
+    # a complete-sounding question, well past the longest usual pause otherwise,
+    # never on a dangling clause. Then a ForceEndpoint is sent. The STT's own
+    # max_turn_silence stays as the fallback and follows the speaker's pauses.
+    # A forced turn that the speaker resumes within that fallback was a false
+    # start; its gap is learned as a pause.
+    PRIOR_PAUSES_MS = [250, 300, 350, 400, 450, 500, 550, 600, 700, 800]  # until the speaker's own pauses replace them
+    MIN_PAUSE_MS = 150  # Shorter word gaps are ordinary speech, not pauses
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.detector = VoiceActivityGate()
+        self.pauses = collections.deque(self.PRIOR_PAUSES_MS, maxlen=ENDPOINT_PAUSE_WINDOW)
+        self.max_silence_ms = self.fallback_silence()
+        self.last_speech_at = time.perf_counter()
+        self.speaking = False
+        self.turn_order = None
+        self.transcript = ""
+        self.confidence = 0.0
+        self.forced_turn = None
+        self.finished_turn = None
+        self.last_forced_end_ms = None  # last word of the latest forced turn, STT clock
+        self.stats = {"turns": 0, "forced": 0, "false_starts": 0, "forced_silence_ms": 0}
+
+    def reset_session(self):
+        # A new STT session restarts turn_order and word times.
+        with self.lock:
+            self.turn_order = None
+            self.transcript = ""
+            self.forced_turn = None
+            self.finished_turn = None
+            self.last_forced_end_ms = None
+
+    def pause_percentile(self, pct):
+        ordered = sorted(self.pauses)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def fallback_silence(self):
+        # STT end-of-turn silence: twice the speaker's long pauses, in 100 ms steps.
+        low, high = ENDPOINT_FALLBACK_MS
+        return int(min(high, max(low, 2 * self.pause_percentile(98))) // 100 * 100)
+
+    def required_silence(self, cue):
+        if cue == "complete":
+            required = self.pause_percentile(90)
+        elif cue == "neutral":
+            required = self.pause_percentile(98) * 1.3
+        else:
+            return None
+        required = max(ENDPOINT_MIN_SILENCE_MS, required)
+        return required if required < self.max_silence_ms else None
+
+    def observe(self, data, speech=None):
+        # Audio thread: every captured packet. speech is the VAD gate's decision
+        # for it when the gate runs; otherwise the own detector decides.
+        if speech is None:
+            speech = self.detector.is_speech(data)
+        with self.lock:
+            self.speaking = speech
+            if speech:
+                self.last_speech_at = time.perf_counter()
+        if not speech:
+            self.check()
+
+    def on_interim(self, data):
+        words = data.get("words") or []
+        with self.lock:
+            order = data.get("turn_order")
+            if order != self.turn_order and words and self.last_forced_end_ms is not None:
+                gap = words[0].get("start", 0) - self.last_forced_end_ms
+                if 0 <= gap < self.max_silence_ms:
+                    # The speaker was only pausing: learn that pause.
+                    self.stats["false_starts"] += 1
+                    self.pauses.append(gap)
+                    if DEBUG_MODE:
+                        print(f"\n[DEBUG] Endpoint false start: resumed after {gap} ms")
+                self.last_forced_end_ms = None
+            self.turn_order = order
+            self.transcript = data.get("transcript", "")
+            self.confidence = data.get("end_of_turn_confidence") or 0.0
+        self.check()
+
+    def on_end_of_turn(self, data):
+        # Learns the finished turn's pauses and adapts the STT fallback. Both the
+        # raw and the formatted end_of_turn message arrive; only the first counts.
+        words = data.get("words") or []
+        order = data.get("turn_order")
+        update = None
+        with self.lock:
+            self.transcript = ""
+            if order is not None and order == self.finished_turn:
+                return
+            self.finished_turn = order
+            self.stats["turns"] += 1
+            for prev, word in zip(words, words[1:]):
+                gap = word.get("start", 0) - prev.get("end", 0)
+                if gap >= self.MIN_PAUSE_MS:
+                    self.pauses.append(gap)
+            if order is not None and order == self.forced_turn and words:
+                self.last_forced_end_ms = words[-1].get("end")
+            target = self.fallback_silence()
+            if abs(target - self.max_silence_ms) >= 100:
+                self.max_silence_ms = target
+                update = target
+        if update is not None:
+            stt_supervisor.send_control({"type": "UpdateConfiguration", "max_turn_silence": update})
+            if DEBUG_MODE:
+                print(f"\n[DEBUG] STT end-of-turn silence now {update} ms")
+
+    def check(self):
+        with self.lock:
+            if self.speaking or not self.transcript or self.turn_order is None:
+                return
+            if self.forced_turn == self.turn_order or self.finished_turn == self.turn_order:
+                return
+            required = self.required_silence(turn_cue(self.transcript, self.confidence))
+            silence_ms = (time.perf_counter() - self.last_speech_at) * 1000
+            if required is None or silence_ms < required:
+                return
+            self.forced_turn = self.turn_order
+        if stt_supervisor.send_control({"type": "ForceEndpoint"}):
+            with self.lock:
+                self.stats["forced"] += 1
+                self.stats["forced_silence_ms"] += silence_ms
+            if DEBUG_MODE:
+                print(f"\n[DEBUG] Ended turn after {silence_ms:.0f} ms of silence (needed {required:.0f} ms)")
+
+    def report(self):
+        forced = self.stats["forced"]
+        if self.stats["turns"]:
+            average = self.stats["forced_silence_ms"] / forced if forced else 0
+            print(f"[INFO] Endpointing: {forced}/{self.stats['turns']} turns ended early (after {average:.0f} ms of "
+                  f"silence on average), {self.stats['false_starts']} false starts; STT fallback "
+                  f"{self.max_silence_ms} ms, speaker pause p90 {self.pause_percentile(90)} ms.")
+
+def endpoint_observed(read_audio, controller):
+    # Wraps a packet reader so the endpoint controller sees all captured audio.
+    def read_observed():
+        data = read_audio()
+        if data:
+            controller.observe(data)
+        return data
+    return read_observed
+
+def stt_session_url(stt_url):
+    if ENDPOINT_MODE:
+        # The STT's semantic end-of-turn is off: turns end on ForceEndpoint or max_turn_silence.
+        return (f"{stt_url}?sample_rate={RATE}&format_turns=true&end_of_turn_confidence_threshold=1"
+                f"&max_turn_silence={endpointer.max_silence_ms}")
+    return f"{stt_url}?sample_rate={RATE}&format_turns=true&end_of_turn_threshold_ms={STT_END_OF_TURN_MS}"
+
+endpointer = EndpointController()
+
+CONTINUATION_WORDS = {
+    "for", "and", "or", "but", "in", "on", "at", "with", "without", "to", "of", "from", "by", "because",
+    "so", "which", "that", "who", "where", "especially", "including", "like", "specifically", "using",
+    "if", "while", "after", "before", "versus", "vs", "plus", "then", "also", "assuming",
+}
+
+class TurnAssembler:
+    # Joins the fragments of a question the speaker finished after a pause.
+    # Turns are keyed by turn_order: a re-sent turn (the formatted final follows
+    # the raw one) replaces its fragment, and a new turn extends the current
+    # question if it comes within the speaker's usual pause and either starts
+    # with a continuation word or follows a fragment that ended mid-sentence.
+    # A question that ends mid-sentence is held for TURN_HOLD_MS, and for as
+    # long as the speaker is talking again, so it is only sent once.
+    PRIOR_GAP_MS = 3000  # Merge window until enough pauses between fragments were seen
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fragments = []  # [turn_order, text, first word start ms, last word end ms]
+        self.ended_at = None
+        self.started = None  # Question text handed to the stream manager (None while held)
+        self.continued = False
+        self.hold_timer = None
+        self.release = None
+        self.gaps = collections.deque(maxlen=ENDPOINT_PAUSE_WINDOW)
+        self.stats = collections.Counter()
+
+    def question(self):
+        return " ".join(fragment[1] for fragment in self.fragments)
+
+    def window_ms(self):
+        if len(self.gaps) < 5:
+            return self.PRIOR_GAP_MS
+        ordered = sorted(self.gaps)
+        low, high = TURN_MERGE_WINDOW_MS
+        return max(low, min(high, 1.5 * ordered[int(0.9 * (len(ordered) - 1))]))
+
+    def add(self, turn_order, text, words):
+        # Returns (question, how): "repeat" for a re-sent turn, "merged" when the
+        # turn continues the current question, else (text, "new").
+        now = time.perf_counter()
+        start = words[0].get("start") if words else None
+        end = words[-1].get("end") if words else None
+        with self.lock:
+            last = self.fragments[-1] if self.fragments else None
+            if last is None:
+                return text, "new"
+            if turn_order is not None and turn_order == last[0]:
+                self.fragments[-1] = [turn_order, text, last[2] if start is None else start,
+                                      last[3] if end is None else end]
+                self.ended_at = now
+                return self.question(), "repeat"
+            if start is not None and last[3] is not None and start >= last[3]:
+                gap = start - last[3]
+            else:
+                gap = (now - self.ended_at) * 1000
+            # A held question takes whatever comes next.
+            if self.started is not None and not (gap <= self.window_ms() and self._continues(last[1], text)):
+                return text, "new"
+            self.gaps.append(gap)
+            self.fragments.append([turn_order, text, start, end])
+            self.ended_at = now
+            self.stats["merged"] += 1
+        if DEBUG_MODE:
+            print(f"\n[DEBUG] Merged a fragment after {gap:.0f} ms: {text[:80]}")
+        return self.question(), "merged"
+
+    def _continues(self, previous, text):
+        words = normalize_words(text)
+        if not words:
+            return False
+        if turn_cue(previous) == "incomplete":
+            return True
+        return words[0] in CONTINUATION_WORDS and not looks_like_complete_question(text)
+
+    def settled(self, question):
+        # True if a re-sent turn needs no action: it is held, or matches what is being answered.
+        with self.lock:
+            return self.release is not None or (
+                self.started is not None and transcripts_match(question, self.started))
+
+    def new_session(self):
+        # turn_order restarts with the STT session, so held fragments can no longer be re-sent.
+        with self.lock:
+            for fragment in self.fragments:
+                fragment[0] = None
+
+    def begin(self, turn_order, text, words):
+        with self.lock:
+            self.fragments = [[turn_order, text, words[0].get("start") if words else None,
+                               words[-1].get("end") if words else None]]
+            self.ended_at = time.perf_counter()
+            self.started = None
+            self.continued = False
+
+    def started_with(self, question, continued):
+        with self.lock:
+            self.started = question
+            self.continued = continued
+
+    def hold(self, callback):
+        # Calls callback(question) after TURN_HOLD_MS unless a merged fragment takes the hold first.
+        with self.lock:
+            self.started = None
+            self.release = callback
+            self.hold_timer = threading.Timer(TURN_HOLD_MS / 1000.0, contextvars.copy_context().run,
+                                              args=(self._release,))
+            self.hold_timer.daemon = True
+            self.hold_timer.start()
+            self.stats["held"] += 1
+
+    def on_interim(self, turn_order):
+        # The speaker went on: a held question waits for this turn to end.
+        with self.lock:
+            if self.hold_timer is not None and self.fragments and turn_order != self.fragments[-1][0]:
+                self.hold_timer.cancel()
+                self.hold_timer = None
+
+    def take_hold(self):
+        with self.lock:
+            callback, self.release = self.release, None
+            if self.hold_timer is not None:
+                self.hold_timer.cancel()
+                self.hold_timer = None
+            return callback
+
+    def _release(self):
+        callback = self.take_hold()
+        if callback:
+            callback(self.question())
+
+    def report(self):
+        if self.stats:
+            print(f"[INFO] Turn assembly: {self.stats['merged']} fragments merged into the previous question, "
+                  f"{self.stats['held']} questions held for more speech; merge window {self.window_ms():.0f} ms.")
+
+turn_assembler = TurnAssembler()
+
+def websocket_stream(audio_source=None, stt_url=STT_URL):
+    # audio_source only needs read(CHUNK) -> bytes; an empty read ends the stream.
+    # replay_harness.py passes a recorded PCM source and a local stand-in STT URL.
+    # Without one, audio comes from an AudioCapture in packets of AUDIO_PACKET_MS,
+    # gated by the VAD when VAD_MODE is on. The socket runs on its own thread
+    # (stt_connection_loop) and reconnects with backoff; audio read while it is
+    # down is buffered by stt_supervisor and replayed.
+    global session_recorder, audio_capture, voice_gate, stt_supervisor
+    try:
+        # Connect first so the handshake overlaps opening the audio device.
+        stt_supervisor = STTSupervisor()
+        wst = threading.Thread(target=stt_connection_loop, args=(stt_url, stt_supervisor))
+        wst.daemon = True
+        wst.start()
+
+        if audio_source is not None:
+            read_audio = lambda: audio_source.read(CHUNK)
+            if ENDPOINT_MODE:
+                read_audio = endpoint_observed(read_audio, endpointer)
+        else:
+            with startup.measure("audio device"):
+                audio_capture = AudioCapture().start()
+            read_audio = audio_capture.read_packet
+            if VAD_MODE:
+                voice_gate = VoiceActivityGate()
+                read_audio = voice_gated(read_audio, voice_gate, endpointer if ENDPOINT_MODE else None)
+            elif ENDPOINT_MODE:
+                read_audio = endpoint_observed(read_audio, endpointer)
+        if SESSION_RECORD_DIR:
+            session_recorder = SessionRecorder(SESSION_RECORD_DIR)
+            print(f"[INFO] Recording session to {session_recorder.path}")
+        
+        reported_drops = 0
+        while is_running:
+            data = read_audio()
+            if not data:
+                break
+            stt_supervisor.send(data)
+            if session_recorder:
+                session_recorder.write_audio(data)
+            if audio_capture and audio_capture.stats["dropped_frames"] > reported_drops:
+                reported_drops = audio_capture.stats["dropped_frames"]
+                print(f"[WARN] Audio capture dropped {reported_drops} frames so far (sender too slow).")
+    except Exception as e:
+        print(f"[ERROR] Audio Stream Failed: {e}")
+    finally:
+        # Leave the current socket open for the last transcripts, but stop reconnecting.
+        stt_supervisor.stopped = True
+        if audio_capture:
+            audio_capture.close()
+        if voice_gate:
+            voice_gate.report()
+        stt_supervisor.report()
+        endpointer.report()
+        if session_recorder:
+            session_recorder.close()
+            session_recorder = None
+
+def stt_connection_loop(stt_url, supervisor):
+    global ws
+
+    def on_stt_open(ws_app):
+        on_open(ws_app)
+        with supervisor.lock:
+            supervisor.begin_session()
+            for data in supervisor.take_backlog():
+                ws_app.send(data, websocket.ABNF.OPCODE_BINARY)
+                supervisor.sent(data)
+            supervisor.mark_connected(lambda data: ws_app.send(data, websocket.ABNF.OPCODE_BINARY), ws_app.send)
+
+    while is_running and not supervisor.stopped:
+        # Rebuilt per connection so a reconnect starts with the learned end-of-turn silence.
+        ws = websocket.WebSocketApp(
+            stt_session_url(stt_url), header={"Authorization": ASSEMBLYAI_API_KEY},
+            on_open=on_stt_open, on_message=on_message, on_error=on_error, on_close=on_close
+        )
+        ws.run_forever()
+        supervisor.disconnected()
+        if not is_running or supervisor.stopped:
+            break
+        delay = supervisor.backoff_delay()
+        print(f"[WARN] STT connection lost; reconnecting in {delay:.1f}s.")
+        time.sleep(delay)
+
+# ========================
+# Asyncio Engine (optional)
+# ========================
+
+class AsyncStreamManager(StreamManager):
+    # Same generation/speculation bookkeeping as StreamManager, but each answer is
+    # a task on the pipeline loop: a superseded answer is cancelled, which closes
+    # its HTTP stream at once, and nothing ever joins or sleeps.
+    def __init__(self, loop, async_client):
+        super().__init__()
+        self.loop = loop
+        self.async_client = async_client
+
+    def _spawn(self, transcript, gen, spec=None):
+        coro = self.generate_and_stream_response_async(transcript, gen, spec)
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                return self.loop.create_task(coro)
+        except RuntimeError:
+            pass
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _is_running(self, worker):
+        return worker is not None and not worker.done()
+
+    def _discard(self, gen, worker):
+        super()._discard(gen, worker)
+        if worker is not None:
+            if isinstance(worker, asyncio.Task):
+                self.loop.call_soon_threadsafe(worker.cancel)
+            else:
+                worker.cancel()
+
+    async def generate_and_stream_response_async(self, transcript, gen, spec=None):
+        # Same race as the thread engine, with each request as a task; cancelling
+        # this task (a superseded turn) cancels them all.
+        prompt_input = self._begin_response(transcript, gen, spec)
+        if prompt_input is None:
+            return
+        race = AnswerRace(asyncio.Event())
+        try:
+            self._launch_attempt(race, AI_MODEL, gen, spec, transcript, prompt_input)
+            while True:
+                race.changed.clear()
+                step = self._next_step(race, gen, spec)
+                if step == "wait":
+                    try:
+                        await asyncio.wait_for(race.changed.wait(), race.wait_timeout())
+                    except asyncio.TimeoutError:
+                        pass
+                elif step == "hedge":
+                    self._hedge(race, gen, spec, transcript, prompt_input)
+                elif step == "retry":
+                    await asyncio.sleep(self._before_retry(race))
+                    if self._is_wanted(gen, spec):
+                        self._launch_attempt(race, race.retry_model(), gen, spec, transcript, prompt_input)
+                elif step == "fail":
+                    self._fail_response(gen, spec, race.errors[-1])
+                    return
+                else:
+                    return
+        finally:
+            # cancel() is True for a request still open, whose connection goes with it.
+            if [task for task in race.workers.values() if task.cancel()]:
+                connection_warmer.stream_closed()
+            connection_warmer.request_done(gen)
+            turn_tracer.ended(gen)
+
+    def _spawn_attempt(self, race, attempt, gen, spec, transcript, prompt_input):
+        race.workers[attempt] = self.loop.create_task(
+            self._stream_attempt_async(race, attempt, gen, spec, transcript, prompt_input))
+
+    def _stop_losers(self, gen, race, winner):
+        if [task for attempt, task in race.workers.items() if attempt != winner and task.cancel()]:
+            connection_warmer.stream_closed()
+
+    async def _stream_attempt_async(self, race, attempt, gen, spec, transcript, prompt_input):
+        model = race.models[attempt]
+        response_parts = []
+        error = None
+        try:
+            request_args = self._request_args(prompt_input, model)
+            async with self.async_client.with_options(max_retries=0).responses.stream(**request_args) as response_stream:
+                if DEBUG_MODE:
+                    print(f"[DEBUG] Stream started ({model})...")
+                async for event in response_stream:
+                    if not self._handle_event(event, gen, spec, response_parts, race, attempt):
+                        return
+            if race.claim(attempt):
+                self._finish_response(transcript, gen, spec, "".join(response_parts))
+        except Exception as e:
+            error = e
+            self._attempt_failed(race, attempt, gen, spec, e)
+        finally:
+            race.end(attempt, error)
+
+    def warm_connection(self):
+        # Pings through the async client, whose pool is the one answers use.
+        asyncio.run_coroutine_threadsafe(self.async_client.models.retrieve(AI_MODEL, timeout=10), self.loop).result()
+
+class AsyncPipeline:
+    # Runs audio capture, the STT websocket and answer streams as tasks on one
+    # event loop in a background thread. Use call_soon/submit to schedule work on
+    # it from other threads; stats holds loop health numbers.
+    LAG_CHECK_S = 0.1
+
+    def __init__(self, audio_source=None, stt_url=STT_URL, use_stt=True):
+        self.audio_source = audio_source
+        self.stt_url = stt_url
+        self.use_stt = use_stt
+        self.loop = None
+        self.main_task = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.conn = None
+        self.stats = {"audio_chunks": 0, "max_loop_lag_ms": 0.0}
+
+    def make_stream_manager(self):
+        return AsyncStreamManager(self.loop, build_async_openai_client())
+
+    def bind(self, name, value):
+        # Publishes engine state under the module-level name the callbacks use.
+        globals()[name] = value
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.main(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop and self.main_task:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread:
+            self.thread.join(timeout=2)
+
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.bind("stream_manager", self.make_stream_manager())
+        self.ready.set()
+        lag_task = self.loop.create_task(self.monitor_loop_lag())
+        try:
+            if self.use_stt:
+                await self.run_stt()
+            else:
+                await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[ERROR] Async pipeline failed: {e}")
+        finally:
+            lag_task.cancel()
+
+    async def monitor_loop_lag(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.LAG_CHECK_S)
+            lag_ms = (self.loop.time() - start - self.LAG_CHECK_S) * 1000
+            if lag_ms > self.stats["max_loop_lag_ms"]:
+                self.stats["max_loop_lag_ms"] = lag_ms
+                if DEBUG_MODE and lag_ms > 50:
+                    print(f"[DEBUG] Event loop lag: {lag_ms:.0f} ms")
 
-AI_MODEL = "gpt-4o-mini"  # Faster, lower-latency model
-HOTKEY = '<ctrl>+<alt>+h'
-HOTKEY_UPLOAD = '<ctrl>+<alt>+u'
-HOTKEY_COMPANY = '<ctrl>+<alt>+c'
-HOTKEY_STAGE = '<ctrl>+<alt>+s'
-DEBUG_MODE = False  # Set to True for verbose logging
-CLEAR_ON_NEW_TURN = False  # Keep history so you can scroll
-MAX_HISTORY_LINES = 1000  # Trim history to last N lines for performance
-STEALTH_HELP_TIMEOUT_MS = 7000  # Hide helper text after a few seconds
+    async def run_stt(self):
+        # Audio is pumped into a bounded queue and forwarded by send_audio for the
+        # whole run; connections come and go underneath it with backoff, and
+        # stt_supervisor buffers and replays audio across the gaps.
+        import websockets
+        self.bind("stt_supervisor", STTSupervisor())
+        audio_queue = asyncio.Queue(maxsize=8)
+        # The audio device is opened on the executor while the first connect runs.
+        pump = self.loop.create_task(self.pump_audio(self.open_audio_reader, audio_queue))
+        sender = self.loop.create_task(self.send_audio(audio_queue))
+        try:
+            while not stt_supervisor.stopped:
+                try:
+                    async with websockets.connect(stt_session_url(self.stt_url), additional_headers={"Authorization": ASSEMBLYAI_API_KEY}) as conn:
+                        on_open(conn)
+                        stt_supervisor.begin_session()
+                        while True:
+                            packets = stt_supervisor.take_backlog()
+                            if not packets:
+                                break
+                            for data in packets:
+                                await conn.send(data)
+                                stt_supervisor.sent(data)
+                        self.conn = conn
+                        stt_supervisor.mark_connected(
+                            control_fn=lambda text: asyncio.run_coroutine_threadsafe(conn.send(text), self.loop))
+                        try:
+                            async for message in conn:
+                                on_message(conn, message)
+                        finally:
+                            self.conn = None
+                            on_close(conn, None, None)
+                except (OSError, websockets.WebSocketException) as e:
+                    on_error(None, e)
+                stt_supervisor.disconnected()
+                if stt_supervisor.stopped:
+                    break
+                delay = stt_supervisor.backoff_delay()
+                print(f"[WARN] STT connection lost; reconnecting in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+        finally:
+            sender.cancel()
+            pump.cancel()
+            if audio_capture:
+                audio_capture.close()
+            if voice_gate:
+                voice_gate.report()
+            stt_supervisor.report()
+            endpointer.report()
 
-# Initialize OpenAI Client
-client = OpenAI(api_key=OPENAI_API_KEY)
+    def open_audio_reader(self):
+        global audio_capture, voice_gate
+        if self.audio_source is not None:
+            read_audio = lambda: self.audio_source.read(CHUNK)
+            return endpoint_observed(read_audio, endpointer) if ENDPOINT_MODE else read_audio
+        with startup.measure("audio device"):
+            audio_capture = AudioCapture().start()
+        read_audio = audio_capture.read_packet
+        if VAD_MODE:
+            voice_gate = VoiceActivityGate()
+            return voice_gated(read_audio, voice_gate, endpointer if ENDPOINT_MODE else None)
+        return endpoint_observed(read_audio, endpointer) if ENDPOINT_MODE else read_audio
 
-# Audio Constants
-CHUNK = 1024
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 16000
+    async def pump_audio(self, open_reader, audio_queue):
+        # Blocking reads (AudioCapture packets, replay files) run on the default
+        # executor; the bounded queue pushes back on them if sending stalls.
+        read_audio = await self.loop.run_in_executor(None, open_reader)
+        while True:
+            data = await self.loop.run_in_executor(None, read_audio)
+            await audio_queue.put(data)
+            if not data:
+                return
 
-# UI Constants
-ctk.set_appearance_mode("Dark")
-ctk.set_default_color_theme("blue")
+    async def send_audio(self, audio_queue):
+        import websockets
+        while True:
+            data = await audio_queue.get()
+            if not data:
+                # Keep the current session for the last transcripts, but stop reconnecting.
+                stt_supervisor.stopped = True
+                return
+            conn = self.conn
+            if conn is not None and stt_supervisor.connected:
+                try:
+                    await conn.send(data)
+                    stt_supervisor.sent(data)
+                    self.stats["audio_chunks"] += 1
+                    continue
+                except websockets.ConnectionClosed:
+                    stt_supervisor.disconnected()
+            stt_supervisor.buffer(data)
+
+async_pipeline = None
 
 # ========================
-# Global State
+# Headless Server
 # ========================
 
-# Queue now holds dicts: {"type": "text"|"clear"|"error", "content": ...}
-answer_queue = queue.Queue()
-current_interim = ""
-ws = None
-is_running = True
-CONVERSATION_CONTEXT_MAX_TURNS = 100
-conversation_history = []
+# State each server session has its own copy of; everything else (OpenAI
+# clients and pools, tracer, connection warmer, model stats, classifier) is
+# shared by the whole process.
+SESSION_SCOPED = (
+    "answer_queue", "conversation_memory", "prompt_builder", "answer_cache",
+    "answer_bank", "context_index", "turn_tracker", "turn_assembler", "endpointer", "stt_supervisor",
+    "stream_manager",
+)
 
-# Context Management
-system_instruction_default = """PERSONA:
-You are answering as a senior professional with 6-7 years of real-world experience.
+class SessionLocal:
+    # Stands in for a module-level name in server mode: every use goes to the
+    # current session's own object (current_session is set in each client's
+    # handler task and inherited by the tasks and timers it starts), or to the
+    # process-wide default outside any session.
+    __slots__ = ("_name", "_default")
 
-CONTEXT:
-- You are in a live technical interview.
-- Your answers must sound confident, concise, knowledgeable, and experience-driven.
-- Speak like someone who has worked on real production systems.
-- Avoid textbook explanations and unnecessary theory.
-- Structure responses clearly but naturally, as in a spoken interview.
-- Do NOT over-explain unless asked.
+    def __init__(self, name, default):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_default", default)
 
-DOMAIN BEHAVIOR:
-- If the question is about DevOps, answer as a DevOps Engineer with 6-7 years of hands-on experience.
-- If the domain is not explicitly stated, infer it from the question and respond as a senior professional in that domain.
+    def _target(self):
+        session = current_session.get()
+        return self._default if session is None else getattr(session, self._name)
 
-COMMANDS & CONFIGS:
-- Include practical commands only when they add value.
-- Keep commands minimal and accurate.
-- Explain briefly why the command is used, not how it works.
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
 
-DISPLAY RULES (STRICT):
-1. NO labels like 'Question:', 'Direct Answer:', 'Key Details:'. Just output the answer.
-2. UNIFIED RESPONSE: Provide ONE clear, cohesive technical answer.
-3. Style:
-   - Start immediately with the core answer (Yes/No/Action).
-   - If a command is needed, put the command first, then a brief explanation.
-   - Otherwise, follow with 1-2 brief sentences of context.
-   - Do not repeat phrases or restate the question.
-   - Never echo the question.
-   - Do not ask clarifying questions; give the best direct answer.
-   - If the question names a tool or service, address it directly.
-   - Use concrete numbers and examples (e.g., "reduce P99 latency by 20%", "rotate on-call every 5 days").
-   - Include what happens next and end with a short prevention step.
-   - If using an anecdote, keep it to one short line and stop.
-   - Avoid hedging; speak with confidence.
-   - Keep it to 2-4 short lines total.
-4. Format:
-   - Do not use bold or asterisks in the output.
-   - Put any commands in a fenced code block with a language hint (e.g., ```bash).
-   - Never output a bare language label or raw code without a code fence.
-   - No bullet lists unless explicitly asked.
-   - Keep it visually clean and short.
+    def __setattr__(self, attr, value):
+        setattr(self._target(), attr, value)
 
-STT HANDLING: The user's question is transcribed from audio. If you see obvious typos or phonetic errors (e.g., 'cube control' instead of 'kubectl', 'pro pod' instead of 'production pod'), interpret them logically.
+    def __len__(self):
+        return len(self._target())
 
-NOISE FILTERING & INTENT:
-- The transcript may include background noise, fillers ('um', 'uh'), or preamble ('Okay, moving on...').
-- IGNORE these. Focus ONLY on the core technical inquiry.
-- If the input is purely conversational noise (e.g., 'Can you hear me?', 'Just a second'), do not generate a technical answer. Output a polite, short status check or nothing.
+    def __bool__(self):
+        return bool(self._target())
 
-Goal: Produce an answer that looks clean, readable, and understandable at a glance during a live interview."""
+    def __iter__(self):
+        return iter(self._target())
 
-global_context = ""
-company_name = ""
-interview_stage = ""
-custom_instructions = system_instruction_default
+    def __getitem__(self, key):
+        return self._target()[key]
 
-# ========================
-# File Processing
-# ========================
+    def __setitem__(self, key, value):
+        self._target()[key] = value
 
-def extract_text_from_file(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
-    text = ""
-    try:
-        if ext == ".pdf":
-            with open(file_path, "rb") as f:
-                reader = PyPDF2.PdfReader(f)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-        elif ext == ".docx":
-            doc = Document(file_path)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        elif ext == ".txt":
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-        return text.strip()
-    except Exception as e:
-        print(f"[ERROR] Failed to read {file_path}: {e}")
-        return ""
+    def __delitem__(self, key):
+        del self._target()[key]
 
-# ========================
-# AI Interaction (Streaming with Cancellation)
-# ========================
+def install_session_scope(**defaults):
+    # Server mode only, before the first session starts; the app never calls it.
+    for name in SESSION_SCOPED:
+        value = globals()[name]
+        if isinstance(value, SessionLocal):
+            object.__setattr__(value, "_default", defaults.get(name, value._default))
+        else:
+            globals()[name] = SessionLocal(name, defaults.get(name, value))
 
-def add_to_history(question, answer):
-    if not question or not answer:
-        return
-    conversation_history.append((question.strip(), answer.strip()))
-    if len(conversation_history) > CONVERSATION_CONTEXT_MAX_TURNS:
-        del conversation_history[:-CONVERSATION_CONTEXT_MAX_TURNS]
+class HeadlessSession(AsyncPipeline):
+    # One client of the headless server, with its own settings, history,
+    # caches, turn state and AsyncStreamManager, run as tasks on the server's
+    # loop. Binary messages are PCM audio (RATE Hz, 16-bit mono), streamed to
+    # its own STT session once the first packet arrives; text messages are
+    # JSON: {"type": "configure", "instructions"/"context"/"company"/"stage"}
+    # or AssemblyAI "Turn" messages from a client that runs its own STT. The
+    # answer_queue messages of the current generation are sent back as JSON.
+    AUDIO_QUEUE_PACKETS = 16  # Client audio waiting for the STT sender before reads pause
 
-def format_conversation_history():
-    if not conversation_history:
-        return ""
-    lines = []
-    for idx, (q, a) in enumerate(conversation_history, start=1):
-        lines.append(f"Q{idx}: {q}")
-        lines.append(f"A{idx}: {a}")
-    return "\n".join(lines)
+    def __init__(self, server, session_id):
+        super().__init__(stt_url=server.stt_url)
+        self.server = server
+        self.id = session_id
+        self.loop = server.loop
+        self.settings = (custom_instructions, "", "", "")
+        self.answer_queue = AnswerQueue()
+        self.conversation_memory = ConversationMemory()
+        self.prompt_builder = PromptBuilder()
+        self.answer_cache = AnswerCache()
+        self.answer_bank = AnswerBank()
+        self.context_index = ContextIndex()
+        self.turn_tracker = TurnTracker()
+        self.turn_assembler = TurnAssembler()
+        self.endpointer = EndpointController()
+        self.stt_supervisor = STTSupervisor()
+        self.stream_manager = AsyncStreamManager(self.loop, server.async_client)
+        self.audio_in = asyncio.Queue(maxsize=self.AUDIO_QUEUE_PACKETS)
+        self.stt_task = None
+        self.wake = asyncio.Event()
+        self.answer_queue.set_listener(lambda: self.loop.call_soon_threadsafe(self.wake.set))
 
-class StreamManager:
-    def __init__(self):
-        self.generation = 0
-        self.current_generation = 0
-        self.lock = threading.Lock()
-        self.current_thread = None
+    def bind(self, name, value):
+        setattr(self, name, value)
 
-    def start_new_stream(self, transcript):
-        # 1. Bump generation to invalidate any in-flight stream
-        with self.lock:
-            self.generation += 1
-            gen = self.generation
-            self.current_generation = gen
-        
-        # 2. Wait a tiny bit for the old thread to notice and exit
-        is_interrupting = False
-        if self.current_thread and self.current_thread.is_alive():
-            is_interrupting = True
-            self.current_thread.join(timeout=0.2)
-        
-        # 3. CRITICAL: Drain the queue of any "old" tokens that were buffered
-        with answer_queue.mutex:
-            answer_queue.queue.clear()
-            
-        # 4. If we interrupted, tell UI to wipe the previous partial turn
-        if is_interrupting:
-             answer_queue.put({"type": "remove_last_turn", "gen": gen})
-        
-        # 3. Start the new thread
-        self.current_thread = threading.Thread(
-            target=self.generate_and_stream_response, 
-            args=(transcript, gen),
-            daemon=True
-        )
-        self.current_thread.start()
+    async def serve(self, conn):
+        # Runs in the client's handler task, with current_session set to self.
+        import websockets
+        sender = self.loop.create_task(self.send_answers(conn))
+        await conn.send(json.dumps({"type": "session", "id": self.id}))
+        try:
+            async for message in conn:
+                if isinstance(message, bytes):
+                    await self.receive_audio(message)
+                else:
+                    await self.receive_control(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            self.close()
 
-    def generate_and_stream_response(self, transcript, gen):
-        if gen != self.current_generation:
-            return
-        if DEBUG_MODE:
-            print(f"[DEBUG] Sending to OpenAI (Stream): {transcript[:100]}...")
-        
-        # Send the question as a clean header; avoid extra labels/separators
-        answer_queue.put({
-            "type": "new_turn",
-            "gen": gen,
-            "content": f"\n\n{transcript}\n\n"
-        })
-        
-        company_block = f"\n\nCOMPANY:\n{company_name}" if company_name.strip() else ""
-        stage_block = f"\n\nINTERVIEW STAGE:\n{interview_stage}" if interview_stage.strip() else ""
-        history_text = format_conversation_history()
-        history_block = f"\n\nRECENT CONVERSATION:\n{history_text}" if history_text else ""
-        full_system_prompt = (
-            f"{custom_instructions}\n\nRELEVANT CONTEXT (Resume/Job Description):\n{global_context}"
-            f"{company_block}"
-            f"{stage_block}"
-            f"{history_block}"
-        )
-        
-        full_response_so_far = ""
+    async def receive_audio(self, data):
+        if self.stt_task is None:
+            self.stt_task = self.loop.create_task(self.run_stt())
+        await self.audio_in.put(data)
 
+    async def receive_control(self, message):
         try:
-            with client.responses.stream(
-                model=AI_MODEL,
-                input=[
-                    {"role": "system", "content": full_system_prompt},
-                    {"role": "user", "content": f"{transcript}"}
-                ],
-                max_output_tokens=120,
-                temperature=0.1
-            ) as response_stream:
-                
-                if DEBUG_MODE:
-                    print("[DEBUG] Stream started...")
-                for event in response_stream:
-                    # Stop if a newer turn started
-                    if gen != self.current_generation:
-                        return
+            data = json.loads(message)
+        except ValueError:
+            return
+        msg_type = data.get("type")
+        if msg_type == "configure":
+            await self.configure(data)
+        elif msg_type in ("Turn", "Begin"):
+            on_message(None, message)
 
-                    if event.type == "response.output_text.delta":
-                        token = event.delta
-                        if token:
-                            full_response_so_far += token
-                            
-                            # SAFETY: Prevent "split-brain" double answers
-                            # If the model tries to output "Direct Answer" a second time, cut it off.
-                            # (Removed strict check as prompt no longer uses "Direct Answer" header)
-                            # if full_response_so_far.count("Direct Answer") > 1: ...
-
-                            answer_queue.put({"type": "text", "gen": gen, "content": token})
-            
-            if DEBUG_MODE:
-                print("[DEBUG] Stream finished.")
-            if gen == self.current_generation and full_response_so_far.strip():
-                add_to_history(transcript, full_response_so_far)
-            
+    async def configure(self, data):
+        instructions, context, company, stage = self.settings
+        fields = {key: data[key] for key in ("instructions", "context", "company", "stage")
+                  if isinstance(data.get(key), str)}
+        if "context" in fields and fields["context"] != context:
+            # Indexed off the loop; the index swaps its arrays in under its lock.
+            self.context_index.clear()
+            if fields["context"].strip():
+                await self.loop.run_in_executor(None, self.context_index.add_document, "context", fields["context"])
+        self.settings = (fields.get("instructions", instructions).strip() or custom_instructions,
+                         fields.get("context", context), fields.get("company", company).strip(),
+                         fields.get("stage", stage).strip())
+        if PREWARM_MODE and fields:
+            self.answer_bank.schedule()
+
+    async def send_answers(self, conn):
+        # Same stale-generation filter as the app's render loop.
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            for msg in self.answer_queue.drain():
+                if "gen" in msg and msg["gen"] != self.stream_manager.current_generation:
+                    continue
+                await conn.send(json.dumps(msg))
+
+    async def pump_audio(self, open_reader, audio_queue):
+        # Audio comes from the client instead of a device; an empty packet ends it.
+        while True:
+            data = await self.audio_in.get()
+            if data and ENDPOINT_MODE:
+                self.endpointer.observe(data)
+            await audio_queue.put(data)
+            if not data:
+                return
+
+    def close(self):
+        if self.stt_task is not None:
+            self.stt_task.cancel()
+        self.turn_assembler.take_hold()
+        self.answer_bank.cancel()
+        manager = self.stream_manager
+        manager.cancel_speculative()
+        manager._discard(manager.current_generation, manager.current_thread)
+
+class HeadlessServer(AsyncPipeline):
+    # The transcription -> answer pipeline without the UI, for many clients at
+    # once: each websocket connection to /sessions is a HeadlessSession, all of
+    # them on this one event loop and sharing one pooled async OpenAI client
+    # (plus the module's summary and prewarm pools). Plain GET /health returns
+    # the session count and loop lag as JSON, /metrics the turn traces in
+    # Prometheus text format.
+    def __init__(self, host="127.0.0.1", port=SERVER_PORT, stt_url=STT_URL, async_client=None,
+                 max_sessions=SERVER_MAX_SESSIONS):
+        super().__init__(stt_url=stt_url, use_stt=False)
+        self.host = host
+        self.port = port
+        self.async_client = async_client
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+        self.stats.update(sessions_served=0, sessions_refused=0)
+
+    async def main(self):
+        from websockets.asyncio.server import serve
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        if self.async_client is None:
+            self.async_client = build_async_openai_client()
+        # Outside any session (e.g. keep-alive pings), the shared client is used.
+        install_session_scope(stream_manager=AsyncStreamManager(self.loop, self.async_client))
+        lag_task = self.loop.create_task(self.monitor_loop_lag())
+        try:
+            async with serve(self.handle, self.host, self.port, process_request=self.process_request,
+                             max_size=2 ** 22) as server:
+                self.port = server.sockets[0].getsockname()[1]
+                print(f"[INFO] Headless server listening on ws://{self.host}:{self.port}/sessions")
+                self.ready.set()
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            if gen == self.current_generation: # Only report error if we weren't cancelled
-                print(f"[ERROR] OpenAI error: {e}")
-                answer_queue.put({"type": "error", "gen": gen, "content": f"\n[AI Error: {str(e)}]"})
+            print(f"[ERROR] Headless server failed: {e}")
+        finally:
+            lag_task.cancel()
+            for session in list(self.sessions.values()):
+                session.close()
+            self.ready.set()
 
-stream_manager = StreamManager()
+    def process_request(self, conn, request):
+        path = request.path.split("?", 1)[0]
+        if path == "/sessions":
+            if len(self.sessions) >= self.max_sessions:
+                self.stats["sessions_refused"] += 1
+                return conn.respond(503, "Too many sessions\n")
+            return None
+        if path == "/health":
+            response = conn.respond(200, json.dumps({
+                "sessions": len(self.sessions), "max_sessions": self.max_sessions,
+                "max_loop_lag_ms": round(self.stats["max_loop_lag_ms"], 1),
+            }))
+            response.headers["Content-Type"] = "application/json"
+            return response
+        if path == "/metrics":
+            return conn.respond(200, turn_tracer.prometheus_text())
+        return conn.respond(404, "Not found\n")
 
-# ========================
-# Audio / WebSocket
-# ========================
+    async def handle(self, conn):
+        session = HeadlessSession(self, next(self.session_ids))
+        current_session.set(session)
+        self.sessions[session.id] = session
+        self.stats["sessions_served"] += 1
+        try:
+            await session.serve(conn)
+        finally:
+            del self.sessions[session.id]
 
-def on_message(ws, message):
-    global current_interim
+def run_headless_server(port=SERVER_PORT):
+    # python stealth_copilot.py --serve
+    client.start()
+    connection_warmer.start().warm()
+    turn_tracer.start()
+    server = HeadlessServer(port=port).start()
     try:
-        data = json.loads(message)
-        msg_type = data.get("type")
+        while server.thread.is_alive():
+            server.thread.join(1)
+    except KeyboardInterrupt:
+        server.stop()
+    connection_warmer.report()
+    model_stats.report()
+    turn_classifier.report()
 
-        if msg_type == "Turn":
-            transcript = data.get("transcript", "")
-            end_of_turn = data.get("end_of_turn", False)
+# ========================
+# GUI Class
+# ========================
 
-            if end_of_turn:
-                # The 'transcript' here is the FINAL version for this turn.
-                full_question = (current_interim + " " + transcript).strip()
-                
-                if len(full_question) > 10:
-                    print("\n" + "-" * 60)
-                    print(f"Question: {full_question}")
-                    # Use the manager to start (and safely cancel old) streams
-                    stream_manager.start_new_stream(full_question)
-                
-                current_interim = ""
-            else:
-                # Accumulate partials so the final question is complete.
-                current_interim = (current_interim + " " + transcript).strip()
-                display_text = current_interim
-                if DEBUG_MODE:
-                    print(f"[DEBUG] Hearing: {display_text}", end="\r", flush=True)
+CODE_LANGS = {"bash", "sh", "zsh", "powershell", "pwsh", "cmd", "python", "yaml", "yml", "json", "sql"}
 
-        elif msg_type == "Begin":
-            print(f"[INFO] AssemblyAI session started: {data.get('id')}")
-    except Exception as e:
-        if DEBUG_MODE:
-            print(f"\n[DEBUG] Message error: {e}")
+class CodeFenceParser:
+    # Incremental ``` state machine for streamed markdown. A fence can arrive split
+    # across tokens ("``" + "`"), and so can the language line after an opening
+    # fence, so trailing backticks and an unfinished language line are held back
+    # until the next token decides them. feed() returns (text, tag) runs.
+    MAX_LANG_CHARS = 20
 
-def on_error(ws, error):
-    print(f"\n[ERROR] WebSocket error: {error}")
+    def __init__(self):
+        self.reset()
 
-def on_close(ws, close_status_code, close_msg):
-    print(f"\n[INFO] WebSocket closed.")
+    def reset(self):
+        self.in_code = False
+        self.pending = ""
+        self.lang_line = None  # Text after an opening fence, until its newline
 
-def on_open(ws):
-    print("[INFO] WebSocket connected!")
+    def flush(self):
+        runs = []
+        if self.lang_line:
+            runs.append((self.lang_line, "code"))
+        if self.pending:
+            runs.append((self.pending, self._tag()))
+        self.reset()
+        return runs
 
-def websocket_stream():
-    global ws
-    try:
-        url = f"wss://streaming.assemblyai.com/v3/ws?sample_rate={RATE}&format_turns=true&end_of_turn_threshold_ms=1600"
-        ws = websocket.WebSocketApp(
-            url, header={"Authorization": ASSEMBLYAI_API_KEY},
-            on_open=on_open, on_message=on_message, on_error=on_error, on_close=on_close
-        )
-        
-        p = pyaudio.PyAudio()
-        device_index = None
-        for i in range(p.get_device_count()):
-            dev = p.get_device_info_by_index(i)
-            if dev['maxInputChannels'] > 0 and ('CABLE Output' in dev['name'] or 'VB-Audio' in dev['name']):
-                device_index = i
-                print(f"[INFO] Using Audio Device: {dev['name']}")
-                break
-        
-        if device_index is None:
-            print("[WARN] VB-CABLE not found. Using default input.")
-            device_index = p.get_default_input_device_info()['index']
+    def _tag(self):
+        return "code" if self.in_code else None
 
-        stream = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, input_device_index=device_index, frames_per_buffer=CHUNK)
-        
-        wst = threading.Thread(target=ws.run_forever)
-        wst.daemon = True
-        wst.start()
-        time.sleep(1)
-        
-        while is_running:
-            data = stream.read(CHUNK)
-            if ws and ws.sock and ws.sock.connected:
-                ws.send(data, websocket.ABNF.OPCODE_BINARY)
-            else:
+    def _hold_backticks(self, text, start):
+        # Splits off up to two trailing backticks that might begin a fence.
+        held = min(len(text) - len(text.rstrip("`")), 2, len(text) - start)
+        if held:
+            self.pending = text[len(text) - held:]
+        return len(text) - held
+
+    def feed(self, text):
+        text = self.pending + text
+        self.pending = ""
+        runs = []
+        pos = 0
+        while pos < len(text):
+            fence = text.find("```", pos)
+            if self.lang_line is not None:
+                newline = text.find("\n", pos)
+                if fence >= 0 and (newline < 0 or fence < newline):
+                    line, pos = self.lang_line + text[pos:fence], fence
+                    self.lang_line = None
+                    if line:
+                        runs.append((line, "code"))
+                    continue
+                if newline < 0:
+                    end = self._hold_backticks(text, pos)
+                    self.lang_line += text[pos:end]
+                    if len(self.lang_line) > self.MAX_LANG_CHARS:
+                        runs.append((self.lang_line, "code"))
+                        self.lang_line = None
+                    break
+                line = self.lang_line + text[pos:newline]
+                self.lang_line = None
+                if line.strip().lower() in CODE_LANGS:
+                    pos = newline + 1
+                else:
+                    if line:
+                        runs.append((line, "code"))
+                    pos = newline
+                continue
+            if fence < 0:
+                end = self._hold_backticks(text, pos)
+                if end > pos:
+                    runs.append((text[pos:end], self._tag()))
                 break
-    except Exception as e:
-        print(f"[ERROR] Audio Stream Failed: {e}")
+            if fence > pos:
+                runs.append((text[pos:fence], self._tag()))
+            self.in_code = not self.in_code
+            if self.in_code:
+                self.lang_line = ""
+            pos = fence + 3
+        return runs
 
-# ========================
-# GUI Class
-# ========================
+def create_app():
+    # Imports the UI toolkit and opens the window. StealthCopilotApp is mixed
+    # into customtkinter's CTk here, so the class needs no toolkit to be defined.
+    global tk, ctk, filedialog, simpledialog
+    import tkinter as tk
+    import customtkinter as ctk
+    from tkinter import filedialog, simpledialog
+    ctk.set_appearance_mode("Dark")
+    ctk.set_default_color_theme("blue")
+    return type("StealthCopilotApp", (StealthCopilotApp, ctk.CTk), {})()
 
-class StealthCopilotApp(ctk.CTk):
+class StealthCopilotApp:
     def __init__(self):
         super().__init__()
 
@@ -366,8 +4370,12 @@ class StealthCopilotApp(ctk.CTk):
         self.is_stealth = True  # Default to True
         self.window_visible = True
         self.last_turn_start_index = None
-        self.in_code_block = False
-        self.code_block_just_opened = False
+        self.fence_parser = CodeFenceParser()
+        self.frame_lock = threading.Lock()
+        self.frame_pending = False
+        self.lines_since_trim = 0
+        self.debug_panel = None
+        self.debug_panel_job = None
         
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -434,6 +4442,12 @@ class StealthCopilotApp(ctk.CTk):
         self.btn_clear = ctk.CTkButton(self.upload_btn_frame, text="Clear Context", fg_color="gray", command=self.clear_context)
         self.btn_clear.pack(side="left")
 
+        self.lbl_ingest_status = ctk.CTkLabel(self.setup_frame, text="", anchor="w")
+        self.lbl_ingest_status.pack(fill="x", pady=(0, 5))
+
+        self.lbl_bank_status = ctk.CTkLabel(self.setup_frame, text="", anchor="w")
+        self.lbl_bank_status.pack(fill="x", pady=(0, 5))
+
         self.lbl_context_preview = ctk.CTkLabel(self.setup_frame, text="Extracted Context Preview:", anchor="w")
         self.lbl_context_preview.pack(fill="x", pady=(0, 5))
         self.txt_context = ctk.CTkTextbox(self.setup_frame)
@@ -446,8 +4460,12 @@ class StealthCopilotApp(ctk.CTk):
         # --- Stealth Overlay Widget ---
         self.overlay_text_widget = None
 
+        startup.mark("ui")
+        self.start_session_store()
         self.start_threads()
-        self.after(50, self.check_queue) # Faster polling
+        answer_queue.set_listener(self.request_frame)
+        self.after(RENDER_IDLE_POLL_MS, self.idle_poll)
+        self.after(500, self.refresh_bank_status)
         
         # Auto-start Stealth Mode
         self.after(100, self.activate_stealth_mode)
@@ -459,6 +4477,9 @@ class StealthCopilotApp(ctk.CTk):
         global custom_instructions
         custom_instructions = self.txt_instr.get("0.0", "end").strip()
         print("[INFO] Instructions updated.")
+        if session_store:
+            session_store.set_setting("custom_instructions", custom_instructions)
+        self.prewarm_answers()
 
     def update_company_name(self, name=None):
         global company_name
@@ -469,6 +4490,9 @@ class StealthCopilotApp(ctk.CTk):
             print(f"[INFO] Company set to: {company_name}")
         else:
             print("[INFO] Company cleared.")
+        if session_store:
+            session_store.set_setting("company_name", company_name)
+        self.prewarm_answers()
 
     def prompt_company_name(self):
         name = simpledialog.askstring("Company Name", "Enter company name:")
@@ -484,6 +4508,9 @@ class StealthCopilotApp(ctk.CTk):
             print(f"[INFO] Interview stage set to: {interview_stage}")
         else:
             print("[INFO] Interview stage cleared.")
+        if session_store:
+            session_store.set_setting("interview_stage", interview_stage)
+        self.prewarm_answers()
 
     def prompt_interview_stage(self):
         stage = simpledialog.askstring("Interview Stage", "Enter interview stage (e.g., HR, manager round):")
@@ -493,13 +4520,46 @@ class StealthCopilotApp(ctk.CTk):
     def upload_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("Documents", "*.pdf *.docx *.txt")])
         if file_path:
-            text = extract_text_from_file(file_path)
+            self.lbl_ingest_status.configure(text=f"Reading {os.path.basename(file_path)}...")
+            ingest_executor.submit(self.ingest_file, file_path)
+
+    def ingest_file(self, file_path):
+        # Runs on ingest_executor: extraction and indexing happen here, and only the
+        # final context update is handed back to the Tk thread.
+        name = os.path.basename(file_path)
+        start = time.perf_counter()
+        last_shown = [-1]
+
+        def progress(done, total):
+            percent = done * 100 // max(total, 1)
+            if percent >= last_shown[0] + 5 or done == total:
+                last_shown[0] = percent
+                self.after(0, lambda: self.lbl_ingest_status.configure(text=f"Reading {name}: {done}/{total} pages"))
+
+        try:
+            text, from_cache = cached_extract_text(file_path, progress)
             if text:
-                global global_context
-                global_context += f"\n--- START FILE: {os.path.basename(file_path)} ---\n{text}\n--- END FILE ---\n"
-                self.txt_context.delete("0.0", "end")
-                self.txt_context.insert("0.0", global_context)
-                print(f"[INFO] Added {file_path} to context.")
+                context_index.add_document(name, text)
+                if session_store:
+                    session_store.add_document(name, text)
+        except Exception as e:
+            print(f"[ERROR] Failed to ingest {file_path}: {e}")
+            text, from_cache = "", False
+        self.after(0, self.finish_ingest, file_path, text, from_cache, time.perf_counter() - start)
+
+    def finish_ingest(self, file_path, text, from_cache, elapsed):
+        name = os.path.basename(file_path)
+        if not text:
+            self.lbl_ingest_status.configure(text=f"No text found in {name}")
+            return
+        global global_context
+        global_context += f"\n--- START FILE: {name} ---\n{text}\n--- END FILE ---\n"
+        self.txt_context.delete("0.0", "end")
+        self.txt_context.insert("0.0", global_context)
+        source = " (cached)" if from_cache else ""
+        self.lbl_ingest_status.configure(text=f"Added {name}{source} in {elapsed:.1f}s")
+        print(f"[INFO] Added {file_path} to context{source} in {elapsed:.2f}s.")
+        self.prewarm_answers()
 
     def upload_file_hotkey(self):
         self.upload_file()
@@ -507,18 +4567,89 @@ class StealthCopilotApp(ctk.CTk):
     def clear_context(self):
         global global_context
         global_context = ""
+        context_index.clear()
+        self.txt_context.delete("0.0", "end")
+        if session_store:
+            session_store.clear_documents()
+        self.prewarm_answers()
+
+    def prewarm_answers(self):
+        if PREWARM_MODE:
+            answer_bank.schedule()
+
+    def refresh_bank_status(self):
+        self.lbl_bank_status.configure(text=answer_bank.status_text())
+        self.after(500, self.refresh_bank_status)
+
+    def start_session_store(self):
+        # The app is usable at once; the last session is loaded on the ingest
+        # thread, ahead of any upload made meanwhile.
+        global session_store
+        if SESSION_DB_PATH:
+            session_store = SessionStore(SESSION_DB_PATH)
+            ingest_executor.submit(self.restore_session)
+
+    def restore_session(self):
+        global custom_instructions, company_name, interview_stage
+        start = time.perf_counter()
+        try:
+            saved = session_store.open()
+        except (sqlite3.Error, OSError) as e:
+            print(f"[ERROR] Could not open session store: {e}")
+            return
+        if not saved:
+            return
+        settings = saved["settings"]
+        custom_instructions = settings.get("custom_instructions", custom_instructions)
+        company_name = settings.get("company_name", company_name)
+        interview_stage = settings.get("interview_stage", interview_stage)
+        self.after(0, self.show_restored_settings)
+
+        if saved["turns"]:
+            memory = json.loads(settings.get("memory_summary", "{}"))
+            conversation_memory.restore(memory.get("summary", ""), memory.get("through", 0), saved["turns"])
+
+        blocks = []
+        for name, text in saved["documents"]:
+            context_index.add_document(name, text)
+            blocks.append(f"\n--- START FILE: {name} ---\n{text}\n--- END FILE ---\n")
+        self.after(0, self.finish_restore, "".join(blocks), saved, time.perf_counter() - start)
+
+    def show_restored_settings(self):
+        self.txt_instr.delete("0.0", "end")
+        self.txt_instr.insert("0.0", custom_instructions)
+        self.entry_company.delete(0, "end")
+        self.entry_company.insert(0, company_name)
+        self.entry_stage.delete(0, "end")
+        self.entry_stage.insert(0, interview_stage)
+
+    def finish_restore(self, context, saved, elapsed):
+        global global_context
+        global_context = context + global_context
         self.txt_context.delete("0.0", "end")
+        self.txt_context.insert("0.0", global_context)
+        kind = "Resumed" if saved["resumed"] else "Restored settings from"
+        print(f"[INFO] {kind} last session: {len(saved['documents'])} documents, "
+              f"{len(saved['turns']) if saved['resumed'] else 0} turns in {elapsed * 1000:.0f} ms.")
+        if saved["documents"] or company_name or interview_stage:
+            self.prewarm_answers()
 
     def start_threads(self):
-        threading.Thread(target=websocket_stream, daemon=True).start()
+        global async_pipeline
+        if PIPELINE_ENGINE == "asyncio":
+            async_pipeline = AsyncPipeline().start()
+        else:
+            threading.Thread(target=websocket_stream, daemon=True).start()
         threading.Thread(target=self.hotkey_listener, daemon=True).start()
 
     def hotkey_listener(self):
+        from pynput import keyboard
         hotkeys = {
             HOTKEY: lambda: self.after(0, self.toggle_visibility),
             HOTKEY_UPLOAD: lambda: self.after(0, self.upload_file_hotkey),
             HOTKEY_COMPANY: lambda: self.after(0, self.prompt_company_name),
             HOTKEY_STAGE: lambda: self.after(0, self.prompt_interview_stage),
+            HOTKEY_DEBUG: lambda: self.after(0, self.toggle_debug_panel),
         }
         with keyboard.GlobalHotKeys(hotkeys) as listener:
             listener.join()
@@ -526,6 +4657,24 @@ class StealthCopilotApp(ctk.CTk):
     def toggle_visibility(self):
         self.after(0, self._toggle_visibility_main)
 
+    def toggle_debug_panel(self):
+        # Rolling latency percentiles over the current window, drawn inside the
+        # main window so it shares its capture exclusion.
+        if self.debug_panel is not None:
+            self.after_cancel(self.debug_panel_job)
+            self.debug_panel.destroy()
+            self.debug_panel = None
+            return
+        self.debug_panel = tk.Label(self, justify="left", anchor="nw", font=("Consolas", 9),
+                                    bg="#111111", fg="#9cdcfe", padx=8, pady=6)
+        self.debug_panel.place(relx=1.0, rely=1.0, anchor="se")
+        self.refresh_debug_panel()
+
+    def refresh_debug_panel(self):
+        self.debug_panel.configure(text=turn_tracer.summary_text())
+        self.debug_panel.lift()
+        self.debug_panel_job = self.after(1000, self.refresh_debug_panel)
+
     def _toggle_visibility_main(self):
         if self.window_visible:
             self.withdraw()
@@ -639,22 +4788,53 @@ class StealthCopilotApp(ctk.CTk):
             dy = event.y - self.y
             self.geometry(f"+{self.winfo_x() + dx}+{self.winfo_y() + dy}")
 
-    def check_queue(self):
+    def request_frame(self):
+        # answer_queue listener, called from worker threads: schedules at most one
+        # render per frame, so tokens that arrive together are drawn together.
+        with self.frame_lock:
+            if self.frame_pending:
+                return
+            self.frame_pending = True
+        self.after(RENDER_FRAME_MS, self.render_frame)
+
+    def render_frame(self):
+        with self.frame_lock:
+            self.frame_pending = False
         try:
-            # Batch process up to 20 items to reduce GUI overhead and improve smoothness
-            for _ in range(20):
-                if answer_queue.empty(): break
-                msg = answer_queue.get_nowait()
-                if "gen" in msg and msg["gen"] != stream_manager.current_generation:
-                    continue
-                self.process_stream_token(msg)
-        except:
-            pass
-        self.after(20, self.check_queue) # 20ms polling for smoother flow
+            self.render_messages(answer_queue.drain())
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"[DEBUG] Render error: {e}")
+
+    def idle_poll(self):
+        if not answer_queue.empty():
+            self.request_frame()
+        self.after(RENDER_IDLE_POLL_MS, self.idle_poll)
+
+    def insert_runs(self, target, runs):
+        # Merges adjacent runs with the same tag; a tk.Text takes them all in one
+        # insert call, the CTkTextbox one call per run.
+        merged = []
+        for text, tag in runs:
+            if merged and merged[-1][1] == tag:
+                merged[-1][0] += text
+            elif text:
+                merged.append([text, tag])
+        if not merged:
+            return
+        self.lines_since_trim += sum(text.count("\n") for text, _ in merged)
+        if isinstance(target, tk.Text):
+            args = []
+            for text, tag in merged:
+                args += [text, tag or ()]
+            target.insert(tk.END, *args)
+        else:
+            for text, tag in merged:
+                target.insert(tk.END, text, tag)
 
-    def process_stream_token(self, msg):
+    def render_messages(self, messages):
         target = self.overlay_text_widget if self.is_stealth else self.live_textbox
-        if not target: return
+        if not target or not messages: return
 
         # Smart Autoscroll Check
         # Only autoscroll if the scrollbar is STRICTLY at the bottom (1.0)
@@ -662,64 +4842,75 @@ class StealthCopilotApp(ctk.CTk):
         # We use a small epsilon for float comparison safety
         is_at_bottom = target.yview()[1] > 0.999
 
-        if msg["type"] == "new_turn":
-            # Mark where this turn starts, so we can delete it if cancelled
-            self.in_code_block = False # Reset code block state for new turn
-            self.code_block_just_opened = False
-            if CLEAR_ON_NEW_TURN:
+        runs = []
+        rendered_gens = set()
+        for msg in messages:
+            if "gen" in msg and msg["gen"] != stream_manager.current_generation:
+                continue
+
+            if msg["type"] == "new_turn":
+                # Mark where this turn starts, so we can delete it if cancelled
+                self.insert_runs(target, runs + self.fence_parser.flush())
+                runs = []
+                if CLEAR_ON_NEW_TURN:
+                    try:
+                        target.delete("1.0", tk.END)
+                    except:
+                        pass
                 try:
-                    target.delete("1.0", tk.END)
+                    self.last_turn_start_index = target.index("end-1c")
                 except:
-                    pass
+                    self.last_turn_start_index = None
+                runs.append((msg["content"], "question"))
+
+            elif msg["type"] == "remove_last_turn":
+                self.insert_runs(target, runs)
+                runs = []
+                self.fence_parser.reset()
+                if self.last_turn_start_index:
+                    try:
+                        target.delete(self.last_turn_start_index, tk.END)
+                    except:
+                        pass
+                    self.last_turn_start_index = None
+
+            elif msg["type"] in ["text", "error"]:
+                runs += self.fence_parser.feed(msg["content"])
+                rendered_gens.add(msg["gen"])
+
+        self.insert_runs(target, runs)
+        if rendered_gens:
+            turn_tracer.rendered(rendered_gens, time.perf_counter())
+
+        # Trim history to the last MAX_HISTORY_LINES lines, checked every TRIM_CHECK_LINES new lines.
+        if self.lines_since_trim >= TRIM_CHECK_LINES:
+            self.lines_since_trim = 0
             try:
-                self.last_turn_start_index = target.index("end-1c")
+                line_count = int(target.index("end-1c").split(".")[0])
+                if line_count > MAX_HISTORY_LINES:
+                    trim_to = f"{line_count - MAX_HISTORY_LINES}.0"
+                    target.delete("1.0", trim_to)
             except:
-                self.last_turn_start_index = None
-            target.insert(tk.END, msg["content"], "question")
-            
-        elif msg["type"] == "remove_last_turn":
-            if self.last_turn_start_index:
-                try:
-                    target.delete(self.last_turn_start_index, tk.END)
-                except:
-                    pass
-                self.last_turn_start_index = None
-
-        elif msg["type"] in ["text", "error"]:
-            content = msg["content"]
-            
-            # Simple Markdown Code Block Parser for Streaming
-            parts = content.split("```")
-            for i, part in enumerate(parts):
-                if i > 0:
-                    self.in_code_block = not self.in_code_block
-                    if self.in_code_block:
-                        self.code_block_just_opened = True
-                
-                if part:
-                    tags = "code" if self.in_code_block else None
-                    text_part = part
-                    if self.in_code_block and self.code_block_just_opened:
-                        first_line, sep, rest = text_part.partition("\n")
-                        lang = first_line.strip().lower()
-                        if lang in {"bash", "sh", "zsh", "powershell", "pwsh", "cmd", "python", "yaml", "yml", "json", "sql"}:
-                            text_part = rest
-                        self.code_block_just_opened = False
-                    target.insert(tk.END, text_part, tags)
-            
-        # Trim history to the last MAX_HISTORY_LINES lines.
-        try:
-            line_count = int(target.index("end-1c").split(".")[0])
-            if line_count > MAX_HISTORY_LINES:
-                trim_to = f"{line_count - MAX_HISTORY_LINES}.0"
-                target.delete("1.0", trim_to)
-        except:
-            pass
+                pass
 
         # If we were at the bottom, keep scrolling. If user scrolled up, don't force it.
         if is_at_bottom:
             target.see(tk.END)
 
-if __name__ == "__main__":
-    app = StealthCopilotApp()
+if __name__ == "__main__" and "--serve" in sys.argv[1:]:
+    run_headless_server()
+elif __name__ == "__main__":
+    startup.mark("imports")
+    client.start()
+    connection_warmer.start().warm()
+    turn_tracer.start()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    app = create_app()
     app.mainloop()
+    connection_warmer.report()
+    turn_classifier.report()
+    turn_assembler.report()
+    stream_manager.report()
+    if session_store:
+        session_store.close()